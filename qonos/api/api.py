@@ -14,6 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from qonos.api import archiver
+from qonos.api import query_reporter
+from qonos.api import reaper
 from qonos.common import utils
 from qonos.openstack.common import cfg
 from qonos.openstack.common.gettextutils import _
@@ -26,6 +29,16 @@ api_opts = [
     cfg.BoolOpt('daemonized', default=False),
     cfg.IntOpt('port', default=8080),
     cfg.MultiStrOpt('action_overrides', default=[]),
+    cfg.IntOpt('scheduler_partitions', default=64,
+               help=_('Number of partitions the schedules are split into '
+                      'among running schedulers')),
+    cfg.IntOpt('scheduler_lease_ttl', default=30,
+               help=_('Seconds a scheduler keeps its partitions without '
+                      'renewing its lease')),
+    cfg.StrOpt('schedule_smoothing_window', default=None,
+               help=_("Window of the day, as 'HH:MM-HH:MM', within which "
+                      "schedules created without a minute and hour are "
+                      "given a daily run time")),
 ]
 
 action_opts = [
@@ -53,9 +66,15 @@ class API(object):
             #NOTE(ameade): We need to preserve all open files for logging
             open_files = utils.get_qonos_open_file_log_handlers()
             with daemon.DaemonContext(files_preserve=open_files):
-                wsgi.run_server(self.app, CONF.api.port)
+                self._serve()
         else:
-            wsgi.run_server(self.app, CONF.api.port)
+            self._serve()
+
+    def _serve(self):
+        reaper.JobReaper().start()
+        archiver.JobArchiver().start()
+        query_reporter.QueryStatsReporter().start()
+        wsgi.run_server(self.app, CONF.api.port)
 
     def register_action_override_cfg_opts(self):
         for action in CONF.api.action_overrides:
@@ -0,0 +1,81 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from eventlet import greenthread
+
+import qonos.db
+from qonos.openstack.common import cfg
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+from qonos.openstack.common import loopingcall
+from qonos.openstack.common import timeutils
+
+LOG = logging.getLogger(__name__)
+
+archiver_opts = [
+    cfg.IntOpt('job_archive_interval', default=300,
+               help=_('Seconds between moves of finished jobs to the job '
+                      'archive. 0 disables archiving')),
+    cfg.IntOpt('job_archive_age', default=86400,
+               help=_('Seconds a job must have been finished before it is '
+                      'archived')),
+    cfg.IntOpt('job_archive_batch_size', default=100,
+               help=_('Number of jobs archived per transaction')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(archiver_opts, group='api')
+
+
+class JobArchiver(object):
+    """Periodically moves finished jobs out of the jobs table."""
+
+    def __init__(self, db_api=None):
+        self.db_api = db_api or qonos.db.get_api()
+
+    def start(self):
+        if CONF.api.job_archive_interval <= 0:
+            LOG.info(_('Job archiver disabled'))
+            return None
+
+        timer = loopingcall.LoopingCall(self.archive)
+        timer.start(interval=CONF.api.job_archive_interval,
+                    initial_delay=CONF.api.job_archive_interval)
+        return timer
+
+    def archive(self):
+        """Archive all jobs finished longer than job_archive_age ago, a
+        batch at a time."""
+        batch_size = CONF.api.job_archive_batch_size
+        finished_before = timeutils.utcnow() - datetime.timedelta(
+            seconds=CONF.api.job_archive_age)
+        total = 0
+        try:
+            while True:
+                moved = self.db_api.jobs_archive_finished(finished_before,
+                                                          batch_size)
+                total += moved
+                if moved < batch_size:
+                    break
+                greenthread.sleep(0)
+        except Exception:
+            LOG.exception(_('Failed to archive finished jobs'))
+
+        if total:
+            LOG.info(_('Archived %d finished jobs') % total)
+        return total
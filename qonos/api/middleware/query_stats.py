@@ -0,0 +1,81 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A filter middleware that counts and times the database queries of each
+request, reports them in response headers and adds them to the totals
+of the route which served the request.
+"""
+
+import webob.dec
+
+from qonos.db import query_stats
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+from qonos.openstack.common import wsgi
+
+LOG = logging.getLogger(__name__)
+
+UNROUTED = 'unrouted'
+
+
+class QueryStatsFilter(wsgi.Middleware):
+
+    @webob.dec.wsgify(RequestClass=wsgi.Request)
+    def __call__(self, req):
+        stats = query_stats.start()
+        req.environ['qonos.query_stats'] = stats
+        try:
+            response = req.get_response(self.application)
+        finally:
+            query_stats.stop()
+
+        route = self._route_name(req)
+        query_stats.add_route(route, stats)
+
+        response.headers['X-Qonos-Query-Count'] = str(stats.count)
+        response.headers['X-Qonos-Query-Time-Ms'] = \
+            '%.3f' % (stats.total_time * 1000)
+        response.headers['X-Qonos-Slowest-Query-Time-Ms'] = \
+            '%.3f' % (stats.slowest_time * 1000)
+        if stats.count:
+            msg = _('%(route)s ran %(count)d queries in %(time).3fs, '
+                    'slowest %(slowest_time).3fs: %(slowest)s')
+            LOG.debug(msg % {'route': route,
+                             'count': stats.count,
+                             'time': stats.total_time,
+                             'slowest_time': stats.slowest_time,
+                             'slowest': stats.slowest_statement})
+        return response
+
+    def _route_name(self, req):
+        """Return controller.action for the route which served req."""
+        routing_args = req.environ.get('wsgiorg.routing_args')
+        if not routing_args:
+            return UNROUTED
+        match = routing_args[1] or {}
+        if match.get('controller') is None or match.get('action') is None:
+            return UNROUTED
+        # NOTE: routes are connected to wsgi.Resource wrappers
+        controller = getattr(match['controller'], 'controller',
+                             match['controller'])
+        return '%s.%s' % (controller.__class__.__name__, match['action'])
+
+    @classmethod
+    def factory(cls, global_conf, **local_conf):
+        def filter(app):
+            return cls(app)
+        return filter
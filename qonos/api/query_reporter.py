@@ -0,0 +1,61 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from qonos.db import query_stats
+from qonos.openstack.common import cfg
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+from qonos.openstack.common import loopingcall
+
+LOG = logging.getLogger(__name__)
+
+reporter_opts = [
+    cfg.IntOpt('query_stats_report_interval', default=300,
+               help=_('Seconds between logs of the database queries run '
+                      'by each API route. 0 disables the report')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(reporter_opts, group='api')
+
+
+class QueryStatsReporter(object):
+    """Periodically logs the query totals of each API route."""
+
+    def start(self):
+        if CONF.api.query_stats_report_interval <= 0:
+            LOG.info(_('Query stats report disabled'))
+            return None
+
+        timer = loopingcall.LoopingCall(self.report)
+        timer.start(interval=CONF.api.query_stats_report_interval,
+                    initial_delay=CONF.api.query_stats_report_interval)
+        return timer
+
+    def report(self):
+        """Log the query totals of every route which has served requests,
+        busiest in queries first."""
+        routes = query_stats.routes_snapshot()
+        msg = _('%(route)s: %(requests)d requests, %(queries)d queries '
+                '(%(per_request).1f avg, %(max_queries)d max), '
+                '%(total_time).3fs in the database, slowest query '
+                '%(slowest_time).3fs: %(slowest_statement)s')
+        for route in sorted(routes, key=lambda r: -routes[r]['queries']):
+            values = dict(routes[route], route=route)
+            values['per_request'] = (float(values['queries']) /
+                                     values['requests'])
+            LOG.info(msg % values)
+        return routes
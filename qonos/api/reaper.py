@@ -0,0 +1,80 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from eventlet import greenthread
+
+import qonos.db
+from qonos.openstack.common import cfg
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+from qonos.openstack.common import loopingcall
+
+LOG = logging.getLogger(__name__)
+
+reaper_opts = [
+    cfg.IntOpt('job_reaper_interval', default=60,
+               help=_('Seconds between sweeps for abandoned jobs, past '
+                      'both their timeout and hard timeout without '
+                      'finishing. 0 disables the reaper')),
+    cfg.IntOpt('job_reaper_batch_size', default=100,
+               help=_('Number of jobs deleted per transaction')),
+    cfg.BoolOpt('job_reaper_record_faults', default=True,
+                help=_('Record a job fault for each job deleted')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(reaper_opts, group='api')
+
+
+class JobReaper(object):
+    """Periodically deletes abandoned jobs, which have passed both their
+    timeout and their hard timeout without finishing."""
+
+    def __init__(self, db_api=None):
+        self.db_api = db_api or qonos.db.get_api()
+
+    def start(self):
+        if CONF.api.job_reaper_interval <= 0:
+            LOG.info(_('Job reaper disabled'))
+            return None
+
+        timer = loopingcall.LoopingCall(self.reap)
+        timer.start(interval=CONF.api.job_reaper_interval,
+                    initial_delay=CONF.api.job_reaper_interval)
+        return timer
+
+    def reap(self):
+        """Delete all abandoned jobs, a batch at a time so no transaction
+        holds its locks for long."""
+        batch_size = CONF.api.job_reaper_batch_size
+        record_faults = CONF.api.job_reaper_record_faults
+        total = 0
+        try:
+            while True:
+                deleted = self.db_api.jobs_delete_hard_timed_out(
+                    batch_size, record_faults)
+                total += deleted
+                if deleted < batch_size:
+                    break
+                # let requests in between batches
+                greenthread.sleep(0)
+        except Exception:
+            # NOTE: an error escaping would stop the looping call for good
+            LOG.exception(_('Failed to delete hard timed out jobs'))
+
+        if total:
+            LOG.info(_('Deleted %d jobs past their hard timeout') % total)
+        return total
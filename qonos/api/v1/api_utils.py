@@ -14,7 +14,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import hashlib
+
+from qonos.common import cron
+from qonos.common import exception
 from qonos.common import utils
+from qonos.openstack.common.gettextutils import _
 
 
 def serialize_metadata(metadata):
@@ -60,3 +66,90 @@ def schedule_to_next_run(schedule):
     return utils.cron_string_to_next_datetime(minute, hour, day_of_month,
                                               month, day_of_week,
                                               schedule.get('last_scheduled'))
+
+
+def parse_partitions(value, partition_count):
+    """Return the scheduler partitions given as a list or as a comma
+    separated string."""
+    if isinstance(value, basestring):
+        value = value.split(',') if value else []
+    try:
+        partitions = [int(partition) for partition in value]
+    except (TypeError, ValueError):
+        partitions = None
+    if partitions is None or [p for p in partitions
+                              if not 0 <= p < partition_count]:
+        msg = _('partitions must be numbers from 0 to %d') % \
+            (partition_count - 1)
+        raise exception.Invalid(message=msg)
+    return partitions
+
+
+def parse_time_window(window):
+    """Return the first minute of the day and the length in minutes of a
+    window of the day given as 'HH:MM-HH:MM', which may run past
+    midnight."""
+    try:
+        start, end = [[int(part) for part in time.split(':')]
+                      for time in window.split('-')]
+        start_hour, start_minute = start
+        end_hour, end_minute = end
+        if not (0 <= start_hour < 24 and 0 <= end_hour < 24 and
+                0 <= start_minute < 60 and 0 <= end_minute < 60):
+            raise ValueError(window)
+    except ValueError:
+        msg = _("time window must be given as 'HH:MM-HH:MM'")
+        raise exception.Invalid(message=msg)
+    start = start_hour * 60 + start_minute
+    length = (end_hour * 60 + end_minute - start) % (24 * 60) or 24 * 60
+    return start, length
+
+
+def smooth_schedule(schedule, window):
+    """Give a schedule which leaves its time of day unset a time within
+    window, a (start, length) from parse_time_window, so it runs daily at
+    that time.
+
+    The time is picked from a hash of the schedule id, spreading schedules
+    evenly over the window while each keeps the same time.
+    """
+    if schedule.get('minute') is not None or \
+            schedule.get('hour') is not None:
+        return
+    start, length = window
+    offset = int(hashlib.md5(str(schedule['id'])).hexdigest()[:8], 16)
+    minute_of_day = (start + offset % length) % (24 * 60)
+    schedule['hour'] = minute_of_day // 60
+    schedule['minute'] = minute_of_day % 60
+
+
+def forecast_jobs(cron_counts, start_time, end_time, bucket_minutes):
+    """Return how many jobs of each action the schedules counted in
+    cron_counts will create in each bucket_minutes long bucket from
+    start_time to end_time.
+
+    Schedules sharing an action and cron pattern run together, so the
+    runs of each pattern are worked out only once.
+    """
+    bucket_size = datetime.timedelta(minutes=bucket_minutes)
+    buckets = []
+    bucket_start = start_time
+    while bucket_start < end_time:
+        buckets.append({'start': bucket_start,
+                        'end': min(bucket_start + bucket_size, end_time),
+                        'jobs': {}})
+        bucket_start += bucket_size
+
+    for cron_count in cron_counts:
+        expression = cron.get_expression(
+            cron_count['minute'], cron_count['hour'],
+            cron_count['day_of_month'], cron_count['month'],
+            cron_count['day_of_week'])
+        action = cron_count['action']
+        for run in expression.runs_between(start_time, end_time):
+            elapsed = run - start_time
+            index = (elapsed.days * 86400 + elapsed.seconds) // \
+                (bucket_minutes * 60)
+            jobs = buckets[index]['jobs']
+            jobs[action] = jobs.get(action, 0) + cron_count['count']
+    return buckets
@@ -39,6 +39,7 @@ class JobsController(object):
         params = {}
         params['limit'] = request.params.get('limit')
         params['marker'] = request.params.get('marker')
+        params['cursor'] = request.params.get('cursor')
         return params
 
     def list(self, request):
@@ -51,33 +52,84 @@ class JobsController(object):
             jobs = self.db_api.job_get_all(params)
         except exception.NotFound:
             raise webob.exc.HTTPNotFound()
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
+
+        for job in jobs:
+            utils.serialize_datetimes(job)
+            api_utils.serialize_job_metadata(job)
+        return {'jobs': jobs}
+
+    def list_archive(self, request):
+        params = self._get_request_params(request)
+        params['schedule_id'] = request.params.get('schedule_id')
+        params['tenant'] = request.params.get('tenant')
+        try:
+            params = utils.get_pagination_limit(params)
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
+        try:
+            jobs = self.db_api.job_archive_get_all(params)
+        except exception.NotFound:
+            raise webob.exc.HTTPNotFound()
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
 
         for job in jobs:
             utils.serialize_datetimes(job)
             api_utils.serialize_job_metadata(job)
         return {'jobs': jobs}
 
+    def list_faults(self, request):
+        params = self._get_request_params(request)
+        for key in ('job_id', 'schedule_id', 'tenant', 'action'):
+            params[key] = request.params.get(key)
+        try:
+            params = utils.get_pagination_limit(params)
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
+        try:
+            faults = self.db_api.job_fault_get_all(params)
+        except exception.NotFound:
+            raise webob.exc.HTTPNotFound()
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
+
+        for fault in faults:
+            utils.serialize_datetimes(fault)
+        return {'faults': faults}
+
     def create(self, request, body):
+        """Create a job for the run of a schedule given by
+        'scheduled_run', by default its next_run.
+
+        Only one job is created per run, so creating it again, as a
+        scheduler retrying a request would, returns the same job.
+        """
         if (body is None or body.get('job') is None or
                 body['job'].get('schedule_id') is None):
             raise webob.exc.HTTPBadRequest()
         job = body['job']
 
         try:
-            schedule = self.db_api.schedule_get_by_id(job['schedule_id'])
+            # NOTE: the schedule may have only just been created
+            schedule = self.db_api.schedule_get_by_id(job['schedule_id'],
+                                                      consistent=True)
         except exception.NotFound:
             raise webob.exc.HTTPNotFound()
 
-        # Update schedule last_scheduled and next_run
-        values = {}
-        values['next_run'] = api_utils.schedule_to_next_run(schedule)
-        print values['next_run']
-        values['last_scheduled'] = timeutils.utcnow()
-        self.db_api.schedule_update(schedule['id'], values)
+        scheduled_run = schedule.get('next_run')
+        if job.get('scheduled_run') is not None:
+            try:
+                scheduled_run = timeutils.normalize_time(
+                    timeutils.parse_isotime(job['scheduled_run']))
+            except ValueError as e:
+                raise webob.exc.HTTPBadRequest(explanation=str(e))
 
         # Create job
         values = {}
         values.update(job)
+        values['scheduled_run'] = scheduled_run
         values['tenant'] = schedule['tenant']
         values['action'] = schedule['action']
         values['status'] = 'queued'
@@ -101,11 +153,53 @@ class JobsController(object):
             datetime.timedelta(seconds=job_timeout_seconds)
 
         job = self.db_api.job_create(values)
+
+        # Update schedule last_scheduled and next_run, unless the run was
+        # already moved past
+        if schedule.get('next_run') == scheduled_run:
+            values = {}
+            values['next_run'] = api_utils.schedule_to_next_run(schedule)
+            values['last_scheduled'] = timeutils.utcnow()
+            self.db_api.schedule_update(schedule['id'], values)
+
         utils.serialize_datetimes(job)
         api_utils.serialize_job_metadata(job)
 
         return {'job': job}
 
+    def enqueue(self, request, body=None):
+        """Create jobs for every schedule due by 'next_run_before'
+        (default now) in one step and return the new job ids. Only the
+        schedules in 'partitions', if given, are enqueued."""
+        body = body or {}
+        next_run_before = timeutils.utcnow()
+        if body.get('next_run_before') is not None:
+            try:
+                next_run_before = timeutils.parse_isotime(
+                    body['next_run_before'])
+            except ValueError as e:
+                raise webob.exc.HTTPBadRequest(explanation=str(e))
+            next_run_before = timeutils.normalize_time(next_run_before)
+
+        action_timeouts = {}
+        for action in CONF.api.action_overrides:
+            action_timeouts[action] = self._job_get_timeout(action)
+
+        partitions = None
+        partition_count = CONF.api.scheduler_partitions
+        if body.get('partitions') is not None:
+            try:
+                partitions = api_utils.parse_partitions(body['partitions'],
+                                                        partition_count)
+            except exception.Invalid as e:
+                raise webob.exc.HTTPBadRequest(explanation=str(e))
+
+        job_ids = self.db_api.jobs_create_for_due_schedules(
+            next_run_before, self._job_get_timeout('default'),
+            action_timeouts, partitions=partitions,
+            partition_count=partition_count)
+        return {'job_ids': job_ids}
+
     def get(self, request, job_id):
         try:
             job = self.db_api.job_get_by_id(job_id)
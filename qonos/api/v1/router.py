@@ -19,6 +19,7 @@ import routes
 from qonos.api.v1 import job_metadata
 from qonos.api.v1 import jobs
 from qonos.api.v1 import schedule_metadata
+from qonos.api.v1 import schedulers
 from qonos.api.v1 import schedules
 from qonos.api.v1 import workers
 from qonos.openstack.common import wsgi
@@ -39,6 +40,16 @@ class API(wsgi.Router):
                        action='create',
                        conditions=dict(method=['POST']))
 
+        mapper.connect('/schedules/load',
+                       controller=schedules_resource,
+                       action='load',
+                       conditions=dict(method=['GET']))
+
+        mapper.connect('/schedules/forecast',
+                       controller=schedules_resource,
+                       action='forecast',
+                       conditions=dict(method=['GET']))
+
         mapper.connect('/schedules/{schedule_id}',
                        controller=schedules_resource,
                        action='get',
@@ -78,6 +89,21 @@ class API(wsgi.Router):
                        action='create',
                        conditions=dict(method=['POST']))
 
+        mapper.connect('/jobs/archive',
+                       controller=jobs_resource,
+                       action='list_archive',
+                       conditions=dict(method=['GET']))
+
+        mapper.connect('/jobs/faults',
+                       controller=jobs_resource,
+                       action='list_faults',
+                       conditions=dict(method=['GET']))
+
+        mapper.connect('/jobs/enqueue',
+                       controller=jobs_resource,
+                       action='enqueue',
+                       conditions=dict(method=['POST']))
+
         mapper.connect('/jobs/{job_id}',
                        controller=jobs_resource,
                        action='get',
@@ -132,6 +158,18 @@ class API(wsgi.Router):
                        action='get_next_job',
                        conditions=dict(method=['POST']))
 
+        schedulers_resource = schedulers.create_resource()
+
+        mapper.connect('/schedulers/{scheduler_id}/lease',
+                       controller=schedulers_resource,
+                       action='lease',
+                       conditions=dict(method=['PUT']))
+
+        mapper.connect('/schedulers/{scheduler_id}/lease',
+                       controller=schedulers_resource,
+                       action='release',
+                       conditions=dict(method=['DELETE']))
+
         super(API, self).__init__(mapper)
 
     @classmethod
@@ -0,0 +1,48 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from qonos.api import api
+import qonos.db
+from qonos.openstack.common import wsgi
+
+
+CONF = api.CONF
+
+
+class SchedulersController(object):
+
+    def __init__(self, db_api=None):
+        self.db_api = db_api or qonos.db.get_api()
+
+    def lease(self, request, scheduler_id, body=None):
+        """Renew the scheduler's lease and return the partitions of the
+        schedules it is to enqueue jobs for over the next ttl seconds."""
+        body = body or {}
+        ttl = CONF.api.scheduler_lease_ttl
+        partitions = self.db_api.scheduler_lease_partitions(
+            scheduler_id, CONF.api.scheduler_partitions, ttl,
+            host=body.get('host'))
+        return {'lease': {'partitions': partitions,
+                          'partition_count': CONF.api.scheduler_partitions,
+                          'ttl': ttl}}
+
+    def release(self, request, scheduler_id):
+        self.db_api.scheduler_lease_release(scheduler_id)
+
+
+def create_resource():
+    """QonoS resource factory method."""
+    return wsgi.Resource(SchedulersController())
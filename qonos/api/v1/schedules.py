@@ -14,21 +14,39 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+
 import webob.exc
 
+from qonos.api import api
 from qonos.api.v1 import api_utils
 from qonos.common import exception
 from qonos.common import utils
 import qonos.db
+from qonos.db import db_utils
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import timeutils
+from qonos.openstack.common import uuidutils
 from qonos.openstack.common import wsgi
 
 
+CONF = api.CONF
+
+# Bounds on the work done for one forecast
+MAX_FORECAST_DAYS = 31
+MAX_FORECAST_BUCKETS = 10000
+
+
 class SchedulesController(object):
 
     def __init__(self, db_api=None):
         self.db_api = db_api or qonos.db.get_api()
+        # NOTE: a malformed window stops the API from starting, rather
+        # than failing every schedule create
+        self.smoothing_window = None
+        if CONF.api.schedule_smoothing_window:
+            self.smoothing_window = api_utils.parse_time_window(
+                CONF.api.schedule_smoothing_window)
 
     def _get_request_params(self, request):
         filter_args = {}
@@ -44,14 +62,34 @@ class SchedulesController(object):
             next_run_before = timeutils.normalize_time(next_run_before)
             filter_args['next_run_before'] = next_run_before
 
+        if request.params.get('changed_since') is not None:
+            changed_since = request.params['changed_since']
+            changed_since = timeutils.parse_isotime(changed_since)
+            changed_since = timeutils.normalize_time(changed_since)
+            filter_args['changed_since'] = changed_since
+
         if request.params.get('tenant') is not None:
             filter_args['tenant'] = request.params['tenant']
 
         if request.params.get('instance_id') is not None:
-            filter_args['instance_id'] = request.params['instance_id']
+            # NOTE: several instances may be given as a comma separated list
+            filter_args['instance_id'] = \
+                request.params['instance_id'].split(',')
+
+        if request.params.get('partitions') is not None:
+            # NOTE: schedulers list the partitions they hold, as a comma
+            # separated list
+            partition_count = CONF.api.scheduler_partitions
+            try:
+                filter_args['partitions'] = api_utils.parse_partitions(
+                    request.params['partitions'], partition_count)
+            except exception.Invalid as e:
+                raise webob.exc.HTTPBadRequest(explanation=str(e))
+            filter_args['partition_count'] = partition_count
 
         filter_args['limit'] = request.params.get('limit')
         filter_args['marker'] = request.params.get('marker')
+        filter_args['cursor'] = request.params.get('cursor')
         return filter_args
 
     def list(self, request):
@@ -60,15 +98,22 @@ class SchedulesController(object):
             filter_args = utils.get_pagination_limit(filter_args)
         except exception.Invalid as e:
             raise webob.exc.HTTPBadRequest(explanation=str(e))
+        # NOTE: schedulers keeping a cache ask for the changes since their
+        # last sync, which a lagging replica may not have yet
+        consistent = filter_args.get('changed_since') is not None
         try:
-            schedules = self.db_api.schedule_get_all(filter_args=filter_args)
+            schedules = self.db_api.schedule_get_all(filter_args=filter_args,
+                                                     consistent=consistent)
             if len(schedules) != 0 and len(schedules) == filter_args['limit']:
-                next_page = '/v1/schedules?marker=%s' % schedules[-1].get('id')
+                cursor = db_utils.encode_cursor(schedules[-1])
+                next_page = '/v1/schedules?cursor=%s' % cursor
             else:
                 next_page = None
         except exception.NotFound:
             msg = _('The specified marker could not be found')
             raise webob.exc.HTTPNotFound(explanation=msg)
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
         for sched in schedules:
             utils.serialize_datetimes(sched),
             api_utils.serialize_schedule_metadata(sched)
@@ -83,13 +128,68 @@ class SchedulesController(object):
         api_utils.deserialize_schedule_metadata(body['schedule'])
         values = {}
         values.update(body['schedule'])
-        values['next_run'] = api_utils.schedule_to_next_run(body['schedule'])
+        if self.smoothing_window is not None:
+            # NOTE: the run time is picked from the id, so it is set here
+            values.setdefault('id', uuidutils.generate_uuid())
+            api_utils.smooth_schedule(values, self.smoothing_window)
+        values['next_run'] = api_utils.schedule_to_next_run(values)
         schedule = self.db_api.schedule_create(values)
 
         utils.serialize_datetimes(schedule)
         api_utils.serialize_schedule_metadata(schedule)
         return {'schedule': schedule}
 
+    def load(self, request):
+        """Return how many schedules are next due in each minute, by
+        default over the coming day."""
+        try:
+            filter_args = self._get_request_params(request)
+        except ValueError as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
+        next_run_after = filter_args.get('next_run_after',
+                                         timeutils.utcnow())
+        next_run_before = filter_args.get(
+            'next_run_before', next_run_after + datetime.timedelta(days=1))
+        load = self.db_api.schedule_next_run_histogram(next_run_after,
+                                                       next_run_before)
+        for minute in load:
+            utils.serialize_datetimes(minute)
+        return {'load': load}
+
+    def forecast(self, request):
+        """Return how many jobs of each action the schedules will create
+        in each bucket_minutes long bucket from start to end, by default
+        hourly over the coming day."""
+        try:
+            start = timeutils.utcnow().replace(second=0, microsecond=0)
+            if request.params.get('start') is not None:
+                start = timeutils.normalize_time(
+                    timeutils.parse_isotime(request.params['start']))
+            end = start + datetime.timedelta(days=1)
+            if request.params.get('end') is not None:
+                end = timeutils.normalize_time(
+                    timeutils.parse_isotime(request.params['end']))
+            bucket_minutes = int(request.params.get('bucket_minutes', 60))
+        except ValueError as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
+
+        if bucket_minutes <= 0 or end <= start:
+            msg = _('bucket_minutes must be positive and end after start')
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        minutes = (end - start).days * 24 * 60 + (end - start).seconds // 60
+        if (end - start > datetime.timedelta(days=MAX_FORECAST_DAYS) or
+                minutes // bucket_minutes >= MAX_FORECAST_BUCKETS):
+            msg = _('A forecast may cover at most %(days)d days in at most '
+                    '%(buckets)d buckets') % {'days': MAX_FORECAST_DAYS,
+                                              'buckets': MAX_FORECAST_BUCKETS}
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+
+        forecast = api_utils.forecast_jobs(
+            self.db_api.schedule_cron_counts(), start, end, bucket_minutes)
+        for bucket in forecast:
+            utils.serialize_datetimes(bucket)
+        return {'forecast': forecast}
+
     def get(self, request, schedule_id):
         try:
             schedule = self.db_api.schedule_get_by_id(schedule_id)
@@ -14,6 +14,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import webob.exc
 
 from qonos.api import api
@@ -22,6 +23,7 @@ from qonos.common import exception
 from qonos.common import utils
 import qonos.db
 from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import timeutils
 from qonos.openstack.common import wsgi
 
 
@@ -37,6 +39,7 @@ class WorkersController(object):
         params = {}
         params['limit'] = request.params.get('limit')
         params['marker'] = request.params.get('marker')
+        params['cursor'] = request.params.get('cursor')
         return params
 
     def list(self, request):
@@ -49,6 +52,8 @@ class WorkersController(object):
             workers = self.db_api.worker_get_all(params=params)
         except exception.NotFound:
             raise webob.exc.HTTPNotFound()
+        except exception.Invalid as e:
+            raise webob.exc.HTTPBadRequest(explanation=str(e))
         [utils.serialize_datetimes(worker) for worker in workers]
         return {'workers': workers}
 
@@ -76,27 +81,57 @@ class WorkersController(object):
     def get_next_job(self, request, worker_id, body):
         action = body.get('action')
         try:
-            # Check that worker exists
-            self.db_api.worker_get_by_id(worker_id)
+            # Check that worker exists, which it may only just have done
+            self.db_api.worker_get_by_id(worker_id, consistent=True)
         except exception.NotFound as e:
             msg = _('Worker %s could not be found.') % worker_id
             raise webob.exc.HTTPNotFound(explanation=msg)
 
         max_retry = self._job_get_max_retry(action)
+        # NOTE: claimed jobs are leased to the worker for the action's
+        # timeout, so they are not handed out again while it holds them
+        new_timeout = timeutils.utcnow() + datetime.timedelta(
+            seconds=self._job_get_timeout(action))
+
+        if body.get('max_jobs') is not None:
+            max_jobs = self._get_max_jobs(body)
+            jobs = self.db_api.jobs_get_and_assign_next_by_action(
+                action, worker_id, max_retry, max_jobs, new_timeout)
+            for job in jobs:
+                utils.serialize_datetimes(job)
+                api_utils.serialize_job_metadata(job)
+            return {'jobs': jobs}
 
         job = self.db_api.job_get_and_assign_next_by_action(
-            action, worker_id, max_retry)
+            action, worker_id, max_retry, new_timeout)
         if job:
             utils.serialize_datetimes(job)
             api_utils.serialize_job_metadata(job)
         return {'job': job}
 
+    def _get_max_jobs(self, body):
+        try:
+            max_jobs = int(body['max_jobs'])
+        except (TypeError, ValueError):
+            msg = _('max_jobs must be an integer')
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        if max_jobs <= 0:
+            msg = _('max_jobs must be positive')
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        return min(CONF.api_limit_max, max_jobs)
+
     def _job_get_max_retry(self, action):
         group = 'action_' + action
         if group not in CONF:
             group = 'action_default'
         return CONF.get(group).max_retry
 
+    def _job_get_timeout(self, action):
+        group = 'action_' + action
+        if group not in CONF:
+            group = 'action_default'
+        return CONF.get(group).timeout_seconds
+
 
 def create_resource():
     """QonoS resource factory method."""
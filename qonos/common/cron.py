@@ -0,0 +1,248 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Next run times of cron schedules.
+
+Each field of a cron expression is parsed once into a bitset of the values
+it allows, and compiled expressions are kept, so working out the next run
+of a schedule is a handful of bit operations rather than a parse. The
+rarely used croniter only syntax, such as 'L' or '#', is left to croniter.
+"""
+
+import calendar
+import datetime
+
+from croniter.croniter import croniter
+
+from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import timeutils
+
+# NOTE: a year of every weekday falling on every date repeats within 28
+# years, so a run not found by then is never found
+_MAX_YEARS = 28
+_MAX_EXPRESSIONS = 1024
+
+_FIELDS = (
+    # (low, high, last, names), where last ends '*' and 'N/step'
+    (0, 59, 59, {}),
+    (0, 23, 23, {}),
+    (1, 31, 31, {}),
+    (1, 12, 12, {'jan': 1, 'feb': 2, 'mar': 3, 'apr': 4, 'may': 5,
+                 'jun': 6, 'jul': 7, 'aug': 8, 'sep': 9, 'oct': 10,
+                 'nov': 11, 'dec': 12}),
+    # Sunday may also be given as 7, but only explicitly
+    (0, 7, 6, {'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5,
+               'sat': 6}),
+)
+
+_EXPRESSIONS = {}
+
+
+def _next_bit(mask, start):
+    """Return the lowest bit of mask at or above start, or None."""
+    mask >>= start
+    if not mask:
+        return None
+    return start + (mask & -mask).bit_length() - 1
+
+
+def _full_mask(low, high):
+    return ((1 << (high + 1)) - 1) & ~((1 << low) - 1)
+
+
+def _parse_value(value, names):
+    value = value.lower()
+    if value in names:
+        return names[value]
+    if not value.isdigit():
+        raise ValueError(value)
+    return int(value)
+
+
+def _parse_field(field, index):
+    low, high, default_last, names = _FIELDS[index]
+    mask = 0
+    for item in str(field).split(','):
+        step = None
+        if '/' in item:
+            item, step = item.split('/', 1)
+            step = int(step) if step.isdigit() else 0
+            if step < 1:
+                raise ValueError(field)
+        if item == '*':
+            first, last = low, default_last
+        elif '-' in item:
+            first, last = [_parse_value(value, names)
+                           for value in item.split('-', 1)]
+        else:
+            first = _parse_value(item, names)
+            # as in croniter, 'N/step' runs from N to the end of the field
+            last = first if step is None else default_last
+        if first < low or last > high or first > last:
+            raise ValueError(field)
+        for value in range(first, last + 1, step or 1):
+            mask |= 1 << value
+
+    if index == 4 and mask & (1 << 7):
+        # Sunday is both 0 and 7
+        mask = (mask | 1) & ~(1 << 7)
+    return mask
+
+
+class _Expression(object):
+    """Runs of an expression, found with the next_after of a subclass."""
+
+    def runs_between(self, start_time, end_time):
+        """Yield the minutes allowed from start_time up to, but not
+        including, end_time."""
+        try:
+            run = self.next_after(start_time -
+                                  datetime.timedelta(microseconds=1))
+            while run < end_time:
+                yield run
+                run = self.next_after(run)
+        except ValueError:
+            return
+
+
+class CronExpression(_Expression):
+    """A cron expression compiled into bitsets of the minutes, hours,
+    days of the month, months and days of the week it allows."""
+
+    def __init__(self, minute, hour, day_of_month, month, day_of_week):
+        fields = (minute, hour, day_of_month, month, day_of_week)
+        (self.minutes, self.hours, self.days, self.months,
+         self.weekdays) = [_parse_field(field, index)
+                           for index, field in enumerate(fields)]
+
+        # NOTE: as in cron, when both the day of the month and the day of
+        # the week are restricted a day matching either will do
+        self.any_day = self.days == _full_mask(1, 31)
+        self.any_weekday = self.weekdays == _full_mask(0, 6)
+
+        # the days of a month allowed by the day of the week, for each day
+        # of the week the month may start on
+        self.weekday_days = []
+        for first_weekday in range(7):
+            days = 0
+            for day in range(1, 32):
+                if self.weekdays & (1 << ((first_weekday + day - 1) % 7)):
+                    days |= 1 << day
+            self.weekday_days.append(days)
+
+    def _month_days(self, year, month):
+        first_weekday, days_in_month = calendar.monthrange(year, month)
+        # calendar counts weekdays from Monday, cron from Sunday
+        weekday_days = self.weekday_days[(first_weekday + 1) % 7]
+        if self.any_weekday:
+            days = self.days
+        elif self.any_day:
+            days = weekday_days
+        else:
+            days = self.days | weekday_days
+        return days & _full_mask(1, days_in_month)
+
+    def next_after(self, start_time):
+        """Return the first minute allowed after start_time."""
+        start_time = (start_time.replace(second=0, microsecond=0) +
+                      datetime.timedelta(minutes=1))
+        year, month, day = start_time.year, start_time.month, start_time.day
+        hour, minute = start_time.hour, start_time.minute
+        while year <= start_time.year + _MAX_YEARS:
+            next_month = _next_bit(self.months, month)
+            if next_month is None:
+                year, month, day, hour, minute = year + 1, 1, 1, 0, 0
+                continue
+            if next_month != month:
+                month, day, hour, minute = next_month, 1, 0, 0
+
+            next_day = _next_bit(self._month_days(year, month), day)
+            if next_day is None:
+                month, day, hour, minute = month + 1, 1, 0, 0
+                continue
+            if next_day != day:
+                day, hour, minute = next_day, 0, 0
+
+            next_hour = _next_bit(self.hours, hour)
+            if next_hour is None:
+                day, hour, minute = day + 1, 0, 0
+                continue
+            if next_hour != hour:
+                hour, minute = next_hour, 0
+
+            next_minute = _next_bit(self.minutes, minute)
+            if next_minute is None:
+                hour, minute = hour + 1, 0
+                continue
+            return datetime.datetime(year, month, day, hour, next_minute)
+
+        raise ValueError(_('Cron expression never matches'))
+
+
+class _CroniterExpression(_Expression):
+    """An expression using syntax only croniter understands."""
+
+    def __init__(self, minute, hour, day_of_month, month, day_of_week):
+        self.cron_string = ' '.join(str(field) for field in
+                                    (minute, hour, day_of_month, month,
+                                     day_of_week))
+
+    def next_after(self, start_time):
+        return croniter(self.cron_string, start_time).get_next(
+            datetime.datetime)
+
+
+def get_expression(minute='*', hour='*', day_of_month='*', month='*',
+                   day_of_week='*'):
+    """Return the compiled cron expression for the given fields, fields
+    of None or '' meaning '*'. A field of 0 means 0."""
+    key = tuple(str(field) if field not in (None, '') else '*'
+                for field in (minute, hour, day_of_month, month,
+                              day_of_week))
+    expression = _EXPRESSIONS.get(key)
+    if expression is None:
+        try:
+            expression = CronExpression(*key)
+        except ValueError:
+            expression = _CroniterExpression(*key)
+        if len(_EXPRESSIONS) >= _MAX_EXPRESSIONS:
+            _EXPRESSIONS.clear()
+        _EXPRESSIONS[key] = expression
+    return expression
+
+
+def next_run(minute='*', hour='*', day_of_month='*', month='*',
+             day_of_week='*', start_time=None):
+    start_time = start_time or timeutils.utcnow()
+    return get_expression(minute, hour, day_of_month, month,
+                          day_of_week).next_after(start_time)
+
+
+def next_runs(schedules, start_time=None):
+    """Return the next runs after start_time of a list of schedules, in
+    the same order. Each distinct expression is worked out only once."""
+    start_time = start_time or timeutils.utcnow()
+    runs = {}
+    result = []
+    for schedule in schedules:
+        key = (schedule.get('minute'), schedule.get('hour'),
+               schedule.get('day_of_month'), schedule.get('month'),
+               schedule.get('day_of_week'))
+        if key not in runs:
+            runs[key] = get_expression(*key).next_after(start_time)
+        result.append(runs[key])
+    return result
@@ -17,8 +17,7 @@
 import datetime
 import logging as pylog
 
-from croniter.croniter import croniter
-
+from qonos.common import cron
 from qonos.common import exception as exc
 from qonos.openstack.common import cfg
 from qonos.openstack.common.gettextutils import _
@@ -42,15 +41,8 @@ def serialize_datetimes(data):
 
 def cron_string_to_next_datetime(minute="*", hour="*", day_of_month="*",
                                  month="*", day_of_week="*", start_time=None):
-    start_time = start_time or timeutils.utcnow()
-    cron_string = ("%s %s %s %s %s" %
-                  (minute or '*',
-                   hour or '*',
-                   day_of_month or '*',
-                   month or '*',
-                   day_of_week or '*'))
-    iter = croniter(cron_string, start_time)
-    return iter.get_next(datetime.datetime)
+    return cron.next_run(minute, hour, day_of_month, month, day_of_week,
+                         start_time)
 
 
 def _validate_limit(limit):
@@ -14,6 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from eventlet import tpool
+
+from qonos.db import query_stats
 from qonos.openstack.common import cfg
 from qonos.openstack.common import importutils
 
@@ -25,11 +28,36 @@ sql_connection_opt = cfg.StrOpt('sql_connection',
                                      'string for the database. '
                                      'Default: %default')
 
+sql_use_tpool_opt = cfg.BoolOpt('sql_use_tpool',
+                                default=False,
+                                help='Run database API calls in native '
+                                     'threads from the eventlet thread '
+                                     'pool, so a slow query does not block '
+                                     'other requests served by the same '
+                                     'process')
+
 CONF = cfg.CONF
 CONF.register_opt(sql_connection_opt)
+CONF.register_opt(sql_use_tpool_opt)
+
+
+class _ThreadPoolProxy(tpool.Proxy):
+    """Runs the calls of a database API in the eventlet thread pool,
+    counting their queries for the request which made them."""
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            return tpool.execute(query_stats.bind(attr), *args, **kwargs)
+        return call
 
 
 def get_api():
     db_api = importutils.import_module(CONF.db_api)
     db_api.configure_db()
+    if CONF.sql_use_tpool:
+        return _ThreadPoolProxy(db_api)
     return db_api
@@ -14,7 +14,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import base64
+import zlib
+
 from qonos.common import exception
+from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import jsonutils
+
+
+# Jobs in these states are finished and may be archived
+FINISHED_JOB_STATUSES = ('DONE', 'ERROR', 'TIMED_OUT')
 
 
 def validate_schedule_values(values):
@@ -41,3 +50,121 @@ def _validate_values(object_name, values, keys):
 def _validate_value(values, key, missing_values):
     if not key in values:
         missing_values.append(key)
+
+
+def filter_values(value):
+    """Return the values of a filter given either one value or a list."""
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def partition_key(item_id):
+    """Return a stable hash of an id, which taken modulo a partition
+    count gives the partition the item belongs to."""
+    return zlib.crc32(unicode(item_id).encode('utf-8')) & 0x7fffffff
+
+
+def in_partitions(item_id, partitions, partition_count):
+    """Return True if an item falls in one of the given partitions."""
+    return partition_key(item_id) % partition_count in partitions
+
+
+def lease_share(partition_count, schedulers):
+    """Return how many partitions each of a number of live schedulers
+    should hold, so that between them they hold every partition."""
+    return (partition_count + schedulers - 1) // max(schedulers, 1)
+
+
+# Schedules with the same values in these share their runs and jobs
+CRON_COUNT_KEYS = ('minute', 'hour', 'day_of_month', 'month',
+                   'day_of_week', 'action')
+
+
+def minute_histogram(times):
+    """Return how many of the given times fall in each minute, as a list
+    of {'minute', 'count'} dicts in time order leaving out empty
+    minutes."""
+    counts = {}
+    for time in times:
+        start = time.replace(second=0, microsecond=0)
+        counts[start] = counts.get(start, 0) + 1
+    return [{'minute': start, 'count': count}
+            for start, count in sorted(counts.iteritems())]
+
+
+def hard_timeout_fault_values(job, job_metadata):
+    """Return the values of the fault recorded for a job deleted after
+    passing its hard timeout."""
+    metadata = dict((meta['key'], meta['value']) for meta in job_metadata)
+    return {'job_id': job['id'],
+            'action': job['action'],
+            'schedule_id': job['schedule_id'],
+            'tenant': job['tenant'],
+            'worker_id': job['worker_id'] or 'UNASSIGNED',
+            'job_metadata': str(metadata),
+            'message': 'Job exceeded its hard timeout'}
+
+
+def metadata_to_json(metadata):
+    """Return a list of metadata items as a JSON object of their keys
+    and values."""
+    return jsonutils.dumps(dict((meta['key'], meta['value'])
+                                for meta in metadata))
+
+
+def metadata_from_json(text, **extra):
+    """Return the metadata items held in JSON from metadata_to_json."""
+    return metadata_items(jsonutils.loads(text or '{}'), **extra)
+
+
+def metadata_items(metadata, **extra):
+    """Return a dict of metadata keys and values as metadata items,
+    ordered by key, each with the extra values given."""
+    items = []
+    for key in sorted(metadata):
+        item = {'key': key, 'value': metadata[key]}
+        item.update(extra)
+        items.append(item)
+    return items
+
+
+def archived_job_values(job, job_metadata):
+    """Return the values of the job_archive row for a finished job."""
+    values = dict((key, job[key]) for key in
+                  ('id', 'created_at', 'updated_at', 'schedule_id', 'tenant',
+                   'worker_id', 'status', 'action', 'retry_count'))
+    values['job_metadata'] = metadata_to_json(job_metadata)
+    return values
+
+
+def archived_job_to_dict(values):
+    """Return an archived job shaped like a job, metadata included."""
+    job = dict(values)
+    job['job_metadata'] = metadata_from_json(job['job_metadata'])
+    return job
+
+
+def encode_cursor(item, sort_keys=('id',)):
+    """Return an opaque pagination cursor pointing just past item.
+
+    The cursor carries the sort key values of item, so the next page can
+    be fetched with a single range query instead of looking up a marker.
+    """
+    values = dict((key, item[key]) for key in sort_keys)
+    return base64.urlsafe_b64encode(jsonutils.dumps(values)).rstrip('=')
+
+
+def decode_cursor(cursor, sort_keys=('id',)):
+    """Return the sort key values held in a cursor from encode_cursor."""
+    try:
+        cursor = str(cursor)
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = jsonutils.loads(base64.urlsafe_b64decode(padded))
+    except (TypeError, ValueError, UnicodeError):
+        values = None
+
+    if not isinstance(values, dict) or set(values) != set(sort_keys):
+        msg = _('Invalid pagination cursor %s') % cursor
+        raise exception.Invalid(message=msg)
+    return values
@@ -0,0 +1,143 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Counts and times the database queries run on behalf of each API request.
+
+The database backend calls record() for every statement it runs. Queries
+are only counted while a collector is started for the current green
+thread, as the query stats middleware does around each request. Calls
+run in native threads, as with sql_use_tpool, are counted for the green
+thread which made them if wrapped with bind(). Totals for each route are
+kept in ROUTES.
+"""
+
+import functools
+import threading
+
+from eventlet import corolocal
+
+_LOCAL = corolocal.local()
+# The collector of the green thread a native thread is running a call for
+_THREAD_LOCAL = threading.local()
+
+# Route name to the RouteStats of the requests served by that route
+ROUTES = {}
+
+
+class QueryStats(object):
+    """The queries run on behalf of one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.total_time += duration
+        if self.slowest_statement is None or duration > self.slowest_time:
+            self.slowest_time = duration
+            self.slowest_statement = statement
+
+
+class RouteStats(object):
+    """The queries run by all requests served by one route."""
+
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.max_queries = 0
+        self.total_time = 0.0
+        self.slowest_time = 0.0
+        self.slowest_statement = None
+
+    def add(self, stats):
+        self.requests += 1
+        self.queries += stats.count
+        self.max_queries = max(self.max_queries, stats.count)
+        self.total_time += stats.total_time
+        if (stats.slowest_statement is not None and
+                stats.slowest_time >= self.slowest_time):
+            self.slowest_time = stats.slowest_time
+            self.slowest_statement = stats.slowest_statement
+
+    def to_dict(self):
+        return {'requests': self.requests,
+                'queries': self.queries,
+                'max_queries': self.max_queries,
+                'total_time': self.total_time,
+                'slowest_time': self.slowest_time,
+                'slowest_statement': self.slowest_statement}
+
+
+def start():
+    """Start counting the queries of the current green thread."""
+    _LOCAL.stats = QueryStats()
+    return _LOCAL.stats
+
+
+def stop():
+    """Stop counting and return what was counted since start()."""
+    stats = getattr(_LOCAL, 'stats', None)
+    _LOCAL.stats = None
+    return stats
+
+
+def _current():
+    if getattr(_THREAD_LOCAL, 'bound', False):
+        return _THREAD_LOCAL.stats
+    return getattr(_LOCAL, 'stats', None)
+
+
+def record(statement, duration):
+    """Count a query which took duration seconds, if counting."""
+    stats = _current()
+    if stats is not None:
+        stats.record(statement, duration)
+
+
+def bind(func):
+    """Return func made to count its queries for the collector of the
+    current green thread, whichever thread it is then run in."""
+    stats = getattr(_LOCAL, 'stats', None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        _THREAD_LOCAL.bound = True
+        _THREAD_LOCAL.stats = stats
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _THREAD_LOCAL.bound = False
+            _THREAD_LOCAL.stats = None
+    return wrapper
+
+
+def add_route(route, stats):
+    """Add the queries of one request to the totals of its route."""
+    ROUTES.setdefault(route, RouteStats()).add(stats)
+
+
+def routes_snapshot():
+    """Return a dict of route name to the totals of that route."""
+    return dict((route, stats.to_dict())
+                for route, stats in ROUTES.iteritems())
+
+
+def reset():
+    ROUTES.clear()
@@ -14,18 +14,43 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import copy
+import bisect
 import datetime
-import operator
+import functools
+import heapq
+import threading
 import uuid
 
 from operator import itemgetter
+from qonos.common import cron
 from qonos.common import exception
 import qonos.db.db_utils as db_utils
+from qonos.db.simple import journal
+from qonos.openstack.common import cfg
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import timeutils
 
 
+simple_db_opts = [
+    cfg.StrOpt('simple_db_journal', default=None,
+               help=_('File the simple DB backend journals its changes '
+                      'to, so they survive a restart. Only one process may '
+                      'use it. If unset the data is only kept in memory')),
+    cfg.FloatOpt('simple_db_sync_interval', default=0.0,
+                 help=_('Seconds changes may wait in the journal before '
+                        'they are synced to disk, so that changes made '
+                        'close together share one fsync. 0 syncs each '
+                        'change before returning')),
+    cfg.IntOpt('simple_db_compact_records', default=10000,
+               help=_('Number of changes after which the journal is '
+                      'compacted into a snapshot of all the data. 0 '
+                      'never compacts')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(simple_db_opts)
+
+
 DATA = {
     'schedules': {},
     'schedule_metadata': {},
@@ -33,17 +58,105 @@ DATA = {
     'job_metadata': {},
     'workers': {},
     'job_faults': {},
+    'job_archive': {},
+    'schedulers': {},
+    # NOTE: keyed by partition number, as a string to survive JSON
+    'scheduler_leases': {},
 }
 
+# Indexes over DATA, kept up to date by every write:
+#   schedule_ids: sorted schedule ids, for pagination
+#   next_run: sorted (next_run, id) pairs of schedules with a next_run
+#   next_run_keys: the next_run of each pair in next_run, for bisecting
+#   updated_at, updated_at_keys: the same for the updated_at of schedules
+#   tenants: tenant to the set of its schedule ids
+#   instance_ids: instance_id metadata value to the set of schedule ids
+#   indexed: schedule id to the (tenant, next_run, updated_at,
+#            instance_id) it is indexed under
+#   ready_jobs: action to a heap of (created_at, id) of its unassigned jobs
+#   leased_jobs: action to a heap of (timeout, id) of its assigned jobs
+#   exhausted_jobs: action to a heap of (retry_count, created_at, id) of
+#                   its jobs passed over for having no retries left
+#   queued_jobs: job id to the (action, heap, entry) of its one current
+#                entry in the job heaps. Other entries for the job are
+#                stale and are dropped when they reach the top of a heap.
+#   job_runs: (schedule_id, scheduled_run) of each job created for a
+#             scheduled run to the job's id, so it is only created once
+#   job_fault_ids: sorted job fault ids, for pagination
+#   job_faults_by: each of JOB_FAULT_FILTERS to a map of its values to the
+#                  sorted ids of the faults with that value
+#   job_fault_times: job id to the sorted (created_at, id) of its faults
+INDEXES = {
+    'schedule_ids': [],
+    'next_run': [],
+    'next_run_keys': [],
+    'updated_at': [],
+    'updated_at_keys': [],
+    'tenants': {},
+    'instance_ids': {},
+    'indexed': {},
+    'ready_jobs': {},
+    'leased_jobs': {},
+    'exhausted_jobs': {},
+    'queued_jobs': {},
+    'job_runs': {},
+    'job_fault_ids': [],
+    'job_faults_by': {},
+    'job_fault_times': {},
+}
 
-def configure_db():
-    pass
+# Fields job faults may be listed by
+JOB_FAULT_FILTERS = ('job_id', 'schedule_id', 'tenant', 'action')
 
+_JOURNAL = None
+# Held by every call, as API requests served by green threads or by
+# native threads (see sql_use_tpool) may call in at the same time
+_LOCK = threading.RLock()
+# The (table, key) entries of DATA changed by the write call in progress,
+# and how deeply write calls are nested
+_PENDING = {'changes': set(), 'depth': 0}
+
+
+def _touch(table, key):
+    """Note that DATA[table][key] was changed, so it is journaled."""
+    if _JOURNAL is not None:
+        _PENDING['changes'].add((table, key))
+
+
+def _synchronized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _LOCK:
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _journaled(func):
+    """Journal the entries of DATA a write call changed once it, and
+    any write calls it makes, return."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _LOCK:
+            _PENDING['depth'] += 1
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _PENDING['depth'] -= 1
+                if _PENDING['depth'] == 0:
+                    _journal_commit()
+    return wrapper
 
-def reset():
-    global DATA
-    for k in DATA:
-        DATA[k] = {}
+
+def _journal_commit():
+    changes = _PENDING['changes']
+    _PENDING['changes'] = set()
+    if _JOURNAL is None or not changes:
+        return
+
+    _JOURNAL.commit([(table, key, DATA[table].get(key))
+                     for table, key in sorted(changes)])
+    if _JOURNAL.should_compact():
+        _JOURNAL.compact(DATA)
 
 
 def _gen_base_attributes(item_id=None):
@@ -52,100 +165,327 @@ def _gen_base_attributes(item_id=None):
         values['id'] = str(uuid.uuid4())
     values['created_at'] = timeutils.utcnow()
     values['updated_at'] = timeutils.utcnow()
-    return copy.deepcopy(values)
+    return values
+
+
+# NOTE: read calls take a 'consistent' argument for parity with the
+# SQLAlchemy backend's replica routing; there is only one copy of the data
+# here, so every read is consistent.
+
+
+@_synchronized
+def configure_db():
+    global _JOURNAL
+    if _JOURNAL is not None or not CONF.simple_db_journal:
+        return
+
+    _journal = journal.Journal(CONF.simple_db_journal,
+                               sync_interval=CONF.simple_db_sync_interval,
+                               compact_records=CONF.simple_db_compact_records)
+    data = _journal.load()
+    for k in DATA:
+        DATA[k] = data.get(k, {})
+    _reset_indexes()
+    for schedule_id in DATA['schedules']:
+        _index_schedule(schedule_id)
+    for job_id in DATA['jobs']:
+        _queue_job(job_id)
+        _index_job_run(job_id)
+    for job_fault_id in DATA['job_faults']:
+        _index_job_fault(job_fault_id)
+    _JOURNAL = _journal
+
+
+@_synchronized
+def reset():
+    global DATA
+    for k in DATA:
+        DATA[k] = {}
+    _reset_indexes()
+    if _JOURNAL is not None:
+        _JOURNAL.compact(DATA)
+
+
+def _reset_indexes():
+    for k in INDEXES:
+        INDEXES[k] = type(INDEXES[k])()
+
+
+def _datetime_key(value):
+    """Return value as a datetime to order by, parsing it if it is a
+    time string."""
+    if isinstance(value, basestring):
+        return timeutils.normalize_time(timeutils.parse_isotime(value))
+    return value
+
+
+def _sorted_list_remove(items, item):
+    i = bisect.bisect_left(items, item)
+    if i < len(items) and items[i] == item:
+        del items[i]
+        return i
+    return None
+
+
+def _ordered_index_add(index, key, item_id):
+    if key is None:
+        return
+    i = bisect.bisect_left(INDEXES[index], (key, item_id))
+    INDEXES[index].insert(i, (key, item_id))
+    INDEXES[index + '_keys'].insert(i, key)
+
+
+def _ordered_index_remove(index, key, item_id):
+    if key is None:
+        return
+    i = _sorted_list_remove(INDEXES[index], (key, item_id))
+    del INDEXES[index + '_keys'][i]
+
+
+def _ordered_index_range(index, after=None, before=None):
+    """Ids of the items with after <= key <= before, in key order."""
+    keys = INDEXES[index + '_keys']
+    start = 0 if after is None else bisect.bisect_left(keys, after)
+    end = len(keys) if before is None else bisect.bisect_right(keys, before)
+    return [item_id for _, item_id in INDEXES[index][start:end]]
+
+
+def _unindex_schedule(schedule_id):
+    keys = INDEXES['indexed'].pop(schedule_id, None)
+    if keys is None:
+        return
+    tenant, next_run, updated_at, instance_id = keys
+
+    _sorted_list_remove(INDEXES['schedule_ids'], schedule_id)
+    _ordered_index_remove('next_run', next_run, schedule_id)
+    _ordered_index_remove('updated_at', updated_at, schedule_id)
+    for index, key in (('tenants', tenant), ('instance_ids', instance_id)):
+        ids = INDEXES[index].get(key)
+        if ids is not None:
+            ids.discard(schedule_id)
+            if not ids:
+                del INDEXES[index][key]
+
+
+def _index_schedule(schedule_id):
+    """Bring the indexes in line with the stored schedule and its
+    metadata."""
+    _unindex_schedule(schedule_id)
+    schedule = DATA['schedules'][schedule_id]
+    tenant = schedule.get('tenant')
+    next_run = _datetime_key(schedule.get('next_run'))
+    updated_at = _datetime_key(schedule.get('updated_at'))
+    instance_meta = DATA['schedule_metadata'].get(schedule_id, {}).get(
+        'instance_id')
+    instance_id = instance_meta['value'] if instance_meta else None
+
+    bisect.insort(INDEXES['schedule_ids'], schedule_id)
+    _ordered_index_add('next_run', next_run, schedule_id)
+    _ordered_index_add('updated_at', updated_at, schedule_id)
+    INDEXES['tenants'].setdefault(tenant, set()).add(schedule_id)
+    if instance_id is not None:
+        INDEXES['instance_ids'].setdefault(instance_id, set()).add(
+            schedule_id)
+    INDEXES['indexed'][schedule_id] = (tenant, next_run, updated_at,
+                                       instance_id)
+
+
+def _schedule_snapshot(schedule_id):
+    """Copy a stored schedule and its metadata for returning.
+
+    Every stored value is immutable, so shallow copies keep callers
+    from changing the store.
+    """
+    schedule = dict(DATA['schedules'][schedule_id])
+    schedule['schedule_metadata'] = [
+        dict(meta)
+        for meta in DATA['schedule_metadata'].get(schedule_id, {}).values()]
+    return schedule
 
 
 def _schedule_create(values):
     global DATA
     DATA['schedules'][values['id']] = values
     _schedule_meta_init(values['id'])
-    return copy.deepcopy(values)
+    _touch('schedules', values['id'])
+    _touch('schedule_metadata', values['id'])
+    _index_schedule(values['id'])
+    return dict(values)
+
+
+def _push_job(job_id, action, heap, entry):
+    INDEXES['queued_jobs'][job_id] = (action, heap, entry)
+    heapq.heappush(INDEXES[heap].setdefault(action, []), entry)
+
+
+def _queue_job(job_id):
+    """Queue a job by its current state, making any entries it already
+    has in the job heaps stale."""
+    job = DATA['jobs'][job_id]
+    if job.get('worker_id') is None:
+        _push_job(job_id, job['action'], 'ready_jobs',
+                  (_datetime_key(job['created_at']), job_id))
+    elif job.get('timeout') is not None:
+        _push_job(job_id, job['action'], 'leased_jobs',
+                  (_datetime_key(job['timeout']), job_id))
+    else:
+        # NOTE: an assigned job without a timeout is never claimed again
+        INDEXES['queued_jobs'].pop(job_id, None)
+
+
+def _job_run_key(job):
+    if job.get('schedule_id') is None or job.get('scheduled_run') is None:
+        return None
+    return (job['schedule_id'], _datetime_key(job['scheduled_run']))
+
+
+def _index_job_run(job_id):
+    key = _job_run_key(DATA['jobs'][job_id])
+    if key is not None:
+        INDEXES['job_runs'][key] = job_id
+
+
+def _pop_queued_job(action, heap):
+    """Pop the top entry of a job heap, or None if it is stale."""
+    entry = heapq.heappop(INDEXES[heap][action])
+    job_id = entry[-1]
+    if INDEXES['queued_jobs'].get(job_id) != (action, heap, entry):
+        return None
+    del INDEXES['queued_jobs'][job_id]
+    return DATA['jobs'][job_id]
 
 
-def _do_pagination(items, marker, limit):
+def _jobs_claim_next(action, max_retry, max_jobs, now):
+    """Pop the oldest max_jobs claimable jobs for action off its queues.
+
+    A job is claimable when it has retries left, its hard timeout has not
+    passed, and it is unassigned or its timeout has passed.
     """
-    This method mimics the behavior of sqlalchemy paginate_query.
-    It takes items and pagination parameters - 'limit' and 'marker'
-    to filter out the items to be returned. Items are sorted in
-    lexicographical order based on the sort key - 'id'.
+    ready = INDEXES['ready_jobs'].setdefault(action, [])
+    leased = INDEXES['leased_jobs'].setdefault(action, [])
+    exhausted = INDEXES['exhausted_jobs'].setdefault(action, [])
+
+    while leased and leased[0][0] <= now:
+        job = _pop_queued_job(action, 'leased_jobs')
+        if job is not None:
+            _push_job(job['id'], action, 'ready_jobs',
+                      (_datetime_key(job['created_at']), job['id']))
+
+    while exhausted and exhausted[0][0] < max_retry:
+        job = _pop_queued_job(action, 'exhausted_jobs')
+        if job is not None:
+            _push_job(job['id'], action, 'ready_jobs',
+                      (_datetime_key(job['created_at']), job['id']))
+
+    jobs = []
+    while ready and len(jobs) < max_jobs:
+        job = _pop_queued_job(action, 'ready_jobs')
+        if job is None:
+            continue
+        if _datetime_key(job['hard_timeout']) <= now:
+            # NOTE: left out of the queues until an update requeues it
+            continue
+        if job['retry_count'] >= max_retry:
+            _push_job(job['id'], action, 'exhausted_jobs',
+                      (job['retry_count'], _datetime_key(job['created_at']),
+                       job['id']))
+            continue
+        jobs.append(job)
+    return jobs
+
+
+def _paginate_ids(ids, marker, limit, cursor=None):
+    """
+    Return the page of the sorted list ids after the 'marker' id (or
+    the id in 'cursor'), holding at most 'limit' ids.
     """
-    items = sorted(items, key=itemgetter('id'))
-    start = 0
-    end = -1
-    if marker is None:
+    if cursor is not None:
+        marker_id = db_utils.decode_cursor(cursor)['id']
+        start = bisect.bisect_right(ids, marker_id)
+    elif marker is None:
         start = 0
     else:
-        for i, item in enumerate(items):
-            if item['id'] == marker:
-                start = i + 1
-                break
-        else:
+        start = bisect.bisect_left(ids, marker)
+        if start == len(ids) or ids[start] != marker:
             msg = _('Marker %s not found') % marker
             raise exception.NotFound(explanation=msg)
+        start += 1
 
     end = start + limit if limit is not None else None
-    return items[start:end]
+    return ids[start:end]
 
 
-def schedule_get_all(filter_args={}):
-    schedules = copy.deepcopy(DATA['schedules'].values())
-    schedules_mutate = copy.deepcopy(DATA['schedules'].values())
+def _do_pagination(items, marker, limit, cursor=None):
+    """
+    This method mimics the behavior of sqlalchemy paginate_query.
+    It takes items and pagination parameters - 'limit' and 'marker'
+    (or 'cursor') to filter out the items to be returned. Items are
+    sorted in lexicographical order based on the sort key - 'id'.
+    """
+    items_by_id = dict((item['id'], item) for item in items)
+    ids = _paginate_ids(sorted(items_by_id), marker, limit, cursor)
+    return [items_by_id[item_id] for item_id in ids]
+
 
-    for schedule in schedules:
-        schedule['schedule_metadata'] =\
-            copy.deepcopy(schedule_meta_get_all(schedule['id']))
+@_synchronized
+def schedule_get_all(filter_args={}, consistent=False):
+    candidates = None
 
-    schedules_mutate = copy.deepcopy(schedules)
+    def _narrow(ids):
+        if candidates is None:
+            return set(ids)
+        return candidates.intersection(ids)
 
-    if 'next_run_before' in filter_args:
-        for schedule in schedules:
-            if not schedule['next_run'] <= filter_args['next_run_before']:
-                if schedule in schedules_mutate:
-                    del schedules_mutate[schedules_mutate.index(schedule)]
+    if ('next_run_before' in filter_args or
+            'next_run_after' in filter_args):
+        candidates = _narrow(_ordered_index_range(
+            'next_run', filter_args.get('next_run_after'),
+            filter_args.get('next_run_before')))
 
-    if 'next_run_after' in filter_args:
-        for schedule in schedules:
-            if not schedule['next_run'] >= filter_args['next_run_after']:
-                if schedule in schedules_mutate:
-                    del schedules_mutate[schedules_mutate.index(schedule)]
+    if filter_args.get('changed_since') is not None:
+        candidates = _narrow(_ordered_index_range(
+            'updated_at', filter_args['changed_since']))
 
     if filter_args.get('tenant') is not None:
-        for schedule in schedules:
-            if schedule['tenant'] != filter_args['tenant']:
-                if schedule in schedules_mutate:
-                    del schedules_mutate[schedules_mutate.index(schedule)]
+        candidates = _narrow(
+            INDEXES['tenants'].get(filter_args['tenant'], ()))
 
     if filter_args.get('instance_id') is not None:
-        instance_id = filter_args['instance_id']
-        for schedule in schedules:
-            if schedule['schedule_metadata']:
-                for schedule_metadata in schedule['schedule_metadata']:
-                    if not(schedule_metadata['key'] == 'instance_id' and
-                           schedule_metadata['value'] == instance_id):
-                        del schedules_mutate[schedules_mutate.index(schedule)]
-                        break
-            else:
-                if schedule in schedules_mutate:
-                    del schedules_mutate[schedules_mutate.index(schedule)]
+        instance_ids = set()
+        for instance_id in db_utils.filter_values(filter_args['instance_id']):
+            instance_ids.update(INDEXES['instance_ids'].get(instance_id, ()))
+        candidates = _narrow(instance_ids)
+
+    if filter_args.get('partitions') is not None:
+        partitions = set(filter_args['partitions'])
+        ids = INDEXES['schedule_ids'] if candidates is None else candidates
+        candidates = _narrow(
+            [schedule_id for schedule_id in ids
+             if db_utils.in_partitions(schedule_id, partitions,
+                                       filter_args['partition_count'])])
+
+    if candidates is None:
+        ids = INDEXES['schedule_ids']
+    else:
+        ids = sorted(candidates)
 
     marker = filter_args.get('marker')
     limit = filter_args.get('limit')
-    schedules_mutate = _do_pagination(schedules_mutate, marker, limit)
-    return schedules_mutate
+    ids = _paginate_ids(ids, marker, limit, filter_args.get('cursor'))
+    return [_schedule_snapshot(schedule_id) for schedule_id in ids]
 
 
-def schedule_get_by_id(schedule_id):
+@_synchronized
+def schedule_get_by_id(schedule_id, consistent=False):
     if schedule_id not in DATA['schedules']:
         raise exception.NotFound()
-    schedule = copy.deepcopy(DATA['schedules'][schedule_id])
-    schedule['schedule_metadata'] = \
-        copy.deepcopy(schedule_meta_get_all(schedule_id))
-    return schedule
+    return _schedule_snapshot(schedule_id)
 
 
+@_journaled
 def schedule_create(schedule_values):
     db_utils.validate_schedule_values(schedule_values)
-    values = copy.deepcopy(schedule_values)
+    values = schedule_values.copy()
     schedule = {}
 
     metadata = []
@@ -164,6 +504,7 @@ def schedule_create(schedule_values):
     return schedule_get_by_id(schedule['id'])
 
 
+@_journaled
 def schedule_update(schedule_id, schedule_values):
     global DATA
     values = schedule_values.copy()
@@ -180,20 +521,54 @@ def schedule_update(schedule_id, schedule_values):
         schedule = DATA['schedules'][schedule_id]
         schedule['updated_at'] = timeutils.utcnow()
         schedule.update(values)
+        _index_schedule(schedule_id)
+        _touch('schedules', schedule_id)
 
     if metadata is not None:
         DATA['schedule_metadata'][schedule_id] = {}
+        _index_schedule(schedule_id)
+        _touch('schedule_metadata', schedule_id)
         for metadatum in metadata:
             schedule_meta_create(schedule_id, metadatum)
 
     return schedule_get_by_id(schedule_id)
 
 
+@_synchronized
+def schedule_next_run_histogram(next_run_after, next_run_before,
+                                consistent=False):
+    """Return how many schedules are next due in each minute from
+    next_run_after to next_run_before."""
+    return db_utils.minute_histogram(
+        DATA['schedules'][schedule_id]['next_run']
+        for schedule_id in _ordered_index_range(
+            'next_run', after=next_run_after, before=next_run_before))
+
+
+@_synchronized
+def schedule_cron_counts(consistent=False):
+    """Return how many schedules there are of each action and cron
+    pattern, as dicts of db_utils.CRON_COUNT_KEYS and 'count'."""
+    counts = {}
+    for schedule in DATA['schedules'].itervalues():
+        key = tuple(schedule.get(name) for name in db_utils.CRON_COUNT_KEYS)
+        counts[key] = counts.get(key, 0) + 1
+    result = []
+    for key, count in counts.iteritems():
+        cron_count = dict(zip(db_utils.CRON_COUNT_KEYS, key))
+        cron_count['count'] = count
+        result.append(cron_count)
+    return result
+
+
+@_journaled
 def schedule_delete(schedule_id):
     global DATA
     if schedule_id not in DATA['schedules']:
         raise exception.NotFound()
+    _unindex_schedule(schedule_id)
     del DATA['schedules'][schedule_id]
+    _touch('schedules', schedule_id)
 
 
 def _schedule_meta_init(schedule_id):
@@ -201,6 +576,7 @@ def _schedule_meta_init(schedule_id):
         DATA['schedule_metadata'][schedule_id] = {}
 
 
+@_journaled
 def schedule_meta_create(schedule_id, values):
     global DATA
     if DATA['schedules'].get(schedule_id) is None:
@@ -221,7 +597,10 @@ def schedule_meta_create(schedule_id, values):
     meta.update(values)
     meta.update(_gen_base_attributes())
     DATA['schedule_metadata'][schedule_id][values['key']] = meta
-    return copy.deepcopy(meta)
+    _touch('schedule_metadata', schedule_id)
+    if values['key'] == 'instance_id':
+        _index_schedule(schedule_id)
+    return dict(meta)
 
 
 def _check_schedule_exists(schedule_id):
@@ -241,13 +620,16 @@ def _check_meta_exists(schedule_id, key):
         raise exception.NotFound(message=msg)
 
 
-def schedule_meta_get_all(schedule_id):
+@_synchronized
+def schedule_meta_get_all(schedule_id, consistent=False):
     _check_schedule_exists(schedule_id)
     _schedule_meta_init(schedule_id)
 
-    return DATA['schedule_metadata'][schedule_id].values()
+    return [dict(meta)
+            for meta in DATA['schedule_metadata'][schedule_id].values()]
 
 
+@_journaled
 def schedule_metadata_update(schedule_id, values):
     global DATA
     if DATA['schedules'].get(schedule_id) is None:
@@ -255,35 +637,44 @@ def schedule_metadata_update(schedule_id, values):
         raise exception.NotFound(message=msg)
 
     DATA['schedule_metadata'][schedule_id] = {}
+    _index_schedule(schedule_id)
+    _touch('schedule_metadata', schedule_id)
     for metadatum in values:
         schedule_meta_create(schedule_id, metadatum)
 
-    return copy.deepcopy(DATA['schedule_metadata'][schedule_id].values())
+    return schedule_meta_get_all(schedule_id)
 
 
 def _delete_schedule_meta(schedule_id, key):
     del DATA['schedule_metadata'][schedule_id][key]
+    _touch('schedule_metadata', schedule_id)
+    if key == 'instance_id':
+        _index_schedule(schedule_id)
 
 
+@_journaled
 def schedule_meta_delete(schedule_id, key):
     _check_meta_exists(schedule_id, key)
     _delete_schedule_meta(schedule_id, key)
 
 
-def worker_get_all(params={}):
-    workers = copy.deepcopy(DATA['workers'].values())
+@_synchronized
+def worker_get_all(params={}, consistent=False):
     marker = params.get('marker')
     limit = params.get('limit')
-    workers = _do_pagination(workers, marker, limit)
-    return workers
+    ids = _paginate_ids(sorted(DATA['workers']), marker, limit,
+                        params.get('cursor'))
+    return [dict(DATA['workers'][worker_id]) for worker_id in ids]
 
 
-def worker_get_by_id(worker_id):
+@_synchronized
+def worker_get_by_id(worker_id, consistent=False):
     if worker_id not in DATA['workers']:
         raise exception.NotFound()
-    return copy.deepcopy(DATA['workers'][worker_id])
+    return dict(DATA['workers'][worker_id])
 
 
+@_journaled
 def worker_create(values):
     global DATA
     worker = {}
@@ -291,22 +682,104 @@ def worker_create(values):
     item_id = values.get('id')
     worker.update(_gen_base_attributes(item_id=item_id))
     DATA['workers'][worker['id']] = worker
-    return copy.deepcopy(worker)
+    _touch('workers', worker['id'])
+    return dict(worker)
 
 
+@_journaled
 def worker_delete(worker_id):
     global DATA
     if worker_id not in DATA['workers']:
         raise exception.NotFound()
     del DATA['workers'][worker_id]
+    _touch('workers', worker_id)
+
+
+@_journaled
+def scheduler_lease_partitions(scheduler_id, partition_count, ttl,
+                               host=None):
+    """Renew the scheduler's lease on its share of partition_count
+    partitions for ttl seconds and return the partitions it holds.
 
+    Each live scheduler's share is an equal split of the partitions.
+    A scheduler holding more than its share gives up the rest, and one
+    holding less takes partitions nobody holds, including those whose
+    scheduler stopped renewing them.
+    """
+    now = timeutils.utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    scheduler = DATA['schedulers'].get(scheduler_id)
+    if scheduler is None:
+        scheduler = {'id': scheduler_id}
+        scheduler.update(_gen_base_attributes(item_id=scheduler_id))
+        DATA['schedulers'][scheduler_id] = scheduler
+    scheduler.update({'host': host, 'expires_at': expires_at,
+                      'updated_at': now})
+    _touch('schedulers', scheduler_id)
+    for other_id, other in DATA['schedulers'].items():
+        if other['expires_at'] <= now:
+            del DATA['schedulers'][other_id]
+            _touch('schedulers', other_id)
+    share = db_utils.lease_share(partition_count, len(DATA['schedulers']))
+
+    leases = DATA['scheduler_leases']
+    mine = sorted(lease['partition_number'] for lease in leases.values()
+                  if lease['scheduler_id'] == scheduler_id and
+                  lease['expires_at'] > now)
+    held = [partition for partition in mine
+            if partition < partition_count][:share]
+    for partition in mine:
+        key = str(partition)
+        if partition not in held:
+            del leases[key]
+        else:
+            leases[key].update({'expires_at': expires_at, 'updated_at': now})
+        _touch('scheduler_leases', key)
 
+    for partition in range(partition_count):
+        if len(held) >= share:
+            break
+        key = str(partition)
+        lease = leases.get(key)
+        if lease is not None and lease['expires_at'] > now:
+            continue
+        if lease is None:
+            lease = _gen_base_attributes()
+            lease['partition_number'] = partition
+            leases[key] = lease
+        lease.update({'scheduler_id': scheduler_id,
+                      'expires_at': expires_at, 'updated_at': now})
+        _touch('scheduler_leases', key)
+        held.append(partition)
+
+    return sorted(held)
+
+
+@_journaled
+def scheduler_lease_release(scheduler_id):
+    """Give up every partition the scheduler holds."""
+    leases = DATA['scheduler_leases']
+    for key, lease in leases.items():
+        if lease['scheduler_id'] == scheduler_id:
+            del leases[key]
+            _touch('scheduler_leases', key)
+    if DATA['schedulers'].pop(scheduler_id, None) is not None:
+        _touch('schedulers', scheduler_id)
+
+
+@_journaled
 def job_create(job_values):
+    """Create a job, or if a job was already created for the same
+    schedule_id and scheduled_run, return that job instead."""
     global DATA
     db_utils.validate_job_values(job_values)
     values = job_values.copy()
     job = {}
 
+    run_key = _job_run_key(values)
+    if run_key in INDEXES['job_runs']:
+        return job_get_by_id(INDEXES['job_runs'][run_key])
+
     metadata = []
     if 'job_metadata' in values:
         metadata = values['job_metadata']
@@ -315,12 +788,16 @@ def job_create(job_values):
     if not 'retry_count' in values:
         values['retry_count'] = 0
     job['worker_id'] = None
+    job['scheduled_run'] = None
 
     job.update(values)
     item_id = values.get('id')
     job.update(_gen_base_attributes(item_id=item_id))
 
     DATA['jobs'][job['id']] = job
+    _queue_job(job['id'])
+    _index_job_run(job['id'])
+    _touch('jobs', job['id'])
 
     for metadatum in metadata:
         job_meta_create(job['id'], metadatum)
@@ -328,25 +805,21 @@ def job_create(job_values):
     return job_get_by_id(job['id'])
 
 
-def job_get_all(params={}):
-    jobs = copy.deepcopy(DATA['jobs'].values())
-
-    for job in jobs:
-        job['job_metadata'] =\
-            job_meta_get_all_by_job_id(job['id'])
-
+@_synchronized
+def job_get_all(params={}, consistent=False):
     marker = params.get('marker')
     limit = params.get('limit')
-    jobs = _do_pagination(jobs, marker, limit)
-
-    return jobs
+    ids = _paginate_ids(sorted(DATA['jobs']), marker, limit,
+                        params.get('cursor'))
+    return [job_get_by_id(job_id) for job_id in ids]
 
 
-def job_get_by_id(job_id):
+@_synchronized
+def job_get_by_id(job_id, consistent=False):
     if job_id not in DATA['jobs']:
         raise exception.NotFound()
 
-    job = copy.deepcopy(DATA['jobs'][job_id])
+    job = dict(DATA['jobs'][job_id])
 
     job['job_metadata'] = \
         job_meta_get_all_by_job_id(job_id)
@@ -354,65 +827,118 @@ def job_get_by_id(job_id):
     return job
 
 
+@_synchronized
 def job_updated_at_get_by_id(job_id):
     job = job_get_by_id(job_id)
     return job['updated_at']
 
 
-def job_get_and_assign_next_by_action(action, worker_id, max_retry):
+@_journaled
+def job_get_and_assign_next_by_action(action, worker_id, max_retry,
+                                      new_timeout=None):
     """Get the next available job for the given action and assign it
     to the worker for worker_id.
     This must be an atomic action!"""
-    job_ref = None
-    now = timeutils.utcnow()
-    jobs = _jobs_get_sorted()
-    for job in jobs:
-        if job['action'] == action and \
-                job['retry_count'] < max_retry and \
-                job['hard_timeout'] > now and \
-                (job['worker_id'] is None or job['timeout'] <= now):
-            job_ref = job
-            break
+    jobs = jobs_get_and_assign_next_by_action(action, worker_id,
+                                              max_retry, 1, new_timeout)
+    return jobs[0] if jobs else None
 
-    if job_ref is None:
-        return None
 
-    job_id = job_ref['id']
-    DATA['jobs'][job_id]['worker_id'] = worker_id
-    DATA['jobs'][job_id]['retry_count'] = job_ref['retry_count'] + 1
-    job = copy.deepcopy(DATA['jobs'][job_id])
-    job['job_metadata'] = job_meta_get_all_by_job_id(job_id)
-
-    return job
+@_journaled
+def jobs_get_and_assign_next_by_action(action, worker_id, max_retry,
+                                       max_jobs, new_timeout=None):
+    """Get up to max_jobs available jobs for the given action and assign
+    them to the worker for worker_id, oldest first.
 
+    If new_timeout is given the jobs are leased to the worker until then,
+    so no other worker claims them in the meantime.
+    This must be an atomic action!"""
+    now = timeutils.utcnow()
+    jobs = []
+    for job in _jobs_claim_next(action, max_retry, max_jobs, now):
+        job['worker_id'] = worker_id
+        job['retry_count'] += 1
+        if new_timeout is not None:
+            job['timeout'] = new_timeout
+        _queue_job(job['id'])
+        _touch('jobs', job['id'])
+        jobs.append(job_get_by_id(job['id']))
 
-def _jobs_get_sorted():
-    jobs = copy.deepcopy(DATA['jobs'])
-    sorted_jobs = []
-    for job_id in jobs:
-        sorted_jobs.append(jobs[job_id])
+    return jobs
 
-    sorted_jobs = sorted(sorted_jobs, key=operator.itemgetter('created_at'))
-    return sorted_jobs
 
+@_journaled
+def jobs_create_for_due_schedules(next_run_before, default_timeout,
+                                  action_timeouts={}, partitions=None,
+                                  partition_count=None):
+    """Queue a job for every schedule due to run by next_run_before and
+    move each of those schedules on to its next run.
 
-def _jobs_cleanup_hard_timed_out():
-    """Find all jobs with hard_timeout values which have passed
-    and delete them, logging the timeout / failure as appropriate"""
+    Job timeouts are given in seconds per action, falling back to
+    default_timeout. If partitions are given, only schedules in those of
+    partition_count partitions are queued. Returns the ids of the created
+    jobs.
+    """
     now = timeutils.utcnow()
-    del_ids = []
-    for job_id in DATA['jobs']:
-        job = DATA['jobs'][job_id]
-        print now, job['hard_timeout']
-        print now - job['hard_timeout']
-        if (now - job['hard_timeout']) > datetime.timedelta(microseconds=0):
-            del_ids.append(job_id)
+    schedules = [DATA['schedules'][schedule_id]
+                 for schedule_id in _ordered_index_range(
+                     'next_run', before=next_run_before)
+                 if partitions is None or db_utils.in_partitions(
+                     schedule_id, partitions, partition_count)]
+    next_runs = cron.next_runs(schedules, start_time=now)
+
+    job_ids = []
+    for schedule, next_run in zip(schedules, next_runs):
+        # NOTE: the job for this run may already have been created alone
+        run_key = (schedule['id'], _datetime_key(schedule['next_run']))
+        if run_key not in INDEXES['job_runs']:
+            timeout = now + datetime.timedelta(
+                seconds=action_timeouts.get(schedule['action'],
+                                            default_timeout))
+            job_metadata = [{'key': meta['key'], 'value': meta['value']}
+                            for meta in schedule_meta_get_all(schedule['id'])]
+            job = job_create({'schedule_id': schedule['id'],
+                              'tenant': schedule['tenant'],
+                              'action': schedule['action'],
+                              'status': 'queued',
+                              'timeout': timeout,
+                              'hard_timeout': timeout,
+                              'scheduled_run': schedule['next_run'],
+                              'job_metadata': job_metadata})
+            job_ids.append(job['id'])
+
+        schedule_update(schedule['id'], {'next_run': next_run,
+                                         'last_scheduled': now})
+
+    return job_ids
+
+
+@_journaled
+def jobs_delete_hard_timed_out(limit, record_faults=False):
+    """Delete up to limit abandoned jobs, along with their metadata.
+
+    A job is abandoned once both its timeout and its hard timeout have
+    passed without it finishing. Finished jobs are left to the archiver.
+
+    Returns the number of jobs deleted, so fewer than limit means none
+    are left. If record_faults is set a fault is saved for each job.
+    """
+    now = timeutils.utcnow()
+    jobs = [job for job in DATA['jobs'].values()
+            if job['hard_timeout'] <= now and job['timeout'] <= now and
+            job.get('status') not in db_utils.FINISHED_JOB_STATUSES]
+    jobs = sorted(jobs, key=itemgetter('hard_timeout'))[:limit]
 
-    for job_id in del_ids:
-        job_delete(job_id)
-    return len(del_ids)
+    for job in jobs:
+        if record_faults:
+            job_metadata = job_meta_get_all_by_job_id(job['id'])
+            job_fault_create(db_utils.hard_timeout_fault_values(
+                job, job_metadata))
+        job_delete(job['id'])
+    return len(jobs)
 
 
+@_journaled
 def job_update(job_id, job_values):
     global DATA
     values = job_values.copy()
@@ -430,22 +956,32 @@ def job_update(job_id, job_values):
         # we may be trying to manually set updated_at
         job['updated_at'] = timeutils.utcnow()
         job.update(values)
+        _queue_job(job_id)
+        _touch('jobs', job_id)
 
     if metadata is not None:
         DATA['job_metadata'][job_id] = {}
+        _touch('job_metadata', job_id)
         for metadatum in metadata:
             job_meta_create(job_id, metadatum)
 
     return job_get_by_id(job_id)
 
 
+@_journaled
 def job_delete(job_id):
     global DATA
     if job_id not in DATA['jobs']:
         raise exception.NotFound()
+    INDEXES['job_runs'].pop(_job_run_key(DATA['jobs'][job_id]), None)
     del DATA['jobs'][job_id]
+    DATA['job_metadata'].pop(job_id, None)
+    INDEXES['queued_jobs'].pop(job_id, None)
+    _touch('jobs', job_id)
+    _touch('job_metadata', job_id)
 
 
+@_journaled
 def job_meta_create(job_id, values):
     global DATA
     values['job_id'] = job_id
@@ -465,7 +1001,8 @@ def job_meta_create(job_id, values):
     meta.update(values)
     meta.update(_gen_base_attributes())
     DATA['job_metadata'][job_id][values['key']] = meta
-    return copy.deepcopy(meta)
+    _touch('job_metadata', job_id)
+    return dict(meta)
 
 
 def _check_job_exists(job_id):
@@ -483,45 +1020,109 @@ def _check_job_meta_exists(job_id, key):
         raise exception.NotFound(message=msg)
 
 
-def job_meta_get_all_by_job_id(job_id):
+@_synchronized
+def job_meta_get_all_by_job_id(job_id, consistent=False):
     _check_job_exists(job_id)
 
     if job_id not in DATA['job_metadata']:
         DATA['job_metadata'][job_id] = {}
 
-    return copy.deepcopy(DATA['job_metadata'][job_id].values())
+    return [dict(meta) for meta in DATA['job_metadata'][job_id].values()]
 
 
+@_journaled
 def job_metadata_update(job_id, values):
     global DATA
     _check_job_exists(job_id)
 
     DATA['job_metadata'][job_id] = {}
+    _touch('job_metadata', job_id)
     for metadatum in values:
         job_meta_create(job_id, metadatum)
 
-    return copy.deepcopy(DATA['job_metadata'][job_id].values())
+    return job_meta_get_all_by_job_id(job_id)
 
 
-def _job_faults_get_sorted():
-    jobs = copy.deepcopy(DATA['job_faults'])
-    sorted_jobs = []
-    for job_id in jobs:
-        sorted_jobs.append(jobs[job_id])
+@_journaled
+def jobs_archive_finished(finished_before, limit):
+    """Move up to limit jobs which finished before finished_before, and
+    their metadata, to the job archive.
 
-    sorted_jobs = sorted(sorted_jobs, key=operator.itemgetter('created_at'),
-                         reverse=True)
-    return sorted_jobs
+    Returns the number of jobs moved, so fewer than limit means none
+    are left.
+    """
+    jobs = [job for job in DATA['jobs'].values()
+            if job.get('status') in db_utils.FINISHED_JOB_STATUSES and
+            job['updated_at'] <= finished_before]
+    jobs = sorted(jobs, key=itemgetter('updated_at'))[:limit]
 
+    for job in jobs:
+        job_metadata = job_meta_get_all_by_job_id(job['id'])
+        DATA['job_archive'][job['id']] = db_utils.archived_job_values(
+            job, job_metadata)
+        _touch('job_archive', job['id'])
+        job_delete(job['id'])
+    return len(jobs)
 
-def job_fault_latest_for_job_id(job_id):
-    job_faults = _job_faults_get_sorted()
-    for job_fault in job_faults:
-        if job_fault['job_id'] == job_id:
-            return job_fault
-    return None
+
+@_synchronized
+def job_archive_get_all(params={}, consistent=False):
+    jobs = [db_utils.archived_job_to_dict(job)
+            for job in DATA['job_archive'].values()]
+
+    if params.get('schedule_id') is not None:
+        jobs = [job for job in jobs
+                if job['schedule_id'] == params['schedule_id']]
+
+    if params.get('tenant') is not None:
+        jobs = [job for job in jobs if job['tenant'] == params['tenant']]
+
+    marker = params.get('marker')
+    limit = params.get('limit')
+    return _do_pagination(jobs, marker, limit, params.get('cursor'))
+
+
+def _index_job_fault(job_fault_id):
+    job_fault = DATA['job_faults'][job_fault_id]
+    bisect.insort(INDEXES['job_fault_ids'], job_fault_id)
+    for key in JOB_FAULT_FILTERS:
+        ids = INDEXES['job_faults_by'].setdefault(key, {}).setdefault(
+            job_fault.get(key), [])
+        bisect.insort(ids, job_fault_id)
+    bisect.insort(
+        INDEXES['job_fault_times'].setdefault(job_fault.get('job_id'), []),
+        (_datetime_key(job_fault['created_at']), job_fault_id))
+
+
+@_synchronized
+def job_fault_latest_for_job_id(job_id, consistent=False):
+    job_fault_times = INDEXES['job_fault_times'].get(job_id)
+    if not job_fault_times:
+        return None
+    return dict(DATA['job_faults'][job_fault_times[-1][1]])
+
+
+@_synchronized
+def job_fault_get_all(params={}, consistent=False):
+    filters = dict((key, params[key]) for key in JOB_FAULT_FILTERS
+                   if params.get(key) is not None)
+
+    ids = INDEXES['job_fault_ids']
+    if filters:
+        # NOTE: start from the filter matching the fewest faults
+        ids = min([INDEXES['job_faults_by'].get(key, {}).get(value, [])
+                   for key, value in filters.iteritems()], key=len)
+        ids = [job_fault_id for job_fault_id in ids
+               if all(DATA['job_faults'][job_fault_id].get(key) == value
+                      for key, value in filters.iteritems())]
+
+    marker = params.get('marker')
+    limit = params.get('limit')
+    ids = _paginate_ids(ids, marker, limit, params.get('cursor'))
+    return [dict(DATA['job_faults'][job_fault_id]) for job_fault_id in ids]
 
 
+@_journaled
 def job_fault_create(values):
     global DATA
     job_fault = {}
@@ -529,4 +1130,6 @@ def job_fault_create(values):
     item_id = values.get('id')
     job_fault.update(_gen_base_attributes(item_id=item_id))
     DATA['job_faults'][job_fault['id']] = job_fault
-    return copy.deepcopy(job_fault)
+    _index_job_fault(job_fault['id'])
+    _touch('job_faults', job_fault['id'])
+    return dict(job_fault)
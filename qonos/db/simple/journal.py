@@ -0,0 +1,182 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Durable storage for the simple DB backend.
+
+Every committed change is appended to the journal file as one JSON line
+holding the new value of each entry of the store it touched, or null for
+an entry it deleted. From time to time the whole store is written to a
+snapshot file and the journal is emptied. Loading the snapshot and then
+replaying the journal over it gives back the store.
+
+A line is only replayed once it is complete, so a change cut short by a
+crash is dropped as a whole.
+"""
+
+import datetime
+import json
+import os
+import threading
+
+from qonos.openstack.common.gettextutils import _
+import qonos.openstack.common.log as logging
+from qonos.openstack.common import timeutils
+
+LOG = logging.getLogger(__name__)
+
+
+def _encode(obj):
+    if isinstance(obj, datetime.datetime):
+        return {'__datetime__': timeutils.strtime(obj)}
+    raise TypeError(_('%r is not JSON serializable') % obj)
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return timeutils.parse_strtime(obj['__datetime__'])
+    return obj
+
+
+def _apply(data, changes):
+    for table, key, value in changes:
+        if value is None:
+            data.setdefault(table, {}).pop(key, None)
+        else:
+            data.setdefault(table, {})[key] = value
+
+
+def _fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal(object):
+    """An append only log of changes to a dict of tables.
+
+    Changes are written as they are committed, but the fsync which makes
+    them durable is shared: commits made within sync_interval seconds of
+    each other are synced together once the interval is up. A
+    sync_interval of 0 syncs every commit before it returns.
+
+    The shared fsync runs on a native timer thread, so it happens whether
+    commits are made from green threads or from the native threads of
+    the eventlet thread pool.
+    """
+
+    def __init__(self, path, sync_interval=0, compact_records=10000):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.sync_interval = sync_interval
+        self.compact_records = compact_records
+        self.records = 0
+        self._file = None
+        self._unsynced = False
+        self._sync_timer = None
+        self._lock = threading.RLock()
+
+    def load(self):
+        """Read the snapshot, replay the journal over it and open the
+        journal for appending. Returns the stored tables."""
+        data = {}
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'rb') as snapshot:
+                data = json.load(snapshot, object_hook=_decode)
+
+        self.records = 0
+        valid_size = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                for line in journal:
+                    if not line.endswith('\n'):
+                        break
+                    try:
+                        changes = json.loads(line, object_hook=_decode)
+                    except ValueError:
+                        break
+                    _apply(data, changes)
+                    valid_size += len(line)
+                    self.records += 1
+
+        self._file = open(self.path, 'ab')
+        if self._file.tell() > valid_size:
+            LOG.warn(_('Dropping an incomplete change from the end of '
+                       'journal %s') % self.path)
+            self._file.truncate(valid_size)
+            self._file.seek(valid_size)
+        return data
+
+    def commit(self, changes):
+        """Append changes, a list of (table, key, value) tuples where a
+        value of None deletes the key."""
+        with self._lock:
+            self._file.write(json.dumps(changes, default=_encode) + '\n')
+            self._file.flush()
+            self.records += 1
+            self._unsynced = True
+            if self.sync_interval <= 0:
+                self.sync()
+            elif self._sync_timer is None:
+                self._sync_timer = threading.Timer(self.sync_interval,
+                                                   self.sync)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+
+    def sync(self):
+        """Make every commit so far durable."""
+        with self._lock:
+            self._sync_timer = None
+            if self._unsynced and self._file is not None:
+                os.fsync(self._file.fileno())
+                self._unsynced = False
+
+    def should_compact(self):
+        return self.compact_records > 0 and \
+            self.records >= self.compact_records
+
+    def compact(self, data):
+        """Write data to the snapshot and empty the journal."""
+        with self._lock:
+            self._compact(data)
+
+    def _compact(self, data):
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'wb') as snapshot:
+            json.dump(data, snapshot, default=_encode)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.rename(tmp_path, self.snapshot_path)
+        _fsync_dir(self.snapshot_path)
+
+        # NOTE: a crash before the journal is emptied only means its
+        # changes are replayed over a snapshot which already has them
+        self._file.truncate(0)
+        self._file.seek(0)
+        os.fsync(self._file.fileno())
+        self._unsynced = False
+        self.records = 0
+
+    def close(self):
+        with self._lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+            self.sync()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
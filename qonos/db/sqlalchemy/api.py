@@ -18,27 +18,42 @@
 Defines interface for DB access
 """
 
+import datetime
 import functools
 import logging
 import time
+import uuid
 
 import sqlalchemy
+import sqlalchemy.ext.compiler as sa_compiler
 import sqlalchemy.orm as sa_orm
 import sqlalchemy.sql as sa_sql
 
+from qonos.common import cron
 from qonos.common import exception
 import qonos.db.db_utils as db_utils
+from qonos.db import query_stats
+from qonos.db.sqlalchemy import migration
 from qonos.db.sqlalchemy import models
 from qonos.openstack.common import cfg
 from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import jsonutils
 import qonos.openstack.common.log as os_logging
 from qonos.openstack.common import timeutils
+from qonos.openstack.common import uuidutils
 
 
 _ENGINE = None
 _MAKER = None
+_SLAVE_ENGINE = None
+_SLAVE_MAKER = None
 _MAX_RETRIES = None
 _RETRY_INTERVAL = None
+# Spare candidates read per claim in case some are lost to other claimers
+_CLAIM_CANDIDATES = 10
+# Columns of schedules and jobs which only serve lookups, such as those
+# mirroring their metadata
+_INTERNAL_COLUMNS = ('inline_metadata', 'instance_id', 'partition_key')
 BASE = models.BASE
 sa_logger = None
 LOG = os_logging.getLogger(__name__)
@@ -48,6 +63,28 @@ db_opts = [
     cfg.IntOpt('sql_max_retries', default=60),
     cfg.IntOpt('sql_retry_interval', default=1),
     cfg.BoolOpt('db_auto_create', default=True),
+    cfg.IntOpt('sql_pool_size', default=5,
+               help=_('Number of connections kept open in the pool')),
+    cfg.IntOpt('sql_max_overflow', default=10,
+               help=_('Number of connections which may be opened beyond '
+                      'sql_pool_size when the pool is exhausted')),
+    cfg.IntOpt('sql_pool_timeout', default=30,
+               help=_('Seconds to wait for a connection from the pool '
+                      'before giving up')),
+    cfg.IntOpt('sql_ping_interval', default=0,
+               help=_('Seconds a MySQL connection may go unchecked before '
+                      'it is pinged on checkout. 0 pings on every '
+                      'checkout')),
+    cfg.StrOpt('sql_slave_connection', default=None,
+               help=_('Connection string of a read replica. Read only DB '
+                      'API calls go to it unless they must be consistent '
+                      'with writes just made')),
+    cfg.BoolOpt('sql_inline_metadata', default=False,
+                help=_('Keep schedule and job metadata as JSON in a column '
+                       'of the schedules and jobs tables instead of in the '
+                       'schedule_metadata and job_metadata tables. Run '
+                       'qonos-manage db_inline_metadata before turning this '
+                       'on')),
 ]
 
 CONF = cfg.CONF
@@ -105,15 +142,144 @@ def force_dict(func):
     return wrapped
 
 
+def _ref_to_dict(ref, collections=()):
+    """Build the dict for a row from an instance the session has just
+    flushed, instead of reading the row back."""
+    values = {}
+    for column in ref.__table__.columns:
+        value = getattr(ref, column.name)
+        # NOTE: integers given as strings come back from the database as ints
+        if (isinstance(column.type, sqlalchemy.Integer) and
+                isinstance(value, basestring) and value.isdigit()):
+            value = int(value)
+        values[column.name] = value
+
+    for collection in collections:
+        values[collection] = [_ref_to_dict(item)
+                              for item in getattr(ref, collection)]
+    return values
+
+
+def _parent_ref_to_dict(ref, collection, parent_key):
+    """Build the dict for a flushed schedule or job, with its metadata
+    under collection."""
+    if CONF.sql_inline_metadata:
+        values = _ref_to_dict(ref)
+        values[collection] = _inline_metadata_items(
+            jsonutils.loads(ref.inline_metadata or '{}'), parent_key, values)
+    else:
+        values = _ref_to_dict(ref, [collection])
+    _drop_internal_columns(values)
+    return values
+
+
+def _attach_metadata(rows, collection, parent_key, get_by_parent_ids):
+    """Set the metadata of each schedule or job row dict under collection,
+    from its inline_metadata column or with one query on the metadata
+    table."""
+    if CONF.sql_inline_metadata:
+        for row in rows:
+            row[collection] = _inline_metadata_items(
+                jsonutils.loads(row['inline_metadata'] or '{}'),
+                parent_key, row)
+    else:
+        metadata = get_by_parent_ids([row['id'] for row in rows])
+        for row in rows:
+            row[collection] = metadata.get(row['id'], [])
+
+    for row in rows:
+        _drop_internal_columns(row)
+
+
+def _drop_internal_columns(values):
+    """Remove the columns which only serve lookups from the dict of a
+    schedule or job; callers see the metadata itself."""
+    for column in _INTERNAL_COLUMNS:
+        values.pop(column, None)
+
+
+def _inline_metadata_items(metadata, parent_key, parent):
+    """Return the inline metadata keys and values of a schedule or job as
+    metadata items.
+
+    Items have no rows of their own, so each takes the timestamps of its
+    schedule or job and an id derived from that of its parent and its key.
+    """
+    items = db_utils.metadata_items(metadata,
+                                    created_at=parent['created_at'],
+                                    updated_at=parent['updated_at'],
+                                    **{parent_key: parent['id']})
+    for item in items:
+        name = u'%s/%s' % (parent['id'], item['key'])
+        item['id'] = str(uuid.uuid5(uuid.NAMESPACE_URL, name.encode('utf-8')))
+    return items
+
+
+def _inline_metadata_get(session, table, parent_id, for_update=False):
+    """Return the row of a schedule or job and the metadata keys and
+    values kept in its inline_metadata column."""
+    query = sa_sql.select([table.c.id, table.c.created_at,
+                           table.c.updated_at, table.c.inline_metadata],
+                          table.c.id == parent_id, for_update=for_update)
+    row = session.execute(query).first()
+    if row is None:
+        raise exception.NotFound()
+    return row, jsonutils.loads(row['inline_metadata'] or '{}')
+
+
+def _metadata_column_values(table, metadata):
+    """Return the values of the columns of a schedule or job which mirror
+    its metadata keys and values."""
+    values = {}
+    if CONF.sql_inline_metadata:
+        values['inline_metadata'] = jsonutils.dumps(metadata)
+    if 'instance_id' in table.c:
+        values['instance_id'] = metadata.get('instance_id')
+    return values
+
+
+def _parent_columns_set(session, table, parent_id, values):
+    """Update columns of a schedule or job which mirror its metadata. As
+    with metadata rows, this leaves its updated_at alone."""
+    if values:
+        session.execute(table.update()
+                             .where(table.c.id == parent_id)
+                             .values(updated_at=table.c.updated_at,
+                                     **values))
+
+
+def _metadata_columns_set(session, table, parent_id, metadata):
+    values = _metadata_column_values(table, metadata)
+    _parent_columns_set(session, table, parent_id, values)
+    return values
+
+
+def _ref_metadata_columns_update(session, ref, metadata):
+    """Bring the columns of a loaded schedule or job which mirror its
+    metadata in line with a new list of metadata items."""
+    values = _metadata_columns_set(
+        session, ref.__table__, ref.id,
+        dict((meta['key'], meta['value']) for meta in metadata))
+    for column, value in values.iteritems():
+        sa_orm.attributes.set_committed_value(ref, column, value)
+
+
 def ping_listener(dbapi_conn, connection_rec, connection_proxy):
 
     """
     Ensures that MySQL connections checked out of the
     pool are alive.
 
+    Connections pinged less than sql_ping_interval seconds ago are
+    trusted without another round trip.
+
     Borrowed from:
     http://groups.google.com/group/sqlalchemy/msg/a4ce563d802c929f
     """
+    now = time.time()
+    last_ping = connection_rec.info.get('last_ping')
+    if last_ping is not None and now - last_ping < CONF.sql_ping_interval:
+        return
 
     try:
         dbapi_conn.cursor().execute('select 1')
@@ -124,6 +290,47 @@ def ping_listener(dbapi_conn, connection_rec, connection_proxy):
             raise sqlalchemy.exc.DisconnectionError(msg)
         else:
             raise
+    connection_rec.info['last_ping'] = now
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info['query_start_time'] = time.time()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """Count the statement towards the queries of the current request."""
+    start_time = conn.info.pop('query_start_time', None)
+    if start_time is not None:
+        query_stats.record(statement, time.time() - start_time)
+
+
+def _create_engine(sql_connection):
+    connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
+    engine_args = {'pool_recycle': CONF.sql_idle_timeout,
+                   'echo': False,
+                   'convert_unicode': True
+                   }
+    # NOTE: SQLite uses pools which hold a single connection
+    if 'sqlite' not in connection_dict.drivername:
+        engine_args['pool_size'] = CONF.sql_pool_size
+        engine_args['max_overflow'] = CONF.sql_max_overflow
+        engine_args['pool_timeout'] = CONF.sql_pool_timeout
+
+    engine = sqlalchemy.create_engine(sql_connection, **engine_args)
+
+    if 'mysql' in connection_dict.drivername:
+        sqlalchemy.event.listen(engine, 'checkout', ping_listener)
+
+    sqlalchemy.event.listen(engine, 'before_cursor_execute',
+                            _before_cursor_execute)
+    sqlalchemy.event.listen(engine, 'after_cursor_execute',
+                            _after_cursor_execute)
+
+    engine.connect = wrap_db_error(engine.connect)
+    engine.connect()
+    return engine
 
 
 def configure_db():
@@ -131,26 +338,14 @@ def configure_db():
     Establish the database, create an engine if needed, and
     register the models.
     """
-    global _ENGINE, sa_logger, _MAX_RETRIES, _RETRY_INTERVAL
+    global _ENGINE, _SLAVE_ENGINE, sa_logger, _MAX_RETRIES, _RETRY_INTERVAL
     LOG.debug("Initializing DB")
     if not _ENGINE:
         sql_connection = CONF.sql_connection
         _MAX_RETRIES = CONF.sql_max_retries
         _RETRY_INTERVAL = CONF.sql_retry_interval
-        connection_dict = sqlalchemy.engine.url.make_url(sql_connection)
-        engine_args = {'pool_recycle': CONF.sql_idle_timeout,
-                       'echo': False,
-                       'convert_unicode': True
-                       }
-
         try:
-            _ENGINE = sqlalchemy.create_engine(sql_connection, **engine_args)
-
-            if 'mysql' in connection_dict.drivername:
-                sqlalchemy.event.listen(_ENGINE, 'checkout', ping_listener)
-
-            _ENGINE.connect = wrap_db_error(_ENGINE.connect)
-            _ENGINE.connect()
+            _ENGINE = _create_engine(sql_connection)
         except Exception, err:
             msg = _("Error configuring registry database with supplied "
                     "sql_connection '%(sql_connection)s'. "
@@ -158,13 +353,24 @@ def configure_db():
             LOG.error(msg)
             raise
 
+        if CONF.sql_slave_connection:
+            sql_slave_connection = CONF.sql_slave_connection
+            try:
+                _SLAVE_ENGINE = _create_engine(sql_slave_connection)
+            except Exception, err:
+                msg = _("Error configuring read replica with supplied "
+                        "sql_slave_connection '%(sql_slave_connection)s'. "
+                        "Got error:\n%(err)s") % locals()
+                LOG.error(msg)
+                raise
+
         sa_logger = logging.getLogger('sqlalchemy.engine')
         if CONF.debug:
             sa_logger.setLevel(logging.DEBUG)
 
         if CONF.db_auto_create:
             LOG.info('auto-creating qonos DB')
-            models.register_models(_ENGINE)
+            migration.db_sync(_ENGINE)
         else:
             LOG.info('not auto-creating qonos DB')
 
@@ -174,9 +380,20 @@ def reset():
     models.register_models(_ENGINE)
 
 
-def get_session(autocommit=True, expire_on_commit=False):
-    """Helper method to grab session."""
-    global _MAKER
+def get_session(autocommit=True, expire_on_commit=False, use_slave=False):
+    """Helper method to grab session.
+
+    With use_slave the session reads from the replica given by
+    sql_slave_connection, if there is one.
+    """
+    global _MAKER, _SLAVE_MAKER
+    if use_slave and _SLAVE_ENGINE:
+        if not _SLAVE_MAKER:
+            _SLAVE_MAKER = sa_orm.sessionmaker(
+                bind=_SLAVE_ENGINE, autocommit=autocommit,
+                expire_on_commit=expire_on_commit)
+        return _SLAVE_MAKER()
+
     if not _MAKER:
         assert _ENGINE
         _MAKER = sa_orm.sessionmaker(bind=_ENGINE,
@@ -185,6 +402,12 @@ def get_session(autocommit=True, expire_on_commit=False):
     return _MAKER()
 
 
+def _read_session(consistent=False):
+    """Return a session for a read only DB API call, which goes to the
+    read replica unless it must see writes just made."""
+    return get_session(use_slave=not consistent)
+
+
 def is_db_connection_error(args):
     """Return True if error in connecting to db."""
     # NOTE(adam_g): This is currently MySQL specific and needs to be extended
@@ -228,25 +451,28 @@ def wrap_db_error(f):
 #################### Schedule methods
 
 
-@force_dict
 def schedule_create(schedule_values):
     db_utils.validate_schedule_values(schedule_values)
     # make a copy so we can remove 'schedule_metadata'
     # without affecting the caller
     values = schedule_values.copy()
-    metadata = None
+    values.setdefault('id', uuidutils.generate_uuid())
+    values['partition_key'] = db_utils.partition_key(values['id'])
     session = get_session()
     schedule_ref = models.Schedule()
-
-    if 'schedule_metadata' in values:
-        metadata = values['schedule_metadata']
+    metadata = values.pop('schedule_metadata', [])
+    if not CONF.sql_inline_metadata:
         _set_schedule_metadata(schedule_ref, metadata)
-        del values['schedule_metadata']
-
+    schedule_ref.update(_metadata_column_values(
+        models.Schedule.__table__,
+        dict((meta['key'], meta['value']) for meta in metadata)))
     schedule_ref.update(values)
-    schedule_ref.save(session=session)
 
-    return _schedule_get_by_id(schedule_ref['id'])
+    with session.begin():
+        schedule_ref.save(session=session)
+
+    return _parent_ref_to_dict(schedule_ref, 'schedule_metadata',
+                               'schedule_id')
 
 
 def paginate_query(query, model, sort_keys, limit=None, marker=None):
@@ -270,8 +496,9 @@ def paginate_query(query, model, sort_keys, limit=None, marker=None):
     :param model: the ORM model class
     :param sort_keys: array of attributes by which results should be sorted
     :param limit: maximum number of items to return
-    :param marker: the last item of the previous page; we returns the next
-                    results after this value.
+    :param marker: the last item of the previous page, or the values of
+                    its sort keys; we returns the next results after this
+                    value.
 
     :rtype: sqlalchemy.orm.query.Query
     :return: The query with sorting and(or) pagination added.
@@ -288,24 +515,11 @@ def paginate_query(query, model, sort_keys, limit=None, marker=None):
     if marker is not None:
         marker_values = []
         for sort_key in sort_keys:
-            v = getattr(marker, sort_key)
+            v = marker[sort_key]
             marker_values.append(v)
 
-    # Note(nikhil): the underlying code only supports asc order of sort_dir
-    #at the moment. However, more than one sort_keys could be supplied.
-        criteria_list = []
-        for i in xrange(0, len(sort_keys)):
-            crit_attrs = []
-            for j in xrange(0, i):
-                model_attr = getattr(model, sort_keys[j])
-                crit_attrs.append((model_attr == marker_values[j]))
-            model_attr = getattr(model, sort_keys[i])
-            crit_attrs.append((model_attr > marker_values[i]))
-            criteria = sa_sql.and_(*crit_attrs)
-            criteria_list.append(criteria)
-
-        f = sa_sql.or_(*criteria_list)
-        query = query.filter(f)
+        sort_attrs = [getattr(model, sort_key) for sort_key in sort_keys]
+        query = query.filter(_pagination_criteria(sort_attrs, marker_values))
 
     if limit is not None:
         query = query.limit(limit)
@@ -313,73 +527,194 @@ def paginate_query(query, model, sort_keys, limit=None, marker=None):
     return query
 
 
-@force_dict
-def schedule_get_all(filter_args={}):
-    session = get_session()
-    query = session.query(models.Schedule)\
-                   .options(sa_orm.joinedload_all(
-                            models.Schedule.schedule_metadata))
+def paginate_select(query, table, sort_keys, limit=None, marker=None):
+    """
+    Returns a select() with sorting and(or) pagination criteria added.
+
+    The SQLAlchemy Core counterpart of paginate_query, for callers which
+    build rows straight from the table rather than through the ORM.
+
+    :param query: the select statement to which we should add paging/sorting
+    :param table: the table being selected from
+    :param sort_keys: array of column names by which results should be sorted
+    :param limit: maximum number of items to return
+    :param marker: the last row of the previous page, or the values of
+                    its sort keys; we return the next results after this
+                    value.
+
+    :rtype: sqlalchemy.sql.expression.Select
+    :return: The select with sorting and(or) pagination added.
+    """
+    try:
+        sort_columns = [table.c[sort_key] for sort_key in sort_keys]
+    except KeyError:
+        raise exception.InvalidSortKey()
+
+    for sort_column in sort_columns:
+        query = query.order_by(sqlalchemy.asc(sort_column))
+
+    if marker is not None:
+        marker_values = [marker[sort_key] for sort_key in sort_keys]
+        query = query.where(_pagination_criteria(sort_columns, marker_values))
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
+
+def _pagination_criteria(sort_columns, marker_values):
+    # Note(nikhil): the underlying code only supports asc order of sort_dir
+    #at the moment. However, more than one sort_keys could be supplied.
+    criteria_list = []
+    for i in xrange(0, len(sort_columns)):
+        crit_attrs = []
+        for j in xrange(0, i):
+            crit_attrs.append((sort_columns[j] == marker_values[j]))
+        crit_attrs.append((sort_columns[i] > marker_values[i]))
+        criteria = sa_sql.and_(*crit_attrs)
+        criteria_list.append(criteria)
+
+    return sa_sql.or_(*criteria_list)
+
+
+def _marker_get(session, table, params):
+    """Return the sort key values of the row to start the page after.
+
+    A cursor carries these values itself; a marker id costs a lookup.
+    """
+    if params.get('cursor') is not None:
+        return db_utils.decode_cursor(params['cursor'])
+    if params.get('marker') is None:
+        return None
+
+    query = sa_sql.select([table.c.id], table.c.id == params['marker'])
+    marker = session.execute(query).first()
+    if marker is None and session.bind is not _ENGINE:
+        # NOTE: the marker may be a row the replica has not caught up on
+        marker = get_session().execute(query).first()
+    if marker is None:
+        raise exception.NotFound()
+    return marker
+
+
+def schedule_get_all(filter_args={}, consistent=False):
+    session = _read_session(consistent)
+    schedules = models.Schedule.__table__
+    query = sa_sql.select([schedules])
 
     if 'next_run_after' in filter_args:
-        query = query.filter(
-            models.Schedule.next_run >= filter_args['next_run_after'])
+        query = query.where(
+            schedules.c.next_run >= filter_args['next_run_after'])
 
     if 'next_run_before' in filter_args:
-        query = query.filter(
-            models.Schedule.next_run <= filter_args['next_run_before'])
+        query = query.where(
+            schedules.c.next_run <= filter_args['next_run_before'])
+
+    if filter_args.get('changed_since') is not None:
+        query = query.where(
+            schedules.c.updated_at >= filter_args['changed_since'])
 
     if filter_args.get('tenant') is not None:
-        query = query.filter(
-                models.Schedule.tenant == filter_args['tenant'])
+        query = query.where(schedules.c.tenant == filter_args['tenant'])
 
     if filter_args.get('instance_id') is not None:
-        query = query.filter(models.Schedule.schedule_metadata.any(
-                    key='instance_id', value=filter_args['instance_id']))
+        instance_ids = db_utils.filter_values(filter_args['instance_id'])
+        query = query.where(schedules.c.instance_id.in_(instance_ids))
 
-    marker_schedule = None
-    if filter_args.get('marker') is not None:
-        marker_schedule = _schedule_get_by_id(filter_args['marker'])
+    if filter_args.get('partitions') is not None:
+        query = query.where(_partition_criteria(
+            schedules, filter_args['partitions'],
+            filter_args['partition_count']))
 
-    query = paginate_query(query, models.Schedule, ['id'],
-                           limit=filter_args.get('limit'),
-                           marker=marker_schedule)
+    marker_schedule = _marker_get(session, schedules, filter_args)
+    query = paginate_select(query, schedules, ['id'],
+                            limit=filter_args.get('limit'),
+                            marker=marker_schedule)
+
+    return _schedules_get_dicts(session, query)
+
+
+def _partition_criteria(schedules, partitions, partition_count):
+    if not partitions:
+        return sa_sql.false()
+    return (schedules.c.partition_key % partition_count).in_(partitions)
+
+
+def _schedules_get_dicts(session, query):
+    """Run a select on the schedules table and return the rows as dicts,
+    each with its schedule_metadata attached."""
+    schedules = [dict(row) for row in session.execute(query)]
+    if not schedules:
+        return []
+
+    _attach_schedule_metadata(session, schedules)
+    return schedules
+
+
+def _attach_schedule_metadata(session, schedules):
+    _attach_metadata(
+        schedules, 'schedule_metadata', 'schedule_id',
+        functools.partial(_schedule_metadata_get_by_schedule_ids, session))
 
-    return query.all()
+
+def _schedule_metadata_get_by_schedule_ids(session, schedule_ids):
+    """Return a dict of schedule id to the metadata of that schedule."""
+    schedule_metadata = models.ScheduleMetadata.__table__
+    query = sa_sql.select([schedule_metadata],
+                          schedule_metadata.c.schedule_id.in_(schedule_ids))
+    metadata = {}
+    for row in session.execute(query):
+        metadata.setdefault(row['schedule_id'], []).append(dict(row))
+    return metadata
+
+
+def _schedule_get_dict_by_id(schedule_id, session=None):
+    session = session or get_session()
+    schedules = models.Schedule.__table__
+    query = sa_sql.select([schedules], schedules.c.id == schedule_id)
+    found = _schedules_get_dicts(session, query)
+    if not found:
+        raise exception.NotFound()
+    return found[0]
 
 
 def _schedule_get_by_id(schedule_id, session=None):
     session = session or get_session()
+    query = session.query(models.Schedule)
+    if not CONF.sql_inline_metadata:
+        query = query.options(sa_orm.joinedload_all('schedule_metadata'))
     try:
-        schedule = session.query(models.Schedule)\
-                          .options(sa_orm.joinedload_all('schedule_metadata'))\
-                          .filter_by(id=schedule_id)\
-                          .one()
+        schedule = query.filter_by(id=schedule_id).one()
     except sa_orm.exc.NoResultFound:
         raise exception.NotFound()
 
     return schedule
 
 
-@force_dict
-def schedule_get_by_id(schedule_id):
-    return _schedule_get_by_id(schedule_id)
+def schedule_get_by_id(schedule_id, consistent=False):
+    return _schedule_get_dict_by_id(schedule_id, _read_session(consistent))
 
 
-@force_dict
 def schedule_update(schedule_id, schedule_values):
     # make a copy so we can remove 'schedule_metadata'
     # without affecting the caller
     values = schedule_values.copy()
     session = get_session()
-    schedule_ref = _schedule_get_by_id(schedule_id, session)
+    with session.begin():
+        schedule_ref = _schedule_get_by_id(schedule_id, session)
 
-    if 'schedule_metadata' in values:
-        metadata = values.pop('schedule_metadata')
-        _schedule_metadata_update_in_place(schedule_ref, metadata)
+        if 'schedule_metadata' in values:
+            metadata = values.pop('schedule_metadata')
+            if not CONF.sql_inline_metadata:
+                _schedule_metadata_update_in_place(schedule_ref, metadata)
+            _ref_metadata_columns_update(session, schedule_ref, metadata)
 
-    schedule_ref.update(values)
-    schedule_ref.save(session=session)
-    return _schedule_get_by_id(schedule_id)
+        schedule_ref.update(values)
+        schedule_ref.save(session=session)
+
+    return _parent_ref_to_dict(schedule_ref, 'schedule_metadata',
+                               'schedule_id')
 
 
 def _schedule_metadata_update_in_place(schedule, metadata):
@@ -404,40 +739,117 @@ def _schedule_metadata_update_in_place(schedule, metadata):
         schedule['schedule_metadata'].remove(meta)
 
 
+_MINUTE_FORMAT = '%Y-%m-%d %H:%M'
+
+
+class _MinuteOf(sa_sql.expression.FunctionElement):
+    """A datetime truncated to its minute, as text in _MINUTE_FORMAT."""
+    name = 'minute_of'
+    type = sqlalchemy.String()
+
+
+# NOTE: the formats are bound rather than inlined, so their '%'s are left
+# alone by drivers which use them for parameters
+@sa_compiler.compiles(_MinuteOf)
+def _compile_minute_of(element, compiler, **kw):
+    return compiler.process(sa_sql.func.date_format(
+        element.clauses, sa_sql.literal('%Y-%m-%d %H:%i')), **kw)
+
+
+@sa_compiler.compiles(_MinuteOf, 'sqlite')
+def _compile_minute_of_sqlite(element, compiler, **kw):
+    return compiler.process(sa_sql.func.strftime(
+        sa_sql.literal(_MINUTE_FORMAT), element.clauses), **kw)
+
+
+@sa_compiler.compiles(_MinuteOf, 'postgresql')
+def _compile_minute_of_postgresql(element, compiler, **kw):
+    return compiler.process(sa_sql.func.to_char(
+        element.clauses, sa_sql.literal('YYYY-MM-DD HH24:MI')), **kw)
+
+
+def schedule_next_run_histogram(next_run_after, next_run_before,
+                                consistent=False):
+    """Return how many schedules are next due in each minute from
+    next_run_after to next_run_before, counted by the database."""
+    schedules = models.Schedule.__table__
+    minute = _MinuteOf(schedules.c.next_run)
+    query = sa_sql.select([minute.label('minute'),
+                           sa_sql.func.count().label('count')],
+                          sa_sql.and_(
+                              schedules.c.next_run >= next_run_after,
+                              schedules.c.next_run <= next_run_before)
+                          ).group_by(minute).order_by(minute)
+    rows = _read_session(consistent).execute(query)
+    return [{'minute': datetime.datetime.strptime(row['minute'],
+                                                  _MINUTE_FORMAT),
+             'count': row['count']}
+            for row in rows]
+
+
+def schedule_cron_counts(consistent=False):
+    """Return how many schedules there are of each action and cron
+    pattern, as dicts of db_utils.CRON_COUNT_KEYS and 'count'."""
+    schedules = models.Schedule.__table__
+    columns = [schedules.c[name] for name in db_utils.CRON_COUNT_KEYS]
+    query = sa_sql.select(
+        columns + [sa_sql.func.count(schedules.c.id).label('count')]
+    ).group_by(*columns)
+    return [dict(row) for row in _read_session(consistent).execute(query)]
+
+
 def schedule_delete(schedule_id):
     session = get_session()
-    schedule_ref = _schedule_get_by_id(schedule_id, session)
-    schedule_ref.delete(session=session)
+    with session.begin():
+        schedule_ref = _schedule_get_by_id(schedule_id, session)
+        schedule_ref.delete(session=session)
 
 
 def _set_schedule_metadata(schedule_ref, metadata):
+    schedule_metadata = schedule_ref.schedule_metadata
     for metadatum in metadata:
         metadata_ref = models.ScheduleMetadata()
         metadata_ref.update(metadatum)
-        schedule_ref.schedule_metadata.append(metadata_ref)
+        schedule_metadata.append(metadata_ref)
 
 #################### Schedule Metadata methods
 
 
-@force_dict
 def schedule_meta_create(schedule_id, values):
+    if CONF.sql_inline_metadata:
+        return _inline_meta_create(models.Schedule.__table__, 'schedule_id',
+                                   schedule_id, values)
+
     session = get_session()
-    _schedule_get_by_id(schedule_id, session)
     meta_ref = models.ScheduleMetadata()
     values['schedule_id'] = schedule_id
     meta_ref.update(values)
 
     try:
-        meta_ref.save(session=session)
+        with session.begin():
+            _schedule_get_by_id(schedule_id, session)
+            meta_ref.save(session=session)
+            if meta_ref.key == 'instance_id':
+                _parent_columns_set(session, models.Schedule.__table__,
+                                    schedule_id,
+                                    {'instance_id': meta_ref.value})
     except sqlalchemy.exc.IntegrityError:
         raise exception.Duplicate()
 
-    return _schedule_meta_get(schedule_id, values['key'])
+    return _ref_to_dict(meta_ref)
+
+
+def schedule_meta_get_all(schedule_id, consistent=False):
+    session = _read_session(consistent)
+    if CONF.sql_inline_metadata:
+        return _inline_meta_get_all(session, models.Schedule.__table__,
+                                    'schedule_id', schedule_id)
+    return _schedule_meta_get_all(schedule_id, session)
 
 
 @force_dict
-def schedule_meta_get_all(schedule_id):
-    session = get_session()
+def _schedule_meta_get_all(schedule_id, session=None):
+    session = session or get_session()
     _schedule_get_by_id(schedule_id, session)
     query = session.query(models.ScheduleMetadata)\
                    .filter_by(schedule_id=schedule_id)
@@ -465,61 +877,110 @@ def _schedule_meta_get(schedule_id, key, session=None):
 
 def _schedule_meta_update(schedule_id, key, values):
     session = get_session()
-    _schedule_get_by_id(schedule_id, session)
-    meta_ref = _schedule_meta_get(schedule_id, key, session)
-    meta_ref.update(values)
-    meta_ref.save(session=session)
+    with session.begin():
+        meta_ref = _schedule_meta_get(schedule_id, key, session)
+        meta_ref.update(values)
+        meta_ref.save(session=session)
     return meta_ref
 
 
-@force_dict
 def schedule_metadata_update(schedule_id, values):
-    session = get_session()
-    schedule = _schedule_get_by_id(schedule_id, session)
-    _schedule_metadata_update_in_place(schedule, values)
+    if CONF.sql_inline_metadata:
+        return _inline_metadata_update(models.Schedule.__table__,
+                                       'schedule_id', schedule_id, values)
 
-    schedule.save(session=session)
+    session = get_session()
+    with session.begin():
+        schedule = _schedule_get_by_id(schedule_id, session)
+        _schedule_metadata_update_in_place(schedule, values)
+        schedule.save(session=session)
+        _ref_metadata_columns_update(session, schedule, values)
 
-    return schedule_meta_get_all(schedule_id)
+    return [_ref_to_dict(meta) for meta in schedule.schedule_metadata]
 
 
 def schedule_meta_delete(schedule_id, key):
+    if CONF.sql_inline_metadata:
+        _inline_meta_delete(models.Schedule.__table__, schedule_id, key)
+        return
+
     session = get_session()
-    _schedule_get_by_id(schedule_id, session)
-    meta_ref = _schedule_meta_get(schedule_id, key, session)
-    meta_ref.delete(session=session)
+    with session.begin():
+        meta_ref = _schedule_meta_get(schedule_id, key, session)
+        meta_ref.delete(session=session)
+        if key == 'instance_id':
+            _parent_columns_set(session, models.Schedule.__table__,
+                                schedule_id, {'instance_id': None})
+
+
+def _inline_meta_create(table, parent_key, parent_id, values):
+    session = get_session()
+    with session.begin():
+        parent, metadata = _inline_metadata_get(session, table, parent_id,
+                                                for_update=True)
+        if values['key'] in metadata:
+            raise exception.Duplicate()
+        metadata[values['key']] = values['value']
+        _metadata_columns_set(session, table, parent_id, metadata)
+
+    return _inline_metadata_items({values['key']: values['value']},
+                                  parent_key, parent)[0]
+
+
+def _inline_meta_get_all(session, table, parent_key, parent_id):
+    parent, metadata = _inline_metadata_get(session, table, parent_id)
+    return _inline_metadata_items(metadata, parent_key, parent)
+
+
+def _inline_metadata_update(table, parent_key, parent_id, values):
+    metadata = dict((meta['key'], meta['value']) for meta in values)
+    session = get_session()
+    with session.begin():
+        parent, _old = _inline_metadata_get(session, table, parent_id,
+                                            for_update=True)
+        _metadata_columns_set(session, table, parent_id, metadata)
+
+    return _inline_metadata_items(metadata, parent_key, parent)
+
+
+def _inline_meta_delete(table, parent_id, key):
+    session = get_session()
+    with session.begin():
+        _parent, metadata = _inline_metadata_get(session, table, parent_id,
+                                                 for_update=True)
+        if key not in metadata:
+            raise exception.NotFound()
+        del metadata[key]
+        _metadata_columns_set(session, table, parent_id, metadata)
 
 
 ##################### Worker methods
 
 
 @force_dict
-def worker_get_all(params={}):
-    session = get_session()
+def worker_get_all(params={}, consistent=False):
+    session = _read_session(consistent)
     query = session.query(models.Worker)
 
-    marker_worker = None
-    if params.get('marker') is not None:
-        marker_worker = _worker_get_by_id(params['marker'])
-
+    marker_worker = _marker_get(session, models.Worker.__table__, params)
     query = paginate_query(query, models.Worker, ['id'],
                            limit=params.get('limit'), marker=marker_worker)
 
     return query.all()
 
 
-@force_dict
 def worker_create(values):
     session = get_session()
     worker_ref = models.Worker()
     worker_ref.update(values)
-    worker_ref.save(session=session)
+    with session.begin():
+        worker_ref.save(session=session)
 
-    return _worker_get_by_id(worker_ref['id'])
+    return _ref_to_dict(worker_ref)
 
 
-def _worker_get_by_id(worker_id):
-    session = get_session()
+def _worker_get_by_id(worker_id, session=None):
+    session = session or get_session()
     query = session.query(models.Worker).filter_by(id=worker_id)
 
     try:
@@ -531,142 +992,570 @@ def _worker_get_by_id(worker_id):
 
 
 @force_dict
-def worker_get_by_id(worker_id):
-    return _worker_get_by_id(worker_id)
+def worker_get_by_id(worker_id, consistent=False):
+    return _worker_get_by_id(worker_id, _read_session(consistent))
 
 
 def worker_delete(worker_id):
     session = get_session()
 
     with session.begin():
-        worker = _worker_get_by_id(worker_id)
+        worker = _worker_get_by_id(worker_id, session)
         worker.delete(session=session)
 
 
+#################### Scheduler methods
+
+
+def scheduler_lease_partitions(scheduler_id, partition_count, ttl,
+                               host=None):
+    """Renew the scheduler's lease on its share of partition_count
+    partitions for ttl seconds and return the partitions it holds.
+
+    Each live scheduler's share is an equal split of the partitions.
+    A scheduler holding more than its share gives up the rest, and one
+    holding less takes partitions nobody holds, including those whose
+    scheduler stopped renewing them. The renewal is one transaction with
+    the leases locked, and a partition is only ever taken with a
+    conditional write, so no two schedulers hold it at once.
+    """
+    now = timeutils.utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    schedulers = models.Scheduler.__table__
+    leases = models.SchedulerLease.__table__
+    session = get_session()
+    with session.begin():
+        result = session.execute(
+            schedulers.update()
+                .where(schedulers.c.id == scheduler_id)
+                .values(host=host, expires_at=expires_at, updated_at=now))
+        if result.rowcount == 0:
+            session.execute(schedulers.insert().values(
+                id=scheduler_id, host=host, expires_at=expires_at,
+                created_at=now, updated_at=now))
+        session.execute(schedulers.delete()
+                            .where(schedulers.c.expires_at <= now))
+        live = session.execute(
+            sa_sql.select([sa_sql.func.count(schedulers.c.id)],
+                          schedulers.c.expires_at > now)).scalar()
+        share = db_utils.lease_share(partition_count, live)
+
+        # NOTE: the leases are locked, so another scheduler renewing at
+        # the same time waits to see which partitions this one takes
+        query = sa_sql.select([leases], for_update=True)
+        rows = [dict(row) for row in session.execute(query)]
+        mine = sorted(row['partition_number'] for row in rows
+                      if row['scheduler_id'] == scheduler_id and
+                      row['expires_at'] > now)
+        held = [partition for partition in mine
+                if partition < partition_count][:share]
+        released = [partition for partition in mine
+                    if partition not in held]
+        if released:
+            session.execute(
+                leases.delete()
+                    .where(leases.c.scheduler_id == scheduler_id)
+                    .where(leases.c.partition_number.in_(released)))
+        if held:
+            session.execute(
+                leases.update()
+                    .where(leases.c.scheduler_id == scheduler_id)
+                    .where(leases.c.partition_number.in_(held))
+                    .values(expires_at=expires_at, updated_at=now))
+
+        taken = set(row['partition_number'] for row in rows
+                    if row['expires_at'] > now)
+        existing = set(row['partition_number'] for row in rows)
+        for partition in range(partition_count):
+            if len(held) >= share:
+                break
+            if partition in taken:
+                continue
+            if _scheduler_lease_take(session, scheduler_id, partition,
+                                     partition in existing, now, expires_at):
+                held.append(partition)
+
+        # NOTE: read back, as a lease which ran out meanwhile may be lost
+        query = sa_sql.select([leases.c.partition_number],
+                              sa_sql.and_(
+                                  leases.c.scheduler_id == scheduler_id,
+                                  leases.c.expires_at > now))
+        partitions = sorted(row[0] for row in session.execute(query))
+
+    return partitions
+
+
+def _scheduler_lease_take(session, scheduler_id, partition, existing, now,
+                          expires_at):
+    leases = models.SchedulerLease.__table__
+    if existing:
+        result = session.execute(
+            leases.update()
+                .where(leases.c.partition_number == partition)
+                .where(leases.c.expires_at <= now)
+                .values(scheduler_id=scheduler_id, expires_at=expires_at,
+                        updated_at=now))
+        return result.rowcount == 1
+
+    try:
+        session.execute(leases.insert().values(
+            id=uuidutils.generate_uuid(), partition_number=partition,
+            scheduler_id=scheduler_id, expires_at=expires_at,
+            created_at=now, updated_at=now))
+    except sqlalchemy.exc.IntegrityError:
+        # NOTE: taken by another scheduler since it was read
+        return False
+    return True
+
+
+def scheduler_lease_release(scheduler_id):
+    """Give up every partition the scheduler holds."""
+    schedulers = models.Scheduler.__table__
+    leases = models.SchedulerLease.__table__
+    session = get_session()
+    with session.begin():
+        session.execute(leases.delete()
+                            .where(leases.c.scheduler_id == scheduler_id))
+        session.execute(schedulers.delete()
+                            .where(schedulers.c.id == scheduler_id))
+
+
 #################### Job methods
 
 
-@force_dict
 def job_create(job_values):
+    """Create a job, or if a job was already created for the same
+    schedule_id and scheduled_run, return that job instead."""
     db_utils.validate_job_values(job_values)
     values = job_values.copy()
     session = get_session()
     job_ref = models.Job()
-
-    if 'job_metadata' in values:
-        metadata = values['job_metadata']
+    metadata = values.pop('job_metadata', [])
+    if not CONF.sql_inline_metadata:
         _set_job_metadata(job_ref, metadata)
-        del values['job_metadata']
-
+    job_ref.update(_metadata_column_values(
+        models.Job.__table__,
+        dict((meta['key'], meta['value']) for meta in metadata)))
     job_ref.update(values)
-    job_ref.save(session=session)
 
-    return _job_get_by_id(job_ref['id'])
+    try:
+        with session.begin():
+            job_ref.save(session=session)
+    except sqlalchemy.exc.IntegrityError:
+        job_id = _job_id_get_by_run(values.get('schedule_id'),
+                                    values.get('scheduled_run'))
+        if job_id is None:
+            raise
+        return job_get_by_id(job_id, consistent=True)
 
+    return _parent_ref_to_dict(job_ref, 'job_metadata', 'job_id')
 
-@force_dict
-def job_get_all(params={}):
-    session = get_session()
-    query = session.query(models.Job)\
-                   .options(sa_orm.subqueryload('job_metadata'))
 
-    marker_job = None
-    if params.get('marker') is not None:
-        marker_job = _job_get_by_id(params['marker'])
+def _job_id_get_by_run(schedule_id, scheduled_run):
+    if schedule_id is None or scheduled_run is None:
+        return None
+    jobs = models.Job.__table__
+    query = sa_sql.select([jobs.c.id],
+                          sa_sql.and_(jobs.c.schedule_id == schedule_id,
+                                      jobs.c.scheduled_run == scheduled_run))
+    return get_session().execute(query).scalar()
+
 
-    query = paginate_query(query, models.Job, ['id'],
-                           limit=params.get('limit'), marker=marker_job)
+def job_get_all(params={}, consistent=False):
+    session = _read_session(consistent)
+    jobs = models.Job.__table__
+    query = sa_sql.select([jobs])
 
-    return query.all()
+    marker_job = _marker_get(session, jobs, params)
+    query = paginate_select(query, jobs, ['id'],
+                            limit=params.get('limit'), marker=marker_job)
+
+    return _jobs_get_dicts(session, query)
+
+
+def _jobs_get_dicts(session, query):
+    """Run a select on the jobs table and return the rows as dicts,
+    each with its job_metadata attached."""
+    jobs = [dict(row) for row in session.execute(query)]
+    if not jobs:
+        return []
+
+    _attach_job_metadata(session, jobs)
+    return jobs
+
+
+def _attach_job_metadata(session, jobs):
+    _attach_metadata(jobs, 'job_metadata', 'job_id',
+                     functools.partial(_job_metadata_get_by_job_ids, session))
+
+
+def _job_get_dict_by_id(job_id, session=None):
+    session = session or get_session()
+    jobs = models.Job.__table__
+    query = sa_sql.select([jobs], jobs.c.id == job_id)
+    found = _jobs_get_dicts(session, query)
+    if not found:
+        raise exception.NotFound()
+    return found[0]
 
 
 def _job_get_by_id(job_id, session=None):
     session = session or get_session()
+    query = session.query(models.Job)
+    if not CONF.sql_inline_metadata:
+        query = query.options(sa_orm.joinedload('job_metadata'))
     try:
-        job = session.query(models.Job)\
-                     .options(sa_orm.subqueryload('job_metadata'))\
-                     .filter_by(id=job_id)\
-                     .one()
+        job = query.filter_by(id=job_id).one()
     except sa_orm.exc.NoResultFound:
         raise exception.NotFound()
 
     return job
 
 
-@force_dict
-def job_get_by_id(job_id):
-    return _job_get_by_id(job_id)
+def job_get_by_id(job_id, consistent=False):
+    return _job_get_dict_by_id(job_id, _read_session(consistent))
 
 
 def job_updated_at_get_by_id(job_id):
-    return _job_get_by_id(job_id)['updated_at']
+    jobs = models.Job.__table__
+    query = sa_sql.select([jobs.c.updated_at], jobs.c.id == job_id)
+    updated_at = get_session().execute(query).scalar()
+    if updated_at is None:
+        raise exception.NotFound()
+    return updated_at
 
 
-@force_dict
-def job_get_and_assign_next_by_action(action, worker_id, max_retry):
+def job_get_and_assign_next_by_action(action, worker_id, max_retry,
+                                      new_timeout=None):
     """Get the next available job for the given action and assign it
     to the worker for worker_id.
     This must be an atomic action!"""
+    jobs = jobs_get_and_assign_next_by_action(action, worker_id,
+                                              max_retry, 1, new_timeout)
+    return jobs[0] if jobs else None
+
+
+def jobs_get_and_assign_next_by_action(action, worker_id, max_retry,
+                                       max_jobs, new_timeout=None):
+    """Get up to max_jobs available jobs for the given action and assign
+    them to the worker for worker_id, oldest first.
+
+    If new_timeout is given the jobs are leased to the worker until then,
+    so no other worker claims them in the meantime.
+    This must be an atomic action!"""
     now = timeutils.utcnow()
     session = get_session()
-    job_id = None
-    try:
-        job_ref = _job_get_next_by_action(session, now, action, max_retry)
+    with session.begin():
+        if _supports_skip_locked(_ENGINE.dialect):
+            jobs = _jobs_claim_next_skip_locked(session, now, action,
+                                                worker_id, max_retry,
+                                                max_jobs, new_timeout)
+        else:
+            jobs = _jobs_claim_next_conditional(session, now, action,
+                                                worker_id, max_retry,
+                                                max_jobs, new_timeout)
+        if not jobs:
+            return []
 
-        if job_ref is None:
-            return None
+        _attach_job_metadata(session, jobs)
+
+    return jobs
+
+
+def jobs_create_for_due_schedules(next_run_before, default_timeout,
+                                  action_timeouts={}, partitions=None,
+                                  partition_count=None):
+    """Queue a job for every schedule due to run by next_run_before and
+    move each of those schedules on to its next run, in one transaction.
+
+    Job timeouts are given in seconds per action, falling back to
+    default_timeout. If partitions are given, only schedules in those of
+    partition_count partitions are queued. Returns the ids of the created
+    jobs.
+    """
+    now = timeutils.utcnow()
+    schedules_table = models.Schedule.__table__
+    schedule_metadata = models.ScheduleMetadata.__table__
+    jobs_table = models.Job.__table__
+    job_metadata = models.JobMetadata.__table__
+
+    due = schedules_table.c.next_run <= next_run_before
+    if partitions is not None:
+        due = sa_sql.and_(due, _partition_criteria(schedules_table,
+                                                   partitions,
+                                                   partition_count))
+    session = get_session()
+    with session.begin():
+        query = sa_sql.select([schedules_table], due, for_update=True)
+        schedules = [dict(row) for row in session.execute(query)]
+        if not schedules:
+            return []
+
+        due_ids = sa_sql.select([schedules_table.c.id], due)
+        # NOTE: the job for a run may already have been created alone
+        query = sa_sql.select(
+            [jobs_table.c.schedule_id, jobs_table.c.scheduled_run],
+            sa_sql.and_(jobs_table.c.schedule_id.in_(due_ids),
+                        jobs_table.c.scheduled_run != None))
+        created_runs = set((row['schedule_id'], row['scheduled_run'])
+                           for row in session.execute(query))
+
+        metadata = {}
+        if not CONF.sql_inline_metadata:
+            query = sa_sql.select(
+                [schedule_metadata],
+                schedule_metadata.c.schedule_id.in_(due_ids))
+            for row in session.execute(query):
+                metadata.setdefault(row['schedule_id'], []).append(row)
+
+        jobs = []
+        jobs_metadata = []
+        schedule_updates = []
+        next_runs = cron.next_runs(schedules, start_time=now)
+        for schedule, next_run in zip(schedules, next_runs):
+            schedule_updates.append({'schedule_id': schedule['id'],
+                                     'new_next_run': next_run})
+            if (schedule['id'], schedule['next_run']) in created_runs:
+                continue
+
+            inline_metadata = None
+            if CONF.sql_inline_metadata:
+                inline_metadata = schedule['inline_metadata']
+            timeout = now + datetime.timedelta(
+                seconds=action_timeouts.get(schedule['action'],
+                                            default_timeout))
+            job_id = uuidutils.generate_uuid()
+            jobs.append({'id': job_id,
+                         'created_at': now,
+                         'updated_at': now,
+                         'schedule_id': schedule['id'],
+                         'tenant': schedule['tenant'],
+                         'worker_id': None,
+                         'status': 'queued',
+                         'action': schedule['action'],
+                         'retry_count': 0,
+                         'timeout': timeout,
+                         'hard_timeout': timeout,
+                         'scheduled_run': schedule['next_run'],
+                         'inline_metadata': inline_metadata})
+            for meta in metadata.get(schedule['id'], []):
+                jobs_metadata.append({'id': uuidutils.generate_uuid(),
+                                      'created_at': now,
+                                      'updated_at': now,
+                                      'job_id': job_id,
+                                      'key': meta['key'],
+                                      'value': meta['value']})
+
+        if jobs:
+            session.execute(jobs_table.insert(), jobs)
+        if jobs_metadata:
+            session.execute(job_metadata.insert(), jobs_metadata)
+        session.execute(
+            schedules_table.update()
+                .where(schedules_table.c.id ==
+                       sa_sql.bindparam('schedule_id'))
+                .values(next_run=sa_sql.bindparam('new_next_run'),
+                        last_scheduled=now,
+                        updated_at=now),
+            schedule_updates)
+
+    return [job['id'] for job in jobs]
+
+
+def _mysql_server_version(version_info):
+    """Return the numeric version of a MySQL server, and whether it is
+    MariaDB, from the dialect's server_version_info.
+
+    MariaDB 10 and later may be reported behind the '5.5.5-' prefix it
+    gives for replication, e.g. '5.5.5-10.6.12-MariaDB' is parsed as
+    (5, 5, 5, 10, 6, 12, 'MariaDB').
+    """
+    mariadb = any(isinstance(part, basestring) and
+                  'mariadb' in part.lower() for part in version_info)
+    version = []
+    for part in version_info:
+        if not isinstance(part, (int, long)):
+            break
+        version.append(part)
+    if mariadb and version[:3] == [5, 5, 5] and len(version) > 3:
+        version = version[3:]
+    return tuple(version), mariadb
+
+
+def _supports_skip_locked(dialect):
+    """Return True if the database can skip rows locked by others."""
+    version = dialect.server_version_info or ()
+    if dialect.name == 'postgresql':
+        return version >= (9, 5)
+    if dialect.name == 'mysql':
+        version, mariadb = _mysql_server_version(version)
+        if mariadb:
+            return version >= (10, 6)
+        return version >= (8, 0)
+    return False
+
+
+class _SkipLockedSelect(sa_sql.expression.Select):
+    """A SELECT ... FOR UPDATE which skips rows locked by other claimers."""
+
+
+@sa_compiler.compiles(_SkipLockedSelect)
+def _compile_skip_locked_select(element, compiler, **kw):
+    return compiler.visit_select(element, **kw) + ' SKIP LOCKED'
 
-        job_ref.update({'worker_id': worker_id,
-                        'retry_count': job_ref['retry_count'] + 1})
-        job_id = job_ref['id']
-        job_ref.save(session)
-    except sa_orm.exc.NoResultFound:
-        raise exception.NotFound()
 
-    return _job_get_by_id(job_id)
+def _job_claimable_criteria(now, action, max_retry):
+    jobs = models.Job.__table__
+    return sa_sql.and_(jobs.c.action == action,
+                       jobs.c.retry_count < max_retry,
+                       jobs.c.hard_timeout > now,
+                       sa_sql.or_(jobs.c.worker_id == None,
+                                  jobs.c.timeout <= now))
 
 
-def _job_get_next_by_action(session, now, action, max_retry):
-    job_ref = session.query(models.Job)\
-        .options(sa_orm.subqueryload('job_metadata'))\
-        .filter_by(action=action)\
-        .filter(models.Job.retry_count < max_retry)\
-        .filter(models.Job.hard_timeout > now)\
-        .filter(sa_sql.or_(models.Job.worker_id == None,
-                           models.Job.timeout <= now))\
-        .with_lockmode('update')\
-        .order_by(models.Job.created_at.asc())\
-        .first()
-    return job_ref
+def _job_claim_values(job, worker_id, now, new_timeout):
+    values = {'worker_id': worker_id,
+              'retry_count': job['retry_count'] + 1,
+              'updated_at': now}
+    if new_timeout is not None:
+        values['timeout'] = new_timeout
+    return values
 
 
-def _jobs_cleanup_hard_timed_out():
-    """Find all jobs with hard_timeout values which have passed
-    and delete them, logging the timeout / failure as appropriate"""
+def _jobs_claim_next_skip_locked(session, now, action, worker_id, max_retry,
+                                 max_jobs, new_timeout):
+    """Lock and assign the oldest claimable jobs nobody else has locked.
+
+    Concurrent claimers each lock different rows instead of queueing
+    up behind the oldest one.
+    """
+    jobs_table = models.Job.__table__
+    query = _SkipLockedSelect([jobs_table],
+                              _job_claimable_criteria(now, action, max_retry),
+                              order_by=[jobs_table.c.created_at.asc()],
+                              limit=max_jobs,
+                              for_update=True)
+    jobs = [dict(row) for row in session.execute(query)]
+    if not jobs:
+        return []
+
+    values = {'worker_id': worker_id,
+              'retry_count': jobs_table.c.retry_count + 1,
+              'updated_at': now}
+    if new_timeout is not None:
+        values['timeout'] = new_timeout
+    session.execute(jobs_table.update()
+                        .where(jobs_table.c.id.in_([j['id'] for j in jobs]))
+                        .values(**values))
+    for job in jobs:
+        job.update(_job_claim_values(job, worker_id, now, new_timeout))
+    return jobs
+
+
+def _job_claim_candidates(session, now, action, max_retry, limit):
+    jobs = models.Job.__table__
+    query = sa_sql.select([jobs],
+                          _job_claimable_criteria(now, action, max_retry),
+                          order_by=[jobs.c.created_at.asc()],
+                          limit=limit)
+    return [dict(row) for row in session.execute(query)]
+
+
+def _jobs_claim_next_conditional(session, now, action, worker_id, max_retry,
+                                 max_jobs, new_timeout):
+    """Assign the oldest claimable jobs using conditional UPDATEs.
+
+    Used where the database cannot skip locked rows (e.g. SQLite). Each
+    candidate is only taken if it is still claimable and its retry_count
+    has not moved since it was read, so a candidate won by a concurrent
+    claimer is passed over rather than assigned twice.
+    """
+    jobs_table = models.Job.__table__
+    candidates = _job_claim_candidates(session, now, action, max_retry,
+                                       max_jobs + _CLAIM_CANDIDATES)
+    jobs = []
+    for job in candidates:
+        values = _job_claim_values(job, worker_id, now, new_timeout)
+        result = session.execute(
+            jobs_table.update()
+                .where(jobs_table.c.id == job['id'])
+                .where(jobs_table.c.retry_count == job['retry_count'])
+                .where(_job_claimable_criteria(now, action, max_retry))
+                .values(**values))
+        if result.rowcount == 1:
+            job.update(values)
+            jobs.append(job)
+            if len(jobs) == max_jobs:
+                break
+
+    return jobs
+
+
+def jobs_delete_hard_timed_out(limit, record_faults=False):
+    """Delete up to limit abandoned jobs, along with their metadata, in
+    one short transaction.
+
+    A job is abandoned once both its timeout and its hard timeout have
+    passed without it finishing. Finished jobs are left to the archiver.
+
+    Returns the number of jobs deleted, so fewer than limit means none
+    are left. If record_faults is set a fault is saved for each job.
+    """
     now = timeutils.utcnow()
+    jobs_table = models.Job.__table__
+    job_metadata = models.JobMetadata.__table__
     session = get_session()
-    num_del = session.query(models.Job)\
-        .filter(models.Job.hard_timeout <= now)\
-        .delete()
-    session.flush()
-    return num_del
+    with session.begin():
+        abandoned = sa_sql.and_(
+            jobs_table.c.hard_timeout <= now,
+            jobs_table.c.timeout <= now,
+            sa_sql.or_(jobs_table.c.status == None,
+                       sa_sql.not_(jobs_table.c.status.in_(
+                           db_utils.FINISHED_JOB_STATUSES))))
+        query = sa_sql.select([jobs_table],
+                              abandoned,
+                              order_by=[jobs_table.c.hard_timeout.asc()],
+                              limit=limit,
+                              for_update=True)
+        jobs = [dict(row) for row in session.execute(query)]
+        if not jobs:
+            return 0
+
+        job_ids = [job['id'] for job in jobs]
+        if record_faults:
+            _attach_job_metadata(session, jobs)
+            faults = [db_utils.hard_timeout_fault_values(
+                          job, job['job_metadata'])
+                      for job in jobs]
+            session.execute(models.JobFault.__table__.insert(), faults)
+
+        if not CONF.sql_inline_metadata:
+            session.execute(job_metadata.delete()
+                                .where(job_metadata.c.job_id.in_(job_ids)))
+        session.execute(jobs_table.delete()
+                            .where(jobs_table.c.id.in_(job_ids)))
+
+    return len(jobs)
 
 
-@force_dict
 def job_update(job_id, job_values):
     # make a copy so we can remove 'job_metadata'
     # without affecting the caller
     values = job_values.copy()
     session = get_session()
-    job_ref = _job_get_by_id(job_id, session)
+    with session.begin():
+        job_ref = _job_get_by_id(job_id, session)
 
-    if 'job_metadata' in values:
-        metadata = values.pop('job_metadata')
-        _job_metadata_update_in_place(job_ref, metadata)
+        if 'job_metadata' in values:
+            metadata = values.pop('job_metadata')
+            if not CONF.sql_inline_metadata:
+                _job_metadata_update_in_place(job_ref, metadata)
+            _ref_metadata_columns_update(session, job_ref, metadata)
 
-    job_ref.update(values)
-    job_ref.save(session=session)
-    return _job_get_by_id(job_id)
+        job_ref.update(values)
+        job_ref.save(session=session)
+
+    return _parent_ref_to_dict(job_ref, 'job_metadata', 'job_id')
 
 
 def _job_metadata_update_in_place(job, metadata):
@@ -693,46 +1582,40 @@ def _job_metadata_update_in_place(job, metadata):
 
 def job_delete(job_id):
     session = get_session()
-    job_ref = _job_get_by_id(job_id)
-    job_ref.delete(session=session)
+    with session.begin():
+        job_ref = _job_get_by_id(job_id, session)
+        job_ref.delete(session=session)
 
 
 def _set_job_metadata(job_ref, metadata):
+    job_metadata = job_ref.job_metadata
     for metadatum in metadata:
         metadata_ref = models.JobMetadata()
         metadata_ref.update(metadatum)
-        job_ref.job_metadata.append(metadata_ref)
+        job_metadata.append(metadata_ref)
 
 
-@force_dict
 def job_meta_create(job_id, values):
+    if CONF.sql_inline_metadata:
+        return _inline_meta_create(models.Job.__table__, 'job_id', job_id,
+                                   values)
+
     values['job_id'] = job_id
     session = get_session()
     meta_ref = models.JobMetadata()
     meta_ref.update(values)
 
     try:
-        meta_ref.save(session=session)
+        with session.begin():
+            meta_ref.save(session=session)
     except sqlalchemy.exc.IntegrityError:
         raise exception.Duplicate()
 
-    return _job_meta_get_by_id(meta_ref['id'])
-
-
-def _job_meta_get_by_id(meta_id):
-    session = get_session()
-    try:
-        meta = session.query(models.JobMetadata)\
-                      .filter_by(id=meta_id)\
-                      .one()
-    except sa_orm.exc.NoResultFound:
-        raise exception.NotFound()
-
-    return meta
+    return _ref_to_dict(meta_ref)
 
 
-def _job_meta_get_all_by_job_id(job_id):
-    session = get_session()
+def _job_meta_get_all_by_job_id(job_id, session=None):
+    session = session or get_session()
     try:
         meta = session.query(models.JobMetadata)\
                       .filter_by(job_id=job_id)\
@@ -743,6 +1626,17 @@ def _job_meta_get_all_by_job_id(job_id):
     return meta
 
 
+def _job_metadata_get_by_job_ids(session, job_ids):
+    """Return a dict of job id to the metadata of that job."""
+    job_metadata = models.JobMetadata.__table__
+    query = sa_sql.select([job_metadata],
+                          job_metadata.c.job_id.in_(job_ids))
+    metadata = {}
+    for row in session.execute(query):
+        metadata.setdefault(row['job_id'], []).append(dict(row))
+    return metadata
+
+
 def _job_meta_get(job_id, key):
     session = get_session()
     try:
@@ -756,34 +1650,115 @@ def _job_meta_get(job_id, key):
     return meta
 
 
-@force_dict
-def job_meta_get_all_by_job_id(job_id):
-    return _job_meta_get_all_by_job_id(job_id)
+def job_meta_get_all_by_job_id(job_id, consistent=False):
+    session = _read_session(consistent)
+    if CONF.sql_inline_metadata:
+        return _inline_meta_get_all(session, models.Job.__table__, 'job_id',
+                                    job_id)
+    return force_dict(_job_meta_get_all_by_job_id)(job_id, session)
 
 
-@force_dict
 def job_metadata_update(job_id, values):
+    if CONF.sql_inline_metadata:
+        return _inline_metadata_update(models.Job.__table__, 'job_id',
+                                       job_id, values)
+
     session = get_session()
-    job = _job_get_by_id(job_id, session)
-    _job_metadata_update_in_place(job, values)
+    with session.begin():
+        job = _job_get_by_id(job_id, session)
+        _job_metadata_update_in_place(job, values)
+        job.save(session=session)
 
-    job.save(session=session)
+    return [_ref_to_dict(meta) for meta in job.job_metadata]
 
-    return job_meta_get_all_by_job_id(job_id)
 
+##################### Job archive methods
 
-##################### Job fault methods
 
-def job_fault_latest_for_job_id(job_id):
+def jobs_archive_finished(finished_before, limit):
+    """Move up to limit jobs which finished before finished_before, and
+    their metadata, from the jobs table to job_archive in one short
+    transaction.
+
+    Returns the number of jobs moved, so fewer than limit means none
+    are left.
+    """
+    jobs_table = models.Job.__table__
+    job_metadata = models.JobMetadata.__table__
     session = get_session()
-    try:
-        job_fault = session.query(models.JobFault)\
-            .filter_by(job_id=job_id)\
-            .order_by(models.JobFault.created_at.desc())\
-            .one()
-        return job_fault
-    except sa_orm.exc.NoResultFound:
-        return None
+    with session.begin():
+        finished = jobs_table.c.status.in_(db_utils.FINISHED_JOB_STATUSES)
+        query = sa_sql.select(
+            [jobs_table],
+            sa_sql.and_(finished,
+                        jobs_table.c.updated_at <= finished_before),
+            order_by=[jobs_table.c.updated_at.asc()],
+            limit=limit,
+            for_update=True)
+        jobs = [dict(row) for row in session.execute(query)]
+        if not jobs:
+            return 0
+
+        job_ids = [job['id'] for job in jobs]
+        _attach_job_metadata(session, jobs)
+        archived = [db_utils.archived_job_values(job, job['job_metadata'])
+                    for job in jobs]
+        session.execute(models.JobArchive.__table__.insert(), archived)
+        if not CONF.sql_inline_metadata:
+            session.execute(job_metadata.delete()
+                                .where(job_metadata.c.job_id.in_(job_ids)))
+        session.execute(jobs_table.delete()
+                            .where(jobs_table.c.id.in_(job_ids)))
+
+    return len(jobs)
+
+
+def job_archive_get_all(params={}, consistent=False):
+    session = _read_session(consistent)
+    archive = models.JobArchive.__table__
+    query = sa_sql.select([archive])
+
+    if params.get('schedule_id') is not None:
+        query = query.where(archive.c.schedule_id == params['schedule_id'])
+
+    if params.get('tenant') is not None:
+        query = query.where(archive.c.tenant == params['tenant'])
+
+    marker_job = _marker_get(session, archive, params)
+    query = paginate_select(query, archive, ['id'],
+                            limit=params.get('limit'), marker=marker_job)
+
+    return [db_utils.archived_job_to_dict(row)
+            for row in session.execute(query)]
+
+
+##################### Job fault methods
+
+def job_fault_latest_for_job_id(job_id, consistent=False):
+    session = _read_session(consistent)
+    faults = models.JobFault.__table__
+    query = sa_sql.select([faults], faults.c.job_id == job_id,
+                          order_by=[faults.c.created_at.desc(),
+                                    faults.c.id.desc()],
+                          limit=1)
+    row = session.execute(query).first()
+    return dict(row) if row is not None else None
+
+
+def job_fault_get_all(params={}, consistent=False):
+    session = _read_session(consistent)
+    faults = models.JobFault.__table__
+    query = sa_sql.select([faults])
+
+    for key in ('job_id', 'schedule_id', 'tenant', 'action'):
+        if params.get(key) is not None:
+            query = query.where(faults.c[key] == params[key])
+
+    marker_fault = _marker_get(session, faults, params)
+    query = paginate_select(query, faults, ['id'],
+                            limit=params.get('limit'), marker=marker_fault)
+
+    return [dict(row) for row in session.execute(query)]
 
 
 @force_dict
@@ -792,6 +1767,7 @@ def job_fault_create(values):
     job_fault_ref = models.JobFault()
     job_fault_ref.update(values)
 
-    job_fault_ref.save(session=session)
+    with session.begin():
+        job_fault_ref.save(session=session)
 
     return job_fault_ref
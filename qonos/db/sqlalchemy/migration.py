@@ -0,0 +1,289 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Versioned schema migrations for the SQLAlchemy backend.
+
+register_models() only creates tables which do not exist yet, so changes
+to existing tables are made here. The current version is kept in the
+schema_version table. Each migration only makes changes which are not
+already present, so a database freshly created from the models is
+brought up to date by running all of them.
+"""
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table
+from sqlalchemy.engine import reflection
+import sqlalchemy.sql as sa_sql
+
+from qonos.common import exception
+import qonos.db.db_utils as db_utils
+from qonos.db.sqlalchemy import models
+from qonos.openstack.common.gettextutils import _
+from qonos.openstack.common import jsonutils
+import qonos.openstack.common.log as os_logging
+
+
+LOG = os_logging.getLogger(__name__)
+
+_VERSION_META = MetaData()
+_VERSION_TABLE = Table('schema_version', _VERSION_META,
+                       Column('repository', String(64), primary_key=True),
+                       Column('version', Integer, nullable=False),
+                       mysql_engine='InnoDB')
+_REPOSITORY = 'qonos'
+
+
+def _create_indexes(engine, model, names):
+    """Create the named indexes of a model which do not exist yet."""
+    table = model.__table__
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set(index['name'] for index in
+                   inspector.get_indexes(table.name))
+    for index in table.indexes:
+        if index.name in names and index.name not in existing:
+            LOG.info(_('Creating index %s') % index.name)
+            index.create(engine)
+
+
+def _drop_indexes(engine, model, names):
+    """Drop the named indexes of a model's table which exist."""
+    table_name = model.__tablename__
+    inspector = reflection.Inspector.from_engine(engine)
+    for index in inspector.get_indexes(table_name):
+        if index['name'] in names:
+            LOG.info(_('Dropping index %s') % index['name'])
+            # NOTE: built on a stand-in table, so the model's own table
+            # does not take on the dropped index
+            table = Table(table_name, MetaData(),
+                          *[Column(name, String(255))
+                            for name in index['column_names']])
+            Index(index['name'], *table.columns).drop(engine)
+
+
+def _add_columns(engine, model, names):
+    """Add the named columns of a model which do not exist yet.
+
+    Only nullable columns without server defaults can be added this way.
+    """
+    table = model.__table__
+    inspector = reflection.Inspector.from_engine(engine)
+    existing = set(column['name'] for column in
+                   inspector.get_columns(table.name))
+    preparer = engine.dialect.identifier_preparer
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        LOG.info(_('Adding column %(table)s.%(column)s') %
+                 {'table': table.name, 'column': name})
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' %
+                       (preparer.format_table(table),
+                        preparer.format_column(column),
+                        column.type.compile(engine.dialect)))
+
+
+def _migrate_001_hot_query_indexes(engine):
+    _create_indexes(engine, models.Schedule,
+                    ['ix_schedules_next_run', 'ix_schedules_tenant'])
+    _create_indexes(engine, models.Job,
+                    ['ix_jobs_action_created_at', 'ix_jobs_hard_timeout',
+                     'ix_jobs_schedule_id'])
+    _create_indexes(engine, models.JobFault,
+                    ['ix_job_faults_job_id_created_at'])
+
+
+def _migrate_002_job_archive(engine):
+    models.JobArchive.__table__.create(engine, checkfirst=True)
+    _create_indexes(engine, models.Job, ['ix_jobs_status_updated_at'])
+
+
+def _migrate_003_inline_metadata(engine):
+    _add_columns(engine, models.Schedule, ['inline_metadata'])
+    _add_columns(engine, models.Job, ['inline_metadata'])
+
+
+def _migrate_004_schedule_instance_id(engine):
+    _add_columns(engine, models.Schedule, ['instance_id'])
+    _create_indexes(engine, models.Schedule, ['ix_schedules_instance_id'])
+
+    schedules = models.Schedule.__table__
+    schedule_metadata = models.ScheduleMetadata.__table__
+    instance_id = sa_sql.select(
+        [schedule_metadata.c.value],
+        sa_sql.and_(schedule_metadata.c.schedule_id == schedules.c.id,
+                    schedule_metadata.c.key == 'instance_id')).as_scalar()
+    with engine.begin() as conn:
+        conn.execute(schedules.update()
+                         .where(schedules.c.instance_id == None)
+                         .values(instance_id=instance_id,
+                                 updated_at=schedules.c.updated_at))
+
+        query = sa_sql.select([schedules.c.id, schedules.c.inline_metadata],
+                              sa_sql.and_(schedules.c.instance_id == None,
+                                          schedules.c.inline_metadata != None))
+        updates = []
+        for row in conn.execute(query):
+            metadata = jsonutils.loads(row['inline_metadata'])
+            if metadata.get('instance_id') is not None:
+                updates.append({'row_id': row['id'],
+                                'new_instance_id': metadata['instance_id']})
+        if updates:
+            conn.execute(
+                schedules.update()
+                    .where(schedules.c.id == sa_sql.bindparam('row_id'))
+                    .values(instance_id=sa_sql.bindparam('new_instance_id'),
+                            updated_at=schedules.c.updated_at),
+                updates)
+
+
+_JOB_FAULT_FILTER_INDEXES = ['ix_job_faults_schedule_id_id',
+                             'ix_job_faults_tenant_id',
+                             'ix_job_faults_action_id']
+
+
+def _migrate_005_job_fault_filter_indexes(engine):
+    _create_indexes(engine, models.JobFault, _JOB_FAULT_FILTER_INDEXES)
+
+
+def _migrate_006_schedule_updated_at_index(engine):
+    _create_indexes(engine, models.Schedule, ['ix_schedules_updated_at'])
+
+
+def _migrate_007_scheduler_leases(engine):
+    models.Scheduler.__table__.create(engine, checkfirst=True)
+    models.SchedulerLease.__table__.create(engine, checkfirst=True)
+    _add_columns(engine, models.Schedule, ['partition_key'])
+
+    schedules = models.Schedule.__table__
+    with engine.begin() as conn:
+        query = sa_sql.select([schedules.c.id],
+                              schedules.c.partition_key == None)
+        updates = [{'row_id': row['id'],
+                    'new_partition_key': db_utils.partition_key(row['id'])}
+                   for row in conn.execute(query)]
+        if updates:
+            conn.execute(
+                schedules.update()
+                    .where(schedules.c.id == sa_sql.bindparam('row_id'))
+                    .values(partition_key=sa_sql.bindparam(
+                                'new_partition_key'),
+                            updated_at=schedules.c.updated_at),
+                updates)
+
+
+def _migrate_008_job_scheduled_run(engine):
+    _add_columns(engine, models.Job, ['scheduled_run'])
+    _create_indexes(engine, models.Job, ['ix_jobs_schedule_id_scheduled_run'])
+
+
+def _migrate_009_job_fault_filter_paging_indexes(engine):
+    # NOTE: version 5 first created single column indexes, which still
+    # sort every matching fault to page through them
+    _drop_indexes(engine, models.JobFault,
+                  ['ix_job_faults_schedule_id', 'ix_job_faults_tenant',
+                   'ix_job_faults_action'])
+    _create_indexes(engine, models.JobFault, _JOB_FAULT_FILTER_INDEXES)
+
+
+MIGRATIONS = [
+    (1, _migrate_001_hot_query_indexes),
+    (2, _migrate_002_job_archive),
+    (3, _migrate_003_inline_metadata),
+    (4, _migrate_004_schedule_instance_id),
+    (5, _migrate_005_job_fault_filter_indexes),
+    (6, _migrate_006_schedule_updated_at_index),
+    (7, _migrate_007_scheduler_leases),
+    (8, _migrate_008_job_scheduled_run),
+    (9, _migrate_009_job_fault_filter_paging_indexes),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def db_version(engine):
+    """Return the schema version of the database, 0 if never migrated."""
+    _VERSION_META.create_all(engine)
+    query = _VERSION_TABLE.select(_VERSION_TABLE.c.repository == _REPOSITORY)
+    row = engine.execute(query).first()
+    return row['version'] if row else 0
+
+
+def _set_db_version(engine, version, new):
+    if new:
+        query = _VERSION_TABLE.insert().values(repository=_REPOSITORY,
+                                               version=version)
+    else:
+        query = _VERSION_TABLE.update()\
+            .where(_VERSION_TABLE.c.repository == _REPOSITORY)\
+            .values(version=version)
+    engine.execute(query)
+
+
+def db_sync(engine, version=None):
+    """
+    Create any missing tables, then upgrade the database schema to
+    version, or to the latest version.
+    """
+    version = LATEST_VERSION if version is None else version
+    if version > LATEST_VERSION:
+        msg = _('Unknown database schema version %s') % version
+        raise exception.Invalid(message=msg)
+
+    models.register_models(engine)
+    current = db_version(engine)
+    for migration_version, migration in MIGRATIONS:
+        if current < migration_version <= version:
+            LOG.info(_('Migrating database schema to version %s')
+                     % migration_version)
+            migration(engine)
+            _set_db_version(engine, migration_version, current == 0)
+            current = migration_version
+    return current
+
+
+def copy_metadata_to_columns(engine):
+    """
+    Fill the inline_metadata column of every schedule and job from the
+    schedule_metadata and job_metadata tables.
+
+    Run this before turning sql_inline_metadata on, while nothing else is
+    writing to the database. Returns the number of rows filled.
+    """
+    total = 0
+    for model, meta_model, parent_key in (
+            (models.Schedule, models.ScheduleMetadata, 'schedule_id'),
+            (models.Job, models.JobMetadata, 'job_id')):
+        table = model.__table__
+        meta_table = meta_model.__table__
+        with engine.begin() as conn:
+            metadata = {}
+            for row in conn.execute(meta_table.select()):
+                metadata.setdefault(row[parent_key], []).append(row)
+
+            updates = [{'row_id': row['id'],
+                        'new_metadata': db_utils.metadata_to_json(
+                            metadata.get(row['id'], []))}
+                       for row in conn.execute(sa_sql.select([table.c.id]))]
+            if updates:
+                conn.execute(
+                    table.update()
+                        .where(table.c.id == sa_sql.bindparam('row_id'))
+                        .values(inline_metadata=sa_sql.bindparam(
+                                    'new_metadata'),
+                                updated_at=table.c.updated_at),
+                    updates)
+        total += len(updates)
+    return total
@@ -21,7 +21,7 @@ SQLAlchemy models for glance data
 
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import ForeignKey, DateTime, Text
+from sqlalchemy import ForeignKey, DateTime, Index, Text
 from sqlalchemy.orm import relationship, backref, object_mapper
 from sqlalchemy import UniqueConstraint
 
@@ -90,6 +90,11 @@ class ModelBase(object):
 class Schedule(BASE, ModelBase):
     """Represents a schedule in the datastore."""
     __tablename__ = 'schedules'
+    __table_args__ = (Index('ix_schedules_next_run', 'next_run'),
+                      Index('ix_schedules_tenant', 'tenant'),
+                      Index('ix_schedules_instance_id', 'instance_id'),
+                      Index('ix_schedules_updated_at', 'updated_at'),
+                      {'mysql_engine': 'InnoDB'})
 
     tenant = Column(String(255), nullable=False)
     action = Column(String(255), nullable=False)
@@ -100,11 +105,20 @@ class Schedule(BASE, ModelBase):
     day_of_week = Column(Integer, nullable=True)
     last_scheduled = Column(DateTime, nullable=True)
     next_run = Column(DateTime, nullable=True)
+    # NOTE: JSON object of the metadata keys and values, used in place of
+    # schedule_metadata rows when sql_inline_metadata is set
+    inline_metadata = Column(Text, nullable=True)
+    # NOTE: copy of the instance_id metadata value, for indexed lookups
+    instance_id = Column(String(255), nullable=True)
+    # NOTE: hash of the id, which places the schedule in a scheduler
+    # partition (see db_utils.partition_key)
+    partition_key = Column(Integer, nullable=True)
 
 
 class ScheduleMetadata(BASE, ModelBase):
     """Represents metadata of a schedule in the datastore."""
     __tablename__ = 'schedule_metadata'
+    # NOTE: the unique constraint also serves lookups by schedule_id
     __table_args__ = (UniqueConstraint('schedule_id', 'key'), {})
 
     schedule_id = Column(String(36),
@@ -126,6 +140,15 @@ class Worker(BASE, ModelBase):
 class Job(BASE, ModelBase):
     """Represents a job in the datastore."""
     __tablename__ = 'jobs'
+    __table_args__ = (Index('ix_jobs_action_created_at', 'action',
+                            'created_at'),
+                      Index('ix_jobs_hard_timeout', 'hard_timeout'),
+                      Index('ix_jobs_schedule_id', 'schedule_id'),
+                      Index('ix_jobs_status_updated_at', 'status',
+                            'updated_at'),
+                      Index('ix_jobs_schedule_id_scheduled_run',
+                            'schedule_id', 'scheduled_run', unique=True),
+                      {'mysql_engine': 'InnoDB'})
 
     schedule_id = Column(String(36))
     tenant = Column(String(36), nullable=False)
@@ -135,11 +158,18 @@ class Job(BASE, ModelBase):
     retry_count = Column(Integer, nullable=False, default=0)
     timeout = Column(DateTime, nullable=False)
     hard_timeout = Column(DateTime, nullable=False)
+    # NOTE: the next_run of the schedule this job was created for. Only
+    # one job is created per schedule and scheduled_run.
+    scheduled_run = Column(DateTime, nullable=True)
+    # NOTE: JSON object of the metadata keys and values, used in place of
+    # job_metadata rows when sql_inline_metadata is set
+    inline_metadata = Column(Text, nullable=True)
 
 
 class JobMetadata(BASE, ModelBase):
     """Represents job metadata in the datastore."""
     __tablename__ = 'job_metadata'
+    # NOTE: the unique constraint also serves lookups by job_id
     __table_args__ = (UniqueConstraint('job_id', 'key'), {})
 
     job_id = Column(String(36), ForeignKey('jobs.id'), nullable=False)
@@ -150,9 +180,34 @@ class JobMetadata(BASE, ModelBase):
                                                        'delete-orphan'))
 
 
+class JobArchive(BASE, ModelBase):
+    """Represents a finished job moved out of the jobs table."""
+    __tablename__ = 'job_archive'
+    __table_args__ = (Index('ix_job_archive_schedule_id', 'schedule_id'),
+                      Index('ix_job_archive_tenant', 'tenant'),
+                      {'mysql_engine': 'InnoDB'})
+
+    schedule_id = Column(String(36))
+    tenant = Column(String(36), nullable=False)
+    worker_id = Column(String(36), nullable=True)
+    status = Column(String(255), nullable=True)
+    action = Column(String(255), nullable=False)
+    retry_count = Column(Integer, nullable=False, default=0)
+    # NOTE: JSON object of the job's metadata keys and values
+    job_metadata = Column(Text, nullable=True)
+
+
 class JobFault(BASE, ModelBase):
     """Represents a job fault in the datastore."""
     __tablename__ = 'job_faults'
+    __table_args__ = (Index('ix_job_faults_job_id_created_at', 'job_id',
+                            'created_at'),
+                      # NOTE: filtered fault listings page by id
+                      Index('ix_job_faults_schedule_id_id', 'schedule_id',
+                            'id'),
+                      Index('ix_job_faults_tenant_id', 'tenant', 'id'),
+                      Index('ix_job_faults_action_id', 'action', 'id'),
+                      {'mysql_engine': 'InnoDB'})
 
     job_id = Column(String(36), nullable=False)
     schedule_id = Column(String(36), nullable=False)
@@ -163,11 +218,31 @@ class JobFault(BASE, ModelBase):
     job_metadata = Column(Text, nullable=True)
 
 
+class Scheduler(BASE, ModelBase):
+    """Represents a running scheduler in the datastore."""
+    __tablename__ = 'schedulers'
+
+    host = Column(String(255), nullable=True)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class SchedulerLease(BASE, ModelBase):
+    """Represents a scheduler's lease on a partition of the schedules."""
+    __tablename__ = 'scheduler_leases'
+    __table_args__ = (UniqueConstraint('partition_number'),
+                      {'mysql_engine': 'InnoDB'})
+
+    partition_number = Column(Integer, nullable=False)
+    scheduler_id = Column(String(36), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
 def register_models(engine):
     """
     Creates database tables for all models with the given engine.
     """
-    models = (Schedule, ScheduleMetadata, Worker, Job, JobFault)
+    models = (Schedule, ScheduleMetadata, Worker, Job, JobArchive, JobFault,
+              Scheduler, SchedulerLease)
     for model in models:
         model.metadata.create_all(engine)
 
@@ -176,6 +251,7 @@ def unregister_models(engine):
     """
     Drops database tables for all models with the given engine.
     """
-    models = (Schedule, ScheduleMetadata, Worker, Job, JobFault)
+    models = (Schedule, ScheduleMetadata, Worker, Job, JobArchive, JobFault,
+              Scheduler, SchedulerLease)
     for model in models:
         model.metadata.drop_all(engine)
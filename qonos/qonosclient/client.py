@@ -15,6 +15,7 @@
 #    under the License.
 
 import httplib
+import urlparse
 
 from qonos.common import utils
 from qonos.openstack.common import log as logging
@@ -75,8 +76,10 @@ class Client(object):
     def delete_worker(self, worker_id):
         self._do_request('DELETE', '/v1/workers/%s' % worker_id)
 
-    def get_next_job(self, worker_id, action):
+    def get_next_job(self, worker_id, action, max_jobs=None):
         body = {'action': action}
+        if max_jobs is not None:
+            body['max_jobs'] = max_jobs
         return self._do_request('POST', '/v1/workers/%s/jobs' % worker_id,
                                 body)
 
@@ -91,6 +94,45 @@ class Client(object):
         schedules = response.get('schedules')
         return schedules
 
+    def list_schedules_page(self, filter_args={}):
+        """Return a page of schedules along with the cursor for the next
+        page, which is None once the last page has been reached."""
+        path = '/v1/schedules%s'
+        query = '?'
+        for key in filter_args:
+            query += ('%s=%s&' % (key, filter_args[key]))
+        response = self._do_request('GET', path % query)
+        cursor = None
+        for link in response.get('schedules_links', []):
+            if link.get('rel') == 'next' and link.get('href'):
+                next_query = urlparse.urlparse(link['href']).query
+                cursor = urlparse.parse_qs(next_query).get('cursor', [None])[0]
+        return response.get('schedules'), cursor
+
+    def get_schedule_load(self, next_run_after=None, next_run_before=None):
+        """Return how many schedules are next due in each minute, as a list
+        of {'minute', 'count'} dicts, by default over the coming day."""
+        path = '/v1/schedules/load%s'
+        query = '?'
+        for key, value in (('next_run_after', next_run_after),
+                           ('next_run_before', next_run_before)):
+            if value is not None:
+                query += ('%s=%s&' % (key, value))
+        return self._do_request('GET', path % query)['load']
+
+    def get_job_forecast(self, start=None, end=None, bucket_minutes=None):
+        """Return how many jobs of each action the schedules will create
+        in each bucket_minutes long bucket from start to end, as a list of
+        {'start', 'end', 'jobs'} dicts, by default hourly over the coming
+        day."""
+        path = '/v1/schedules/forecast%s'
+        query = '?'
+        for key, value in (('start', start), ('end', end),
+                           ('bucket_minutes', bucket_minutes)):
+            if value is not None:
+                query += ('%s=%s&' % (key, value))
+        return self._do_request('GET', path % query)['forecast']
+
     def create_schedule(self, schedule):
         return self._do_request('POST', '/v1/schedules', schedule)['schedule']
 
@@ -105,6 +147,17 @@ class Client(object):
     def delete_schedule(self, schedule_id):
         self._do_request('DELETE', '/v1/schedules/%s' % schedule_id)
 
+    ######## schedulers
+
+    def lease_partitions(self, scheduler_id, host=None):
+        """Renew the scheduler's lease, returning the partitions it holds
+        along with the partition count and the lease ttl in seconds."""
+        path = '/v1/schedulers/%s/lease' % scheduler_id
+        return self._do_request('PUT', path, {'host': host})['lease']
+
+    def release_partitions(self, scheduler_id):
+        self._do_request('DELETE', '/v1/schedulers/%s/lease' % scheduler_id)
+
     ######## schedule metadata
 
     def list_schedule_metadata(self, schedule_id):
@@ -125,10 +178,40 @@ class Client(object):
             query += ('%s=%s&' % (key, params[key]))
         return self._do_request('GET', path % query)['jobs']
 
-    def create_job(self, schedule_id):
+    def list_archived_jobs(self, params={}):
+        path = '/v1/jobs/archive%s'
+        query = '?'
+        for key in params:
+            query += ('%s=%s&' % (key, params[key]))
+        return self._do_request('GET', path % query)['jobs']
+
+    def list_job_faults(self, params={}):
+        path = '/v1/jobs/faults%s'
+        query = '?'
+        for key in params:
+            query += ('%s=%s&' % (key, params[key]))
+        return self._do_request('GET', path % query)['faults']
+
+    def create_job(self, schedule_id, scheduled_run=None):
+        """Create a job for the run of a schedule at scheduled_run, by
+        default its next run. Creating the job for a run again returns
+        the job already created."""
         job = {'job': {'schedule_id': schedule_id}}
+        if scheduled_run is not None:
+            job['job']['scheduled_run'] = scheduled_run
         return self._do_request('POST', 'v1/jobs', job)['job']
 
+    def enqueue_jobs(self, next_run_before=None, partitions=None):
+        """Create jobs for all schedules due by next_run_before on the
+        server, or only those in the given scheduler partitions, and
+        return the ids of the new jobs."""
+        body = {}
+        if next_run_before is not None:
+            body['next_run_before'] = next_run_before
+        if partitions is not None:
+            body['partitions'] = partitions
+        return self._do_request('POST', '/v1/jobs/enqueue', body)['job_ids']
+
     def get_job(self, job_id):
         path = '/v1/jobs/%s' % job_id
         return self._do_request('GET', path)['job']
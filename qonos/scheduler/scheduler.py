@@ -14,13 +14,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
+import heapq
+import socket
 import time
 
+import eventlet
+
 from qonos.common import utils
 from qonos.openstack.common import cfg
 from qonos.openstack.common.gettextutils import _
 import qonos.openstack.common.log as logging
 from qonos.openstack.common import timeutils
+from qonos.openstack.common import uuidutils
+from qonos.qonosclient import exception as client_exc
 
 LOG = logging.getLogger(__name__)
 
@@ -30,16 +37,118 @@ scheduler_opts = [
     cfg.StrOpt('api_endpoint', default='localhost'),
     cfg.IntOpt('api_port', default=8080),
     cfg.BoolOpt('daemonized', default=False),
+    cfg.BoolOpt('bulk_enqueue', default=True,
+                help=_('Have the API create the jobs for all due schedules '
+                       'in one request rather than one request per '
+                       'schedule')),
+    cfg.BoolOpt('schedule_cache', default=True,
+                help=_('Keep the next run times of all schedules in memory, '
+                       'fetching only the schedules changed since the last '
+                       'poll, and enqueue jobs only once a schedule is due')),
+    cfg.IntOpt('schedule_full_sync_interval', default=3600,
+               help=_('Seconds between fetches of every schedule into the '
+                      'schedule cache, which pick up deleted schedules')),
+    cfg.IntOpt('schedule_sync_overlap', default=60,
+               help=_('Seconds before the newest change seen that each '
+                      'sync of the schedule cache looks back from, to catch '
+                      'changes committed out of order')),
+    cfg.IntOpt('enqueue_concurrency', default=10,
+               help=_('Number of jobs created at once when bulk_enqueue is '
+                      'disabled')),
+    cfg.BoolOpt('sharded', default=False,
+                help=_('Lease a share of the schedule partitions from the '
+                       'API and only enqueue jobs for those, so that '
+                       'several schedulers can run at once')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(scheduler_opts, group='scheduler')
 
 
+def _parse_time(value):
+    if value is None:
+        return None
+    return timeutils.normalize_time(timeutils.parse_isotime(value))
+
+
+class ScheduleCache(object):
+    """The next run times of all schedules, in a heap.
+
+    A schedule's heap entry goes stale when its next run changes; stale
+    entries are dropped once they reach the top of the heap.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.next_runs = {}
+        self.heap = []
+        # The latest updated_at of the schedules seen so far
+        self.changed_since = None
+
+    def update(self, schedules):
+        for schedule in schedules:
+            next_run = _parse_time(schedule.get('next_run'))
+            if next_run is None:
+                self.next_runs.pop(schedule['id'], None)
+            elif self.next_runs.get(schedule['id']) != next_run:
+                self.next_runs[schedule['id']] = next_run
+                heapq.heappush(self.heap, (next_run, schedule['id']))
+
+            updated_at = _parse_time(schedule.get('updated_at'))
+            if updated_at is not None and (self.changed_since is None or
+                                           updated_at > self.changed_since):
+                self.changed_since = updated_at
+
+    def _drop_stale(self):
+        while self.heap:
+            next_run, schedule_id = self.heap[0]
+            if self.next_runs.get(schedule_id) == next_run:
+                return
+            heapq.heappop(self.heap)
+
+    def next_due(self):
+        """Return the earliest next run, or None if there are no
+        schedules."""
+        self._drop_stale()
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        """Remove and return the (id, next_run) of the schedules due by
+        now, earliest first.
+
+        Enqueueing their jobs moves them on to their next run, which the
+        next sync brings back into the cache. Runs whose jobs could not be
+        enqueued must be put back with restore.
+        """
+        due = []
+        while self.next_due() is not None and self.heap[0][0] <= now:
+            next_run, schedule_id = heapq.heappop(self.heap)
+            del self.next_runs[schedule_id]
+            due.append((schedule_id, next_run))
+        return due
+
+    def restore(self, due):
+        """Put back (id, next_run) pairs taken by pop_due, unless a sync
+        has since brought a newer next run."""
+        for schedule_id, next_run in due:
+            if schedule_id not in self.next_runs:
+                self.next_runs[schedule_id] = next_run
+                heapq.heappush(self.heap, (next_run, schedule_id))
+
+
 class Scheduler(object):
     def __init__(self, client_factory):
         self.client = client_factory(CONF.scheduler.api_endpoint,
                                      CONF.scheduler.api_port)
+        self.cache = ScheduleCache()
+        self.last_full_sync = None
+        self.scheduler_id = uuidutils.generate_uuid()
+        # The partitions leased when sharded, and the time.time() at which
+        # the lease runs out
+        self.partitions = None
+        self.lease_expires = None
 
     def run(self, run_once=False):
         LOG.debug(_('Starting qonos scheduler service'))
@@ -49,11 +158,20 @@ class Scheduler(object):
             #NOTE(ameade): We need to preserve all open files for logging
             open_files = utils.get_qonos_open_file_log_handlers()
             with daemon.DaemonContext(files_preserve=open_files):
-                self._run_loop(run_once)
+                self._run_sharded_loop(run_once)
         else:
+            self._run_sharded_loop(run_once)
+
+    def _run_sharded_loop(self, run_once=False):
+        try:
             self._run_loop(run_once)
+        finally:
+            self.release_lease()
 
     def _run_loop(self, run_once=False):
+        if CONF.scheduler.schedule_cache:
+            return self._run_cached_loop(run_once)
+
         next_run = None
         current_run = None
 
@@ -62,7 +180,8 @@ class Scheduler(object):
             next_run = time.time() + CONF.scheduler.job_schedule_interval
 
             # do work
-            self.enqueue_jobs(end_time=current_run)
+            if self.renew_lease():
+                self.enqueue_jobs(end_time=current_run)
 
             # do nothing until next run
             seconds = next_run - time.time()
@@ -74,24 +193,222 @@ class Scheduler(object):
             if run_once:
                 break
 
+    def _run_cached_loop(self, run_once=False):
+        while True:
+            # NOTE: times go to the API to the second
+            now = timeutils.utcnow().replace(microsecond=0)
+            not_enqueued = []
+            if self.renew_lease():
+                self.sync_schedules()
+                due = self.cache.pop_due(now)
+                if due:
+                    not_enqueued = self.enqueue_due_jobs(
+                        due, timeutils.isotime(now))
+                    self.cache.restore(not_enqueued)
+
+            # sleep until the next schedule is due, polling for changed
+            # schedules at least every job_schedule_interval. Runs put
+            # back are retried on the next poll, not right away.
+            seconds = CONF.scheduler.job_schedule_interval
+            next_due = self.cache.next_due()
+            if next_due is not None and not not_enqueued:
+                until_due = next_due - timeutils.utcnow()
+                seconds = min(seconds, until_due.days * 86400 +
+                              until_due.seconds +
+                              until_due.microseconds / 1000000.0)
+            if seconds > 0:
+                time.sleep(seconds)
+
+            if run_once:
+                break
+
+    def renew_lease(self):
+        """Renew the lease on this scheduler's partitions when sharded.
+
+        Returns False if there is nothing this scheduler may enqueue jobs
+        for until the next renewal.
+        """
+        if not CONF.scheduler.sharded:
+            return True
+
+        started = time.time()
+        try:
+            lease = self.client.lease_partitions(self.scheduler_id,
+                                                 host=socket.gethostname())
+        except Exception:
+            LOG.exception(_('Failed to renew the scheduler lease'))
+            return False
+
+        if lease['partitions'] != self.partitions:
+            LOG.info(_('Holding %(held)d of %(count)d schedule partitions') %
+                     {'held': len(lease['partitions']),
+                      'count': lease['partition_count']})
+            # NOTE: the cached schedules are of the old partitions
+            self.cache.clear()
+        self.partitions = lease['partitions']
+        self.lease_expires = started + lease['ttl']
+        return bool(self.partitions)
+
+    def release_lease(self):
+        """Hand this scheduler's partitions to the others right away."""
+        if not CONF.scheduler.sharded or not self.partitions:
+            return
+        try:
+            self.client.release_partitions(self.scheduler_id)
+        except Exception:
+            LOG.exception(_('Failed to release the scheduler lease'))
+        self.partitions = None
+
+    def _lease_valid(self):
+        if not CONF.scheduler.sharded:
+            return True
+        if time.time() < self.lease_expires:
+            return True
+        LOG.warn(_('Scheduler lease ran out before jobs were enqueued'))
+        return False
+
+    def _filter_args(self, filter_args):
+        """Limit listed schedules to the leased partitions."""
+        if CONF.scheduler.sharded:
+            filter_args['partitions'] = ','.join(str(partition) for partition
+                                                 in self.partitions)
+        return filter_args
+
+    def _enqueue_bulk(self, end_time):
+        """Returns False if the jobs were not enqueued."""
+        if not self._lease_valid():
+            return False
+        kwargs = {'next_run_before': end_time}
+        if CONF.scheduler.sharded:
+            kwargs['partitions'] = self.partitions
+        job_ids = self.client.enqueue_jobs(**kwargs)
+        LOG.debug(_('Created %d jobs') % len(job_ids))
+        return True
+
+    def sync_schedules(self):
+        """Bring the schedule cache up to date, fetching only the
+        schedules changed since the last sync unless a full sync is due."""
+        now = time.time()
+        full_sync = (self.last_full_sync is None or
+                     self.cache.changed_since is None or
+                     now - self.last_full_sync >=
+                     CONF.scheduler.schedule_full_sync_interval)
+
+        filter_args = self._filter_args({})
+        if not full_sync:
+            # NOTE: a change may commit with an updated_at older than one
+            # already seen, so the sync looks back a little; changes seen
+            # twice are simply applied again
+            overlap = datetime.timedelta(
+                seconds=CONF.scheduler.schedule_sync_overlap)
+            filter_args['changed_since'] = timeutils.isotime(
+                self.cache.changed_since - overlap)
+        schedules = self._list_schedules(filter_args)
+
+        if full_sync:
+            self.cache.clear()
+            self.last_full_sync = now
+        self.cache.update(schedules)
+        LOG.debug(_('Synced %d schedules') % len(schedules))
+
+    def enqueue_due_jobs(self, due, end_time):
+        """Create jobs for the (id, next_run) of the cached schedules
+        found due by end_time.
+
+        Returns the (id, next_run) of the runs whose jobs were not
+        enqueued, to be tried again.
+        """
+        if CONF.scheduler.bulk_enqueue:
+            try:
+                if self._enqueue_bulk(end_time):
+                    return []
+            except Exception:
+                LOG.exception(_('Failed to enqueue jobs'))
+            return due
+
+        if not self._lease_valid():
+            return due
+        next_runs = dict(due)
+        failed = self._create_jobs([[(schedule_id,
+                                      timeutils.isotime(next_run))
+                                     for schedule_id, next_run in due]])
+        return [(schedule_id, next_runs[schedule_id])
+                for schedule_id, _next_run in failed]
+
     def enqueue_jobs(self, start_time=None, end_time=None):
         LOG.debug(_('Creating new jobs'))
-        schedules = self.get_schedules(start_time, end_time)
-        for schedule in schedules:
-            self.client.create_job(schedule['id'])
+        if CONF.scheduler.bulk_enqueue:
+            self._enqueue_bulk(end_time)
+            return
+        if not self._lease_valid():
+            return
+
+        filter_args = self._get_schedule_filter_args(start_time, end_time)
+        self._create_jobs(
+            [(schedule['id'], schedule.get('next_run')) for schedule in page]
+            for page in self._iter_schedule_pages(filter_args))
+
+    def _create_jobs(self, pages):
+        """Create a job for every run in pages, an iterable of lists of
+        (schedule id, next_run). Naming the run each job is for means a
+        job is never created twice for one run, even if another scheduler
+        or a retry gets to it too.
+
+        Each page is handed to a pool of enqueue_concurrency creators as
+        soon as it arrives, and the next page is not fetched until the
+        pool has room, so only about one page is held at a time.
+
+        Returns the (schedule id, next_run) of the runs whose job could
+        not be created, so they can be retried.
+        """
+        pool = eventlet.GreenPool(CONF.scheduler.enqueue_concurrency)
+        created = []
+        failed = []
+        for runs in pages:
+            for schedule_id, next_run in runs:
+                pool.spawn_n(self._create_job, schedule_id, next_run,
+                             created, failed)
+        pool.waitall()
+        LOG.debug(_('Created %d jobs') % len(created))
+        if failed:
+            LOG.warn(_('Failed to create %d jobs') % len(failed))
+        return failed
+
+    def _create_job(self, schedule_id, next_run, created, failed):
+        try:
+            self.client.create_job(schedule_id, next_run)
+            created.append(schedule_id)
+        except client_exc.NotFound:
+            # NOTE: deleted since it was listed
+            pass
+        except Exception:
+            LOG.exception(_('Failed to create a job for schedule %s')
+                          % schedule_id)
+            failed.append((schedule_id, next_run))
 
     def get_schedules(self, start_time=None, end_time=None):
+        filter_args = self._get_schedule_filter_args(start_time, end_time)
+        return self._list_schedules(filter_args)
+
+    def _get_schedule_filter_args(self, start_time, end_time):
         filter_args = {'next_run_before': end_time}
 
         if start_time:
             filter_args['next_run_after'] = start_time
 
-        schedules = self.client.list_schedules(filter_args=filter_args)
+        return self._filter_args(filter_args)
 
-        response = schedules
-        while response:
-            filter_args['marker'] = response[-1]['id']
-            response = self.client.list_schedules(filter_args=filter_args)
-            schedules.extend(response)
+    def _iter_schedule_pages(self, filter_args):
+        while True:
+            response, cursor = self.client.list_schedules_page(
+                filter_args=filter_args)
+            yield response
+            if cursor is None:
+                break
+            filter_args['cursor'] = cursor
 
+    def _list_schedules(self, filter_args):
+        schedules = []
+        for page in self._iter_schedule_pages(filter_args):
+            schedules.extend(page)
         return schedules
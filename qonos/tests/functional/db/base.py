@@ -17,8 +17,11 @@
 import datetime
 import uuid
 
+from qonos.api import archiver
+from qonos.api import reaper
 from qonos.common import exception
 from qonos.common import utils as qonos_utils
+from qonos.db import db_utils
 from qonos.openstack.common import cfg
 from qonos.openstack.common import timeutils
 from qonos.openstack.common import uuidutils
@@ -138,6 +141,103 @@ class TestSchedulesDBApi(test_utils.BaseTestCase):
         self.assertEqual(len(schedules), 1)
         self.assertEqual(schedules[0]['id'], self.schedule_1['id'])
 
+    def test_schedule_get_all_instance_id_filter_list(self):
+        self.db_api.schedule_metadata_update(
+            self.schedule_2['id'],
+            [{'key': 'instance_id', 'value': 'my_instance_2'}])
+        filters = {'instance_id': ['my_instance_1', 'my_instance_2',
+                                   'my_instance_3']}
+        schedules = self.db_api.schedule_get_all(filter_args=filters)
+        self.assertEqual(sorted(s['id'] for s in schedules),
+                         sorted([self.schedule_1['id'],
+                                 self.schedule_2['id']]))
+        self.assertFalse('instance_id' in schedules[0])
+
+    def test_schedule_get_all_instance_id_filter_follows_metadata(self):
+        filters = {'instance_id': 'my_instance_1'}
+        self.db_api.schedule_meta_delete(self.schedule_1['id'],
+                                         'instance_id')
+        self.assertEqual(self.db_api.schedule_get_all(filters), [])
+
+        self.db_api.schedule_meta_create(self.schedule_2['id'],
+                                         {'key': 'instance_id',
+                                          'value': 'my_instance_1'})
+        schedules = self.db_api.schedule_get_all(filters)
+        self.assertEqual([s['id'] for s in schedules],
+                         [self.schedule_2['id']])
+
+        self.db_api.schedule_update(
+            self.schedule_2['id'],
+            {'schedule_metadata': [{'key': 'instance_id',
+                                    'value': 'my_instance_2'}]})
+        self.assertEqual(self.db_api.schedule_get_all(filters), [])
+
+    def test_schedule_get_all_filters_follow_update(self):
+        next_run = self.schedule_2['next_run'] + datetime.timedelta(days=1)
+        self.db_api.schedule_update(self.schedule_1['id'],
+                                    {'tenant': str(TENANT_2),
+                                     'next_run': next_run})
+
+        filters = {'tenant': str(TENANT_1)}
+        self.assertEqual(self.db_api.schedule_get_all(filters), [])
+        filters = {'next_run_after': next_run}
+        schedules = self.db_api.schedule_get_all(filters)
+        self.assertEqual([s['id'] for s in schedules],
+                         [self.schedule_1['id']])
+        filters = {'next_run_before': self.schedule_2['next_run'],
+                   'tenant': str(TENANT_2)}
+        schedules = self.db_api.schedule_get_all(filters)
+        self.assertEqual([s['id'] for s in schedules],
+                         [self.schedule_2['id']])
+
+    def test_schedule_get_all_changed_since(self):
+        timeutils.advance_time_seconds(60)
+        changed_since = timeutils.utcnow()
+        self.db_api.schedule_update(self.schedule_2['id'],
+                                    {'next_run': changed_since})
+
+        filters = {'changed_since': changed_since}
+        schedules = self.db_api.schedule_get_all(filters)
+        self.assertEqual([s['id'] for s in schedules],
+                         [self.schedule_2['id']])
+        filters['changed_since'] += datetime.timedelta(seconds=1)
+        self.assertEqual(self.db_api.schedule_get_all(filters), [])
+
+    def test_schedule_get_all_partitions(self):
+        schedules = [self.schedule_1, self.schedule_2] + \
+            [self._create_basic_schedule() for i in range(6)]
+        found = []
+        for partition in range(4):
+            filters = {'partitions': [partition], 'partition_count': 4}
+            for schedule in self.db_api.schedule_get_all(filters):
+                self.assertEqual(
+                    db_utils.partition_key(schedule['id']) % 4, partition)
+                found.append(schedule['id'])
+        self.assertEqual(sorted(found), sorted(s['id'] for s in schedules))
+
+    def test_schedule_get_all_no_partitions(self):
+        filters = {'partitions': [], 'partition_count': 4}
+        self.assertEqual(self.db_api.schedule_get_all(filters), [])
+
+    def test_schedule_get_all_filters_skip_deleted(self):
+        self.db_api.schedule_delete(self.schedule_1['id'])
+        for filters in ({'tenant': str(TENANT_1)},
+                        {'instance_id': 'my_instance_1'},
+                        {'next_run_before': self.schedule_1['next_run']}):
+            self.assertEqual(self.db_api.schedule_get_all(filters), [])
+
+    def test_schedule_get_all_returns_copies(self):
+        schedule = self.db_api.schedule_get_all({'tenant': str(TENANT_1)})[0]
+        schedule['tenant'] = str(TENANT_2)
+        schedule['schedule_metadata'][0]['value'] = 'changed'
+        schedule['schedule_metadata'].append({'key': 'a', 'value': 'b'})
+
+        schedule = self.db_api.schedule_get_by_id(self.schedule_1['id'])
+        self.assertEqual(schedule['tenant'], str(TENANT_1))
+        self.assertEqual(schedule['schedule_metadata'][0]['value'],
+                         'my_instance_1')
+        self.assertEqual(len(schedule['schedule_metadata']), 1)
+
     def test_schedule_get_next_run_filters(self):
         filters = {}
         filters['next_run_after'] = self.schedule_1['next_run']
@@ -157,6 +257,44 @@ class TestSchedulesDBApi(test_utils.BaseTestCase):
         schedules = self.db_api.schedule_get_all(filter_args=filters)
         self.assertEqual(len(schedules), 1)
 
+    def test_schedule_next_run_histogram(self):
+        next_run = self.schedule_1['next_run']
+        self.db_api.schedule_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'next_run': next_run + datetime.timedelta(seconds=45)})
+        self.db_api.schedule_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'next_run': next_run + datetime.timedelta(days=2)})
+
+        load = self.db_api.schedule_next_run_histogram(
+            timeutils.utcnow(), next_run + datetime.timedelta(days=1))
+        self.assertEqual(load, [
+            {'minute': next_run, 'count': 2},
+            {'minute': self.schedule_2['next_run'], 'count': 1},
+        ])
+
+    def test_schedule_cron_counts(self):
+        self.db_api.schedule_create({'action': 'snapshot',
+                                     'tenant': unit_utils.TENANT1,
+                                     'minute': 30, 'hour': 2})
+        self.db_api.schedule_create({'action': 'backup',
+                                     'tenant': unit_utils.TENANT1,
+                                     'minute': 30, 'hour': 2})
+        counts = self.db_api.schedule_cron_counts()
+        expected = [
+            {'minute': 30, 'hour': 2, 'day_of_month': None, 'month': None,
+             'day_of_week': None, 'action': 'snapshot', 'count': 2},
+            {'minute': 30, 'hour': 3, 'day_of_month': None, 'month': None,
+             'day_of_week': None, 'action': 'snapshot', 'count': 1},
+            {'minute': 30, 'hour': 2, 'day_of_month': None, 'month': None,
+             'day_of_week': None, 'action': 'backup', 'count': 1},
+        ]
+        self.assertEqual(len(counts), len(expected))
+        for count in expected:
+            self.assertTrue(count in counts)
+
     def test_schedule_get_all_with_limit(self):
         filters = {}
         filters['limit'] = 1
@@ -171,6 +309,27 @@ class TestSchedulesDBApi(test_utils.BaseTestCase):
         expected = [self.schedule_2]
         self.assertEqual(expected, schedules)
 
+    def test_schedule_get_all_with_cursor(self):
+        filters = {}
+        filters['cursor'] = db_utils.encode_cursor(self.schedule_1)
+        schedules = self.db_api.schedule_get_all(filter_args=filters)
+        expected = [self.schedule_2]
+        self.assertEqual(expected, schedules)
+
+    def test_schedule_get_all_with_cursor_of_deleted_schedule(self):
+        filters = {}
+        filters['cursor'] = db_utils.encode_cursor(self.schedule_1)
+        self.db_api.schedule_delete(self.schedule_1['id'])
+        schedules = self.db_api.schedule_get_all(filter_args=filters)
+        expected = [self.schedule_2]
+        self.assertEqual(expected, schedules)
+
+    def test_schedule_get_all_with_invalid_cursor(self):
+        filters = {}
+        filters['cursor'] = 'not-a-cursor'
+        self.assertRaises(exception.Invalid, self.db_api.schedule_get_all,
+                          filter_args=filters)
+
     def test_schedule_get_by_id(self):
         fixture = {
             'tenant': str(uuid.uuid4()),
@@ -550,6 +709,13 @@ class TestWorkersDBApi(test_utils.BaseTestCase):
         expected = [self.worker_2]
         self.assertEqual(expected, workers)
 
+    def test_worker_get_all_with_cursor(self):
+        params = {}
+        params['cursor'] = db_utils.encode_cursor(self.worker_1)
+        workers = self.db_api.worker_get_all(params=params)
+        expected = [self.worker_2]
+        self.assertEqual(expected, workers)
+
     def test_worker_get_by_id(self):
         actual = self.db_api.worker_get_by_id(self.worker_1['id'])
         self.assertEquals(actual['id'], self.worker_1['id'])
@@ -635,6 +801,37 @@ class TestJobsDBApi(test_utils.BaseTestCase):
                 'tenant': unit_utils.TENANT1
                 })
 
+    def _create_run_job(self, scheduled_run):
+        now = timeutils.utcnow()
+        return self.db_api.job_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'schedule_id': unit_utils.SCHEDULE_UUID3,
+            'timeout': now,
+            'hard_timeout': now,
+            'scheduled_run': scheduled_run,
+        })
+
+    def test_job_create_once_per_run(self):
+        run = datetime.datetime(2013, 1, 1, 2, 30)
+        job = self._create_run_job(run)
+        self.assertEqual(job['scheduled_run'], run)
+        self.assertEqual(self._create_run_job(run)['id'], job['id'])
+
+        next_job = self._create_run_job(run + datetime.timedelta(days=1))
+        self.assertNotEqual(next_job['id'], job['id'])
+        self.assertEqual(len(self.db_api.job_get_all()), 4)
+
+    def test_job_create_without_run(self):
+        self.assertNotEqual(self._create_run_job(None)['id'],
+                            self._create_run_job(None)['id'])
+
+    def test_job_create_run_again_after_delete(self):
+        run = datetime.datetime(2013, 1, 1, 2, 30)
+        job = self._create_run_job(run)
+        self.db_api.job_delete(job['id'])
+        self.assertNotEqual(self._create_run_job(run)['id'], job['id'])
+
     def test_job_create_no_action(self):
         fixture = {
             'tenant': unit_utils.TENANT1,
@@ -724,20 +921,146 @@ class TestJobsDBApi(test_utils.BaseTestCase):
         self.assertEqual(metadata[0]['value'],
                          fixture['job_metadata'][0]['value'])
 
-    def test_jobs_cleanup_hard_timed_out(self):
+    def test_jobs_delete_hard_timed_out(self):
         jobs = self.db_api.job_get_all()
         self.assertEqual(len(jobs), 2)
         timeutils.set_time_override()
         timeutils.advance_time_delta(datetime.timedelta(hours=4, minutes=1))
-        self.db_api._jobs_cleanup_hard_timed_out()
+        deleted = self.db_api.jobs_delete_hard_timed_out(10)
         timeutils.clear_time_override()
+        self.assertEqual(deleted, 2)
         jobs = self.db_api.job_get_all()
         self.assertEqual(len(jobs), 0)
+        fault = self.db_api.job_fault_latest_for_job_id(self.job_1['id'])
+        self.assertEqual(fault, None)
+
+    def test_jobs_delete_hard_timed_out_in_batches(self):
+        timeutils.set_time_override()
+        timeutils.advance_time_delta(datetime.timedelta(hours=4, minutes=1))
+        self.assertEqual(self.db_api.jobs_delete_hard_timed_out(1), 1)
+        self.assertEqual(len(self.db_api.job_get_all()), 1)
+        self.assertEqual(self.db_api.jobs_delete_hard_timed_out(1), 1)
+        self.assertEqual(self.db_api.jobs_delete_hard_timed_out(1), 0)
+        timeutils.clear_time_override()
+
+    def test_jobs_delete_hard_timed_out_not_expired(self):
+        self.assertEqual(self.db_api.jobs_delete_hard_timed_out(10), 0)
+        self.assertEqual(len(self.db_api.job_get_all()), 2)
+
+    def test_jobs_delete_hard_timed_out_skips_finished(self):
+        for status in db_utils.FINISHED_JOB_STATUSES:
+            job = self._create_basic_job()
+            self.db_api.job_update(job['id'], {'status': status})
+        timeutils.set_time_override()
+        timeutils.advance_time_delta(datetime.timedelta(hours=4, minutes=1))
+        deleted = self.db_api.jobs_delete_hard_timed_out(10,
+                                                         record_faults=True)
+        timeutils.clear_time_override()
+
+        self.assertEqual(deleted, 2)
+        jobs = self.db_api.job_get_all()
+        self.assertEqual(sorted(job['status'] for job in jobs),
+                         sorted(db_utils.FINISHED_JOB_STATUSES))
+        for job in jobs:
+            self.assertEqual(
+                self.db_api.job_fault_latest_for_job_id(job['id']), None)
+
+    def test_jobs_delete_hard_timed_out_skips_live_timeout(self):
+        timeutils.set_time_override()
+        timeutils.advance_time_delta(datetime.timedelta(hours=4, minutes=1))
+        # a worker still working on the job keeps pushing its timeout on
+        self.db_api.job_update(self.job_1['id'], {
+            'status': 'PROCESSING',
+            'timeout': timeutils.utcnow() + datetime.timedelta(minutes=5)})
+        deleted = self.db_api.jobs_delete_hard_timed_out(10)
+        timeutils.clear_time_override()
+
+        self.assertEqual(deleted, 1)
+        self.assertEqual([job['id'] for job in self.db_api.job_get_all()],
+                         [self.job_1['id']])
+
+    def test_jobs_delete_hard_timed_out_records_faults(self):
+        self.db_api.job_meta_create(self.job_1['id'],
+                                    {'key': 'instance_id',
+                                     'value': 'my_instance'})
+        timeutils.set_time_override()
+        timeutils.advance_time_delta(datetime.timedelta(hours=4, minutes=1))
+        self.db_api.jobs_delete_hard_timed_out(10, record_faults=True)
+        timeutils.clear_time_override()
+
+        fault = self.db_api.job_fault_latest_for_job_id(self.job_1['id'])
+        self.assertEqual(fault['schedule_id'], self.job_1['schedule_id'])
+        self.assertEqual(fault['tenant'], self.job_1['tenant'])
+        self.assertEqual(fault['worker_id'], self.job_1['worker_id'])
+        self.assertEqual(fault['action'], self.job_1['action'])
+        self.assertTrue('my_instance' in fault['job_metadata'])
+        self.assertTrue(fault['message'])
 
     def test_job_get_all(self):
         jobs = self.db_api.job_get_all()
         self.assertEqual(len(jobs), 2)
 
+    def _finish_job(self, job, status='DONE'):
+        self.db_api.job_meta_create(job['id'], {'key': 'instance_id',
+                                                'value': 'my_instance'})
+        return self.db_api.job_update(job['id'], {'status': status})
+
+    def test_jobs_archive_finished(self):
+        job = self._finish_job(self.job_1)
+        finished_before = job['updated_at'] + datetime.timedelta(seconds=1)
+        moved = self.db_api.jobs_archive_finished(finished_before, 10)
+        self.assertEqual(moved, 1)
+
+        jobs = self.db_api.job_get_all()
+        self.assertEqual([j['id'] for j in jobs], [self.job_2['id']])
+        archived = self.db_api.job_archive_get_all()
+        self.assertEqual(len(archived), 1)
+        for key in ('id', 'created_at', 'updated_at', 'schedule_id',
+                    'tenant', 'worker_id', 'status', 'action',
+                    'retry_count'):
+            self.assertEqual(archived[0][key], job[key])
+        self.assertEqual(archived[0]['job_metadata'],
+                         [{'key': 'instance_id', 'value': 'my_instance'}])
+
+    def test_jobs_archive_finished_skips_recent_and_running(self):
+        job = self._finish_job(self.job_1)
+        self.db_api.job_update(self.job_2['id'], {'status': 'PROCESSING'})
+        finished_before = job['updated_at'] - datetime.timedelta(seconds=1)
+        self.assertEqual(
+            self.db_api.jobs_archive_finished(finished_before, 10), 0)
+        finished_before = job['updated_at'] + datetime.timedelta(hours=1)
+        self.assertEqual(
+            self.db_api.jobs_archive_finished(finished_before, 10), 1)
+        self.assertEqual(len(self.db_api.job_get_all()), 1)
+
+    def test_jobs_archive_finished_in_batches(self):
+        self._finish_job(self.job_1)
+        job = self._finish_job(self.job_2, 'ERROR')
+        finished_before = job['updated_at'] + datetime.timedelta(seconds=1)
+        self.assertEqual(
+            self.db_api.jobs_archive_finished(finished_before, 1), 1)
+        self.assertEqual(
+            self.db_api.jobs_archive_finished(finished_before, 1), 1)
+        self.assertEqual(
+            self.db_api.jobs_archive_finished(finished_before, 1), 0)
+        self.assertEqual(self.db_api.job_get_all(), [])
+
+    def test_job_archive_get_all_filters_and_pagination(self):
+        self._finish_job(self.job_1)
+        job = self._finish_job(self.job_2, 'TIMED_OUT')
+        finished_before = job['updated_at'] + datetime.timedelta(seconds=1)
+        self.db_api.jobs_archive_finished(finished_before, 10)
+
+        params = {'schedule_id': self.job_2['schedule_id']}
+        archived = self.db_api.job_archive_get_all(params)
+        self.assertEqual([j['id'] for j in archived], [self.job_2['id']])
+        params = {'limit': 1}
+        archived = self.db_api.job_archive_get_all(params)
+        self.assertEqual([j['id'] for j in archived], [self.job_1['id']])
+        params = {'cursor': db_utils.encode_cursor(archived[0])}
+        archived = self.db_api.job_archive_get_all(params)
+        self.assertEqual([j['id'] for j in archived], [self.job_2['id']])
+
     def test_job_get_all_with_limit(self):
         params = {}
         params['limit'] = 1
@@ -754,6 +1077,13 @@ class TestJobsDBApi(test_utils.BaseTestCase):
         expected = [self.job_2]
         self.assertEqual(expected, jobs)
 
+    def test_job_get_all_with_cursor(self):
+        params = {}
+        params['cursor'] = db_utils.encode_cursor(self.job_1)
+        jobs = self.db_api.job_get_all(params=params)
+        expected = [self.job_2]
+        self.assertEqual(expected, jobs)
+
     def test_job_get_by_id(self):
         expected = self.job_1
         actual = self.db_api.job_get_by_id(self.job_1['id'])
@@ -907,6 +1237,52 @@ class TestJobsDBApi(test_utils.BaseTestCase):
                           job_id, {})
 
 
+class TestJobHousekeeping(test_utils.BaseTestCase):
+    """The job reaper and archiver running together on their defaults."""
+
+    def setUp(self):
+        super(TestJobHousekeeping, self).setUp()
+        self.db_api = db_api
+        timeutils.set_time_override()
+
+    def tearDown(self):
+        timeutils.clear_time_override()
+        self.db_api.reset()
+        super(TestJobHousekeeping, self).tearDown()
+
+    def _create_job(self):
+        # NOTE: the default action timeout_seconds
+        timeout = timeutils.utcnow() + datetime.timedelta(seconds=60)
+        return self.db_api.job_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'schedule_id': unit_utils.SCHEDULE_UUID1,
+            'status': 'queued',
+            'timeout': timeout,
+            'hard_timeout': timeout})
+
+    def test_finished_jobs_reach_the_archive(self):
+        done = self._create_job()
+        self.db_api.job_update(done['id'], {'status': 'DONE'})
+        abandoned = self._create_job()
+
+        timeutils.advance_time_seconds(CONF.api.job_reaper_interval * 2)
+        self.assertEqual(reaper.JobReaper(self.db_api).reap(), 1)
+        self.assertEqual([job['id'] for job in self.db_api.job_get_all()],
+                         [done['id']])
+        fault = self.db_api.job_fault_latest_for_job_id(abandoned['id'])
+        self.assertNotEqual(fault, None)
+        self.assertEqual(
+            self.db_api.job_fault_latest_for_job_id(done['id']), None)
+
+        timeutils.advance_time_seconds(CONF.api.job_archive_age * 2)
+        self.assertEqual(reaper.JobReaper(self.db_api).reap(), 0)
+        self.assertEqual(archiver.JobArchiver(self.db_api).archive(), 1)
+        self.assertEqual(self.db_api.job_get_all(), [])
+        self.assertEqual([job['id'] for job in
+                          self.db_api.job_archive_get_all()], [done['id']])
+
+
 class TestJobsDBGetNextJobApi(test_utils.BaseTestCase):
 
     def setUp(self):
@@ -998,6 +1374,318 @@ class TestJobsDBGetNextJobApi(test_utils.BaseTestCase):
         self.assertEqual(job['hard_timeout'], expected['hard_timeout'])
         self.assertEqual(job['retry_count'], expected['retry_count'] + 1)
 
+    def test_get_next_jobs_batch(self):
+        retries = 2
+        self._create_jobs(5, self.job_fixture_1, self.job_fixture_2,
+                          self.job_fixture_1.copy(),
+                          self.job_fixture_1.copy())
+        jobs = db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, retries, 2)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs[0]['id'], self.jobs[0]['id'])
+        self.assertEqual(jobs[1]['id'], self.jobs[2]['id'])
+        for job in jobs:
+            self.assertEqual(job['worker_id'], unit_utils.WORKER_UUID1)
+            self.assertEqual(job['retry_count'], 1)
+            self.assertEqual(job['job_metadata'], [])
+
+    def test_get_next_jobs_batch_fewer_available(self):
+        retries = 2
+        self._create_jobs(10, self.job_fixture_1, self.job_fixture_2)
+        jobs = db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, retries, 5)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['id'], self.jobs[0]['id'])
+
+        jobs = db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, retries, 5)
+        self.assertEqual(jobs, [])
+
+    def test_get_next_jobs_batch_leased(self):
+        retries = 5
+        self.job_fixture_1['hard_timeout'] = (timeutils.utcnow() +
+                                              datetime.timedelta(hours=1))
+        self._create_jobs(1, *[self.job_fixture_1.copy() for i in range(4)])
+        lease = datetime.timedelta(minutes=10)
+
+        first = db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, retries, 2,
+            timeutils.utcnow() + lease)
+        self.assertEqual([job['id'] for job in first],
+                         [job['id'] for job in self.jobs[:2]])
+        for job in first:
+            self.assertEqual(job['timeout'], timeutils.utcnow() + lease)
+
+        # the timeouts the jobs were created with have passed, but the
+        # jobs of the first batch are still leased
+        timeutils.advance_time_seconds(60)
+        second = db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID2, retries, 4,
+            timeutils.utcnow() + lease)
+        self.assertEqual([job['id'] for job in second],
+                         [job['id'] for job in self.jobs[2:]])
+        self.assertEqual(db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID2, retries, 4,
+            timeutils.utcnow() + lease), [])
+
+        timeutils.advance_time_delta(lease)
+        third = db_api.jobs_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID2, retries, 2,
+            timeutils.utcnow() + lease)
+        self.assertEqual([job['id'] for job in third],
+                         [job['id'] for job in self.jobs[:2]])
+        for job in third:
+            self.assertEqual(job['worker_id'], unit_utils.WORKER_UUID2)
+            self.assertEqual(job['timeout'], timeutils.utcnow() + lease)
+            self.assertEqual(job['retry_count'], 2)
+
+    def test_get_next_job_other_action(self):
+        self.job_fixture_1['action'] = 'backup'
+        self._create_jobs(10, self.job_fixture_1)
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       unit_utils.WORKER_UUID1,
+                                                       2)
+        self.assertEqual(job, None)
+
+    def test_get_next_job_lease_expires(self):
+        self.job_fixture_1['hard_timeout'] = (timeutils.utcnow() +
+                                              datetime.timedelta(hours=1))
+        self._create_jobs(10, self.job_fixture_1)
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       unit_utils.WORKER_UUID1,
+                                                       3)
+        self.assertEqual(job['id'], self.jobs[0]['id'])
+        self.assertEqual(db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID2, 3), None)
+
+        timeutils.advance_time_seconds(30)
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       unit_utils.WORKER_UUID2,
+                                                       3)
+        self.assertEqual(job['id'], self.jobs[0]['id'])
+        self.assertEqual(job['worker_id'], unit_utils.WORKER_UUID2)
+        self.assertEqual(job['retry_count'], 2)
+
+    def test_get_next_job_after_unassign(self):
+        self._create_jobs(10, self.job_fixture_2)
+        self.assertEqual(db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, 2), None)
+
+        db_api.job_update(self.jobs[0]['id'], {'worker_id': None})
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       unit_utils.WORKER_UUID1,
+                                                       2)
+        self.assertEqual(job['id'], self.jobs[0]['id'])
+
+    def test_get_next_job_retries_raised(self):
+        self.job_fixture_1['retry_count'] = 3
+        self._create_jobs(10, self.job_fixture_1)
+        self.assertEqual(db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, 2), None)
+
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       unit_utils.WORKER_UUID1,
+                                                       5)
+        self.assertEqual(job['id'], self.jobs[0]['id'])
+        self.assertEqual(job['retry_count'], 4)
+
+    def test_get_next_job_hard_timeout_extended(self):
+        now = timeutils.utcnow()
+        self.job_fixture_1['hard_timeout'] = now
+        self._create_jobs(10, self.job_fixture_1)
+        self.assertEqual(db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, 2), None)
+
+        db_api.job_update(self.jobs[0]['id'],
+                          {'hard_timeout': now + datetime.timedelta(hours=1)})
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       unit_utils.WORKER_UUID1,
+                                                       2)
+        self.assertEqual(job['id'], self.jobs[0]['id'])
+
+
+class TestJobsDBCreateForDueSchedulesApi(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestJobsDBCreateForDueSchedulesApi, self).setUp()
+        self.db_api = db_api
+        timeutils.set_time_override()
+        now = timeutils.utcnow()
+        self.due = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'minute': 30,
+            'hour': 2,
+            'next_run': now - datetime.timedelta(minutes=1),
+            'schedule_metadata': [{'key': 'instance_id',
+                                   'value': 'my_instance'}],
+        })
+        self.not_due = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT2,
+            'action': 'snapshot',
+            'minute': 30,
+            'hour': 2,
+            'next_run': now + datetime.timedelta(minutes=1),
+        })
+
+    def tearDown(self):
+        super(TestJobsDBCreateForDueSchedulesApi, self).tearDown()
+        timeutils.clear_time_override()
+        self.db_api.reset()
+
+    def test_create_for_due_schedules(self):
+        now = timeutils.utcnow()
+        job_ids = self.db_api.jobs_create_for_due_schedules(now, 60,
+                                                            {'snapshot': 30})
+        self.assertEqual(len(job_ids), 1)
+
+        job = self.db_api.job_get_by_id(job_ids[0])
+        self.assertEqual(job['schedule_id'], self.due['id'])
+        self.assertEqual(job['tenant'], self.due['tenant'])
+        self.assertEqual(job['action'], 'snapshot')
+        self.assertEqual(job['status'], 'queued')
+        self.assertEqual(job['worker_id'], None)
+        self.assertEqual(job['retry_count'], 0)
+        self.assertEqual(job['timeout'], now + datetime.timedelta(seconds=30))
+        self.assertEqual(job['hard_timeout'], job['timeout'])
+        self.assertEqual(len(job['job_metadata']), 1)
+        self.assertEqual(job['job_metadata'][0]['key'], 'instance_id')
+        self.assertEqual(job['job_metadata'][0]['value'], 'my_instance')
+
+        schedule = self.db_api.schedule_get_by_id(self.due['id'])
+        self.assertEqual(schedule['last_scheduled'], now)
+        self.assertTrue(schedule['next_run'] > now)
+        schedule = self.db_api.schedule_get_by_id(self.not_due['id'])
+        self.assertEqual(schedule['next_run'], self.not_due['next_run'])
+        self.assertEqual(schedule.get('last_scheduled'), None)
+
+    def test_create_for_due_schedules_default_timeout(self):
+        now = timeutils.utcnow()
+        job_ids = self.db_api.jobs_create_for_due_schedules(now, 60)
+        job = self.db_api.job_get_by_id(job_ids[0])
+        self.assertEqual(job['timeout'], now + datetime.timedelta(seconds=60))
+
+    def test_create_for_due_schedules_in_partitions(self):
+        now = timeutils.utcnow()
+        partition = db_utils.partition_key(self.due['id']) % 2
+        job_ids = self.db_api.jobs_create_for_due_schedules(
+            now, 60, partitions=[1 - partition], partition_count=2)
+        self.assertEqual(job_ids, [])
+        job_ids = self.db_api.jobs_create_for_due_schedules(
+            now, 60, partitions=[partition], partition_count=2)
+        self.assertEqual(len(job_ids), 1)
+
+    def test_create_for_due_schedules_run_already_created(self):
+        now = timeutils.utcnow()
+        job = self.db_api.job_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'schedule_id': self.due['id'],
+            'timeout': now,
+            'hard_timeout': now,
+            'scheduled_run': self.due['next_run'],
+        })
+        job_ids = self.db_api.jobs_create_for_due_schedules(now, 60)
+        self.assertEqual(job_ids, [])
+        self.assertEqual([j['id'] for j in self.db_api.job_get_all()],
+                         [job['id']])
+        schedule = self.db_api.schedule_get_by_id(self.due['id'])
+        self.assertTrue(schedule['next_run'] > now)
+
+    def test_create_for_due_schedules_same_time_run_created(self):
+        now = timeutils.utcnow()
+        other = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'minute': 30,
+            'hour': 2,
+            'next_run': self.due['next_run'],
+        })
+        # NOTE: schedules due at the same time are taken in id order, so
+        # the run created already is that of the last schedule taken
+        created, waiting = sorted([self.due, other],
+                                  key=lambda s: s['id'], reverse=True)
+        self.db_api.job_create({
+            'action': 'snapshot',
+            'tenant': unit_utils.TENANT1,
+            'schedule_id': created['id'],
+            'timeout': now,
+            'hard_timeout': now,
+            'scheduled_run': created['next_run'],
+        })
+
+        job_ids = self.db_api.jobs_create_for_due_schedules(now, 60)
+        self.assertEqual(len(job_ids), 1)
+        job = self.db_api.job_get_by_id(job_ids[0])
+        self.assertEqual(job['schedule_id'], waiting['id'])
+        self.assertEqual(job['scheduled_run'], waiting['next_run'])
+
+    def test_create_for_due_schedules_only_once(self):
+        now = timeutils.utcnow()
+        self.db_api.jobs_create_for_due_schedules(now, 60)
+        job_ids = self.db_api.jobs_create_for_due_schedules(now, 60)
+        self.assertEqual(job_ids, [])
+        self.assertEqual(len(self.db_api.job_get_all()), 1)
+
+
+class TestSchedulerLeaseDBApi(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSchedulerLeaseDBApi, self).setUp()
+        self.db_api = db_api
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1))
+
+    def tearDown(self):
+        super(TestSchedulerLeaseDBApi, self).tearDown()
+        timeutils.clear_time_override()
+        self.db_api.reset()
+
+    def _lease(self, scheduler_id):
+        return self.db_api.scheduler_lease_partitions(scheduler_id, 8, 30,
+                                                      host='host')
+
+    def test_lease_takes_every_partition(self):
+        self.assertEqual(self._lease('a'), range(8))
+        self.assertEqual(self._lease('a'), range(8))
+
+    def test_lease_splits_partitions(self):
+        self._lease('a')
+        # every partition is still held by a
+        self.assertEqual(self._lease('b'), [])
+
+        timeutils.advance_time_seconds(5)
+        held_a = self._lease('a')
+        held_b = self._lease('b')
+        self.assertEqual(len(held_a), 4)
+        self.assertEqual(len(held_b), 4)
+        self.assertEqual(sorted(held_a + held_b), range(8))
+
+        timeutils.advance_time_seconds(5)
+        self.assertEqual(self._lease('a'), held_a)
+        self.assertEqual(self._lease('b'), held_b)
+
+    def test_lease_takes_over_expired_partitions(self):
+        self._lease('a')
+        timeutils.advance_time_seconds(10)
+        self._lease('b')
+        timeutils.advance_time_seconds(5)
+        self._lease('a')
+        self.assertEqual(len(self._lease('b')), 4)
+
+        # a stops renewing
+        timeutils.advance_time_seconds(31)
+        self.assertEqual(self._lease('b'), range(8))
+
+    def test_lease_release(self):
+        self._lease('a')
+        self.db_api.scheduler_lease_release('a')
+        self.assertEqual(self._lease('b'), range(8))
+
+    def test_lease_fewer_partitions(self):
+        self._lease('a')
+        held = self.db_api.scheduler_lease_partitions('a', 4, 30)
+        self.assertEqual(held, range(4))
+
 
 class TestJobFaultDBApi(test_utils.BaseTestCase):
 
@@ -1048,3 +1736,57 @@ class TestJobFaultDBApi(test_utils.BaseTestCase):
         self.assertEqual(job_fault['job_metadata'], fixture['job_metadata'])
         self.assertNotEqual(job_fault['created_at'], None)
         self.assertNotEqual(job_fault['updated_at'], None)
+
+    def _create_job_faults(self):
+        self.faults = []
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1))
+        self.addCleanup(timeutils.clear_time_override)
+        for job_id, tenant, action in (('job-1', 'tenant-1', 'snapshot'),
+                                       ('job-1', 'tenant-1', 'snapshot'),
+                                       ('job-2', 'tenant-1', 'backup'),
+                                       ('job-3', 'tenant-2', 'snapshot')):
+            self.faults.append(self.db_api.job_fault_create({
+                'schedule_id': 'schedule-%s' % job_id,
+                'tenant': tenant,
+                'worker_id': 'worker-1',
+                'job_id': job_id,
+                'action': action}))
+            timeutils.advance_time_seconds(1)
+
+    def test_job_fault_latest_for_job_id(self):
+        self._create_job_faults()
+        fault = self.db_api.job_fault_latest_for_job_id('job-1')
+        self.assertEqual(fault['id'], self.faults[1]['id'])
+        self.assertEqual(self.db_api.job_fault_latest_for_job_id('job-4'),
+                         None)
+
+    def test_job_fault_get_all(self):
+        self._create_job_faults()
+        faults = self.db_api.job_fault_get_all()
+        self.assertEqual([f['id'] for f in faults],
+                         sorted(f['id'] for f in self.faults))
+
+    def test_job_fault_get_all_filters(self):
+        self._create_job_faults()
+        for filters, expected in (({'job_id': 'job-1'}, self.faults[:2]),
+                                  ({'schedule_id': 'schedule-job-2'},
+                                   self.faults[2:3]),
+                                  ({'tenant': 'tenant-1',
+                                    'action': 'snapshot'}, self.faults[:2]),
+                                  ({'action': 'snapshot'},
+                                   [self.faults[i] for i in (0, 1, 3)]),
+                                  ({'tenant': 'tenant-3'}, [])):
+            faults = self.db_api.job_fault_get_all(filters)
+            self.assertEqual([f['id'] for f in faults],
+                             sorted(f['id'] for f in expected))
+
+    def test_job_fault_get_all_paginated(self):
+        self._create_job_faults()
+        ids = sorted(f['id'] for f in self.faults)
+        faults = self.db_api.job_fault_get_all({'limit': 2})
+        self.assertEqual([f['id'] for f in faults], ids[:2])
+        faults = self.db_api.job_fault_get_all({'marker': ids[1],
+                                                'limit': 1})
+        self.assertEqual([f['id'] for f in faults], ids[2:3])
+        self.assertRaises(exception.NotFound, self.db_api.job_fault_get_all,
+                          {'marker': 'missing'})
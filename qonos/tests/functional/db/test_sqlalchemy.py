@@ -14,10 +14,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import sys
 
+import sqlalchemy
+from sqlalchemy.engine import reflection
+
+from qonos.common import exception
+from qonos.db import db_utils
+from qonos.db import query_stats
 import qonos.db.sqlalchemy.api
+from qonos.db.sqlalchemy import migration
+from qonos.db.sqlalchemy import models
+from qonos.openstack.common import timeutils
 from qonos.tests.functional.db import base
+from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils
 
 
@@ -32,6 +43,522 @@ def tearDownModule():
     base.db_api = None
 
 
+class InlineMetadataMixin(object):
+    """Run a test with metadata kept in the inline_metadata columns."""
+
+    def setUp(self):
+        self.config(sql_inline_metadata=True)
+        super(InlineMetadataMixin, self).setUp()
+
+
 #NOTE(ameade): Pull in cross driver db tests
 thismodule = sys.modules[__name__]
 utils.import_test_cases(thismodule, base, suffix="_Sqlalchemy_DB")
+utils.import_test_cases(thismodule, base, suffix="_Sqlalchemy_Inline_DB",
+                        mixins=[InlineMetadataMixin])
+
+
+class TestJobClaimSqlalchemyApi(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestJobClaimSqlalchemyApi, self).setUp()
+        self.db_api = qonos.db.sqlalchemy.api
+        timeutils.set_time_override()
+        self.jobs = []
+        for i in range(2):
+            now = timeutils.utcnow()
+            self.jobs.append(self.db_api.job_create({
+                'action': 'snapshot',
+                'tenant': unit_utils.TENANT1,
+                'timeout': now + datetime.timedelta(seconds=30),
+                'hard_timeout': now + datetime.timedelta(seconds=30),
+                'job_metadata': [{'key': 'instance_id',
+                                  'value': 'my_instance_%d' % i}],
+            }))
+            timeutils.advance_time_seconds(1)
+
+    def tearDown(self):
+        super(TestJobClaimSqlalchemyApi, self).tearDown()
+        timeutils.clear_time_override()
+        self.db_api.reset()
+
+    def test_claim_passes_over_job_claimed_concurrently(self):
+        real_candidates = self.db_api._job_claim_candidates
+
+        def fake_candidates(*args, **kwargs):
+            candidates = real_candidates(*args, **kwargs)
+            # Another worker wins the oldest job after we read it
+            self.db_api.job_update(candidates[0]['id'],
+                                   {'worker_id': unit_utils.WORKER_UUID2,
+                                    'retry_count': 1})
+            return candidates
+
+        self.stubs.Set(self.db_api, '_job_claim_candidates', fake_candidates)
+        job = self.db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, 2)
+
+        self.assertEqual(job['id'], self.jobs[1]['id'])
+        self.assertEqual(job['worker_id'], unit_utils.WORKER_UUID1)
+        self.assertEqual(job['retry_count'], 1)
+        self.assertEqual(job['job_metadata'][0]['value'], 'my_instance_1')
+        stored = self.db_api.job_get_by_id(self.jobs[0]['id'])
+        self.assertEqual(stored['worker_id'], unit_utils.WORKER_UUID2)
+
+    def test_claim_returns_none_when_all_candidates_lost(self):
+        real_candidates = self.db_api._job_claim_candidates
+
+        def fake_candidates(*args, **kwargs):
+            candidates = real_candidates(*args, **kwargs)
+            for candidate in candidates:
+                self.db_api.job_update(candidate['id'],
+                                       {'worker_id': unit_utils.WORKER_UUID2,
+                                        'retry_count': 1})
+            return candidates
+
+        self.stubs.Set(self.db_api, '_job_claim_candidates', fake_candidates)
+        job = self.db_api.job_get_and_assign_next_by_action(
+            'snapshot', unit_utils.WORKER_UUID1, 2)
+        self.assertEqual(job, None)
+
+
+class TestSchedulerLeaseSqlalchemyApi(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSchedulerLeaseSqlalchemyApi, self).setUp()
+        self.db_api = qonos.db.sqlalchemy.api
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1))
+
+    def tearDown(self):
+        super(TestSchedulerLeaseSqlalchemyApi, self).tearDown()
+        timeutils.clear_time_override()
+        self.db_api.reset()
+
+    def _scheduler_ids(self):
+        schedulers = models.Scheduler.__table__
+        query = sqlalchemy.sql.select([schedulers.c.id])
+        return [row[0] for row in self.db_api.get_session().execute(query)]
+
+    def test_lease_failure_rolls_back(self):
+        self.db_api.scheduler_lease_partitions('a', 8, 30)
+        # a stops renewing
+        timeutils.advance_time_seconds(31)
+
+        def fake_take(*args, **kwargs):
+            raise RuntimeError()
+
+        self.stubs.Set(self.db_api, '_scheduler_lease_take', fake_take)
+        self.assertRaises(RuntimeError,
+                          self.db_api.scheduler_lease_partitions, 'b', 8, 30)
+        self.assertEqual(self._scheduler_ids(), ['a'])
+
+
+class TestRowDictsSqlalchemy(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestRowDictsSqlalchemy, self).setUp()
+        self.db_api = qonos.db.sqlalchemy.api
+        now = timeutils.utcnow()
+        self.schedule = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'minute': 30,
+            'hour': 2,
+            'next_run': now,
+            'schedule_metadata': [{'key': 'instance_id', 'value': 'my_id'},
+                                  {'key': 'retention', 'value': '3'}],
+        })
+        self.job = self.db_api.job_create({
+            'schedule_id': self.schedule['id'],
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'timeout': now,
+            'hard_timeout': now,
+            'job_metadata': [{'key': 'instance_id', 'value': 'my_id'}],
+        })
+
+    def tearDown(self):
+        super(TestRowDictsSqlalchemy, self).tearDown()
+        self.db_api.reset()
+
+    def _sorted_meta(self, obj, meta_key):
+        obj[meta_key] = sorted(obj[meta_key], key=lambda m: m['key'])
+        return obj
+
+    def test_schedule_dict_matches_orm(self):
+        orm_schedule = self.db_api.force_dict(
+            self.db_api._schedule_get_by_id)(self.schedule['id'])
+        del orm_schedule['inline_metadata']
+        del orm_schedule['instance_id']
+        del orm_schedule['partition_key']
+        schedule = self.db_api.schedule_get_by_id(self.schedule['id'])
+        self.assertEqual(self._sorted_meta(schedule, 'schedule_metadata'),
+                         self._sorted_meta(orm_schedule, 'schedule_metadata'))
+
+    def test_job_dict_matches_orm(self):
+        orm_job = self.db_api.force_dict(
+            self.db_api._job_get_by_id)(self.job['id'])
+        del orm_job['inline_metadata']
+        job = self.db_api.job_get_by_id(self.job['id'])
+        self.assertEqual(job, orm_job)
+
+    def test_schedule_update_result_matches_get(self):
+        schedule = self.db_api.schedule_update(
+            self.schedule['id'],
+            {'hour': '3',
+             'schedule_metadata': [{'key': 'instance_id', 'value': 'new'}]})
+        self.assertEqual(schedule['hour'], 3)
+        self.assertEqual(schedule,
+                         self.db_api.schedule_get_by_id(self.schedule['id']))
+
+    def test_job_update_result_matches_get(self):
+        job = self.db_api.job_update(self.job['id'], {'status': 'DONE'})
+        self.assertEqual(job, self.db_api.job_get_by_id(self.job['id']))
+
+    def test_jobs_delete_hard_timed_out_deletes_metadata(self):
+        timeutils.set_time_override(self.job['hard_timeout'])
+        timeutils.advance_time_seconds(1)
+        self.assertEqual(self.db_api.jobs_delete_hard_timed_out(10), 1)
+        timeutils.clear_time_override()
+        session = self.db_api.get_session()
+        self.assertEqual(session.query(models.JobMetadata).count(), 0)
+
+    def test_schedule_get_all_marker_not_found(self):
+        self.assertRaises(exception.NotFound, self.db_api.schedule_get_all,
+                          {'marker': unit_utils.SCHEDULE_UUID5})
+
+    def test_job_updated_at_not_found(self):
+        self.assertRaises(exception.NotFound,
+                          self.db_api.job_updated_at_get_by_id,
+                          unit_utils.JOB_UUID5)
+
+
+class TestInlineMetadataSqlalchemy(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestInlineMetadataSqlalchemy, self).setUp()
+        self.db_api = qonos.db.sqlalchemy.api
+        self.engine = self.db_api._ENGINE
+        self.config(sql_inline_metadata=True)
+        now = timeutils.utcnow()
+        self.schedule = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'next_run': now,
+            'schedule_metadata': [{'key': 'instance_id', 'value': 'my_%id'}],
+        })
+        self.job = self.db_api.job_create({
+            'schedule_id': self.schedule['id'],
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'timeout': now,
+            'hard_timeout': now,
+            'job_metadata': [{'key': 'instance_id', 'value': 'my_%id'}],
+        })
+
+    def tearDown(self):
+        super(TestInlineMetadataSqlalchemy, self).tearDown()
+        self.db_api.reset()
+
+    def test_create_writes_no_metadata_rows(self):
+        session = self.db_api.get_session()
+        self.assertEqual(session.query(models.ScheduleMetadata).count(), 0)
+        self.assertEqual(session.query(models.JobMetadata).count(), 0)
+        meta = self.job['job_metadata'][0]
+        self.assertEqual((meta['job_id'], meta['key'], meta['value']),
+                         (self.job['id'], 'instance_id', 'my_%id'))
+        self.assertEqual(self.db_api.job_meta_get_all_by_job_id(
+            self.job['id']), self.job['job_metadata'])
+        self.assertFalse('inline_metadata' in self.job)
+
+    def test_copy_metadata_to_columns(self):
+        self.config(sql_inline_metadata=False)
+        job = self.db_api.job_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'timeout': self.job['timeout'],
+            'hard_timeout': self.job['hard_timeout'],
+            'job_metadata': [{'key': 'a', 'value': '1'},
+                             {'key': 'b', 'value': '2'}],
+        })
+
+        self.assertEqual(migration.copy_metadata_to_columns(self.engine), 3)
+
+        self.config(sql_inline_metadata=True)
+        metadata = self.db_api.job_meta_get_all_by_job_id(job['id'])
+        self.assertEqual([(m['key'], m['value']) for m in metadata],
+                         [('a', '1'), ('b', '2')])
+        # NOTE: schedule metadata was only ever kept inline, so the copy
+        # clears it
+        schedule = self.db_api.schedule_get_by_id(self.schedule['id'])
+        self.assertEqual(schedule['schedule_metadata'], [])
+
+
+class TestReadReplicaSqlalchemy(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestReadReplicaSqlalchemy, self).setUp()
+        self.db_api = qonos.db.sqlalchemy.api
+        # NOTE: a separate, empty database stands in for a replica which
+        # has not caught up yet
+        replica = sqlalchemy.create_engine('sqlite://')
+        models.register_models(replica)
+        self.stubs.Set(self.db_api, '_SLAVE_ENGINE', replica)
+        self.stubs.Set(self.db_api, '_SLAVE_MAKER', None)
+        self.schedule = self.db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+        })
+        self.worker = self.db_api.worker_create({'host': 'worker-host'})
+
+    def tearDown(self):
+        super(TestReadReplicaSqlalchemy, self).tearDown()
+        self.db_api.reset()
+
+    def test_reads_go_to_replica(self):
+        self.assertEqual(self.db_api.schedule_get_all(), [])
+        self.assertEqual(self.db_api.worker_get_all(), [])
+        self.assertRaises(exception.NotFound, self.db_api.schedule_get_by_id,
+                          self.schedule['id'])
+
+    def test_consistent_reads_go_to_primary(self):
+        schedules = self.db_api.schedule_get_all(consistent=True)
+        self.assertEqual([s['id'] for s in schedules], [self.schedule['id']])
+        schedule = self.db_api.schedule_get_by_id(self.schedule['id'],
+                                                  consistent=True)
+        self.assertEqual(schedule['id'], self.schedule['id'])
+        worker = self.db_api.worker_get_by_id(self.worker['id'],
+                                              consistent=True)
+        self.assertEqual(worker['id'], self.worker['id'])
+
+    def test_writes_go_to_primary(self):
+        self.db_api.schedule_update(self.schedule['id'], {'hour': 3})
+        schedule = self.db_api.schedule_get_by_id(self.schedule['id'],
+                                                  consistent=True)
+        self.assertEqual(schedule['hour'], 3)
+
+    def test_marker_missing_from_replica_is_found_on_primary(self):
+        schedules = self.db_api.schedule_get_all(
+            {'marker': self.schedule['id']})
+        self.assertEqual(schedules, [])
+        self.assertRaises(exception.NotFound, self.db_api.schedule_get_all,
+                          {'marker': unit_utils.SCHEDULE_UUID5})
+
+
+class TestQueryStatsSqlalchemy(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestQueryStatsSqlalchemy, self).setUp()
+        self.db_api = qonos.db.sqlalchemy.api
+
+    def tearDown(self):
+        super(TestQueryStatsSqlalchemy, self).tearDown()
+        query_stats.stop()
+        self.db_api.reset()
+
+    def _count_queries(self, func, *args):
+        query_stats.start()
+        func(*args)
+        return query_stats.stop().count
+
+    def _create_schedules(self):
+        for i in range(3):
+            self.db_api.schedule_create({
+                'tenant': unit_utils.TENANT1,
+                'action': 'snapshot',
+                'schedule_metadata': [{'key': 'instance_id',
+                                       'value': 'inst-%d' % i}],
+            })
+
+    def test_schedule_list_reads_metadata_in_one_query(self):
+        self._create_schedules()
+        self.assertEqual(self._count_queries(self.db_api.schedule_get_all),
+                         2)
+
+    def test_schedule_list_inline_metadata_in_one_query(self):
+        self.config(sql_inline_metadata=True)
+        self._create_schedules()
+        self.assertEqual(self._count_queries(self.db_api.schedule_get_all),
+                         1)
+
+    def test_slowest_statement_recorded(self):
+        query_stats.start()
+        self.db_api.job_get_all()
+        stats = query_stats.stop()
+        self.assertTrue(stats.slowest_statement.startswith('SELECT'))
+        self.assertTrue(stats.total_time >= stats.slowest_time)
+
+
+class TestMigrationSqlalchemy(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestMigrationSqlalchemy, self).setUp()
+        self.engine = qonos.db.sqlalchemy.api._ENGINE
+
+    def _index_names(self, model):
+        inspector = reflection.Inspector.from_engine(self.engine)
+        return set(index['name'] for index in
+                   inspector.get_indexes(model.__tablename__))
+
+    def test_db_sync_is_latest_after_configure(self):
+        self.assertEqual(migration.db_version(self.engine),
+                         migration.LATEST_VERSION)
+        self.assertEqual(migration.db_sync(self.engine),
+                         migration.LATEST_VERSION)
+
+    def test_db_sync_adds_indexes_to_existing_schema(self):
+        for index in models.Job.__table__.indexes:
+            index.drop(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.delete())
+        self.assertEqual(migration.db_version(self.engine), 0)
+        self.assertFalse('ix_jobs_action_created_at' in
+                         self._index_names(models.Job))
+
+        version = migration.db_sync(self.engine)
+
+        self.assertEqual(version, migration.LATEST_VERSION)
+        self.assertEqual(migration.db_version(self.engine), version)
+        self.assertTrue('ix_jobs_action_created_at' in
+                        self._index_names(models.Job))
+        self.assertTrue('ix_jobs_status_updated_at' in
+                        self._index_names(models.Job))
+        self.assertTrue('ix_schedules_next_run' in
+                        self._index_names(models.Schedule))
+
+    def test_db_sync_unknown_version(self):
+        self.assertRaises(exception.Invalid, migration.db_sync, self.engine,
+                          migration.LATEST_VERSION + 1)
+
+    def test_db_sync_adds_inline_metadata_columns(self):
+        jobs = models.Job.__table__
+        old_meta = sqlalchemy.MetaData()
+        sqlalchemy.Table(jobs.name, old_meta,
+                         *[column.copy() for column in jobs.columns
+                           if column.name != 'inline_metadata'])
+        jobs.drop(self.engine)
+        old_meta.create_all(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=2))
+
+        self.assertEqual(migration.db_sync(self.engine),
+                         migration.LATEST_VERSION)
+
+        inspector = reflection.Inspector.from_engine(self.engine)
+        self.assertTrue('inline_metadata' in
+                        [c['name'] for c in inspector.get_columns(jobs.name)])
+        qonos.db.sqlalchemy.api.reset()
+
+    def test_db_sync_fills_schedule_instance_ids(self):
+        api = qonos.db.sqlalchemy.api
+        schedule = api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'schedule_metadata': [{'key': 'instance_id', 'value': 'inst-1'}],
+        })
+        schedules = models.Schedule.__table__
+        self.engine.execute(schedules.update().values(
+            instance_id=None, updated_at=schedules.c.updated_at))
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=3))
+
+        migration.db_sync(self.engine)
+
+        row = self.engine.execute(schedules.select()).first()
+        self.assertEqual(row['instance_id'], 'inst-1')
+        self.assertEqual(row['updated_at'], schedule['updated_at'])
+        api.reset()
+
+    def test_db_sync_adds_job_fault_filter_indexes(self):
+        for index in models.JobFault.__table__.indexes:
+            if index.name != 'ix_job_faults_job_id_created_at':
+                index.drop(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=4))
+
+        migration.db_sync(self.engine)
+
+        self.assertEqual(self._index_names(models.JobFault),
+                         set(['ix_job_faults_job_id_created_at',
+                              'ix_job_faults_schedule_id_id',
+                              'ix_job_faults_tenant_id',
+                              'ix_job_faults_action_id']))
+
+    def test_db_sync_replaces_single_column_fault_indexes(self):
+        faults = models.JobFault.__table__
+        for index in faults.indexes:
+            if index.name != 'ix_job_faults_job_id_created_at':
+                index.drop(self.engine)
+        old_meta = sqlalchemy.MetaData()
+        old_faults = sqlalchemy.Table(faults.name, old_meta,
+                                      *[column.copy()
+                                        for column in faults.columns])
+        for name in ('schedule_id', 'tenant', 'action'):
+            sqlalchemy.Index('ix_job_faults_' + name,
+                             old_faults.c[name]).create(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=8))
+
+        migration.db_sync(self.engine)
+
+        inspector = reflection.Inspector.from_engine(self.engine)
+        indexes = dict((index['name'], index['column_names'])
+                       for index in inspector.get_indexes(faults.name))
+        self.assertEqual(indexes, {
+            'ix_job_faults_job_id_created_at': ['job_id', 'created_at'],
+            'ix_job_faults_schedule_id_id': ['schedule_id', 'id'],
+            'ix_job_faults_tenant_id': ['tenant', 'id'],
+            'ix_job_faults_action_id': ['action', 'id'],
+        })
+        self.assertEqual(len(faults.indexes), 4)
+
+    def test_db_sync_adds_schedule_updated_at_index(self):
+        for index in models.Schedule.__table__.indexes:
+            if index.name == 'ix_schedules_updated_at':
+                index.drop(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=5))
+
+        migration.db_sync(self.engine)
+
+        self.assertTrue('ix_schedules_updated_at' in
+                        self._index_names(models.Schedule))
+
+    def test_db_sync_fills_schedule_partition_keys(self):
+        api = qonos.db.sqlalchemy.api
+        schedule = api.schedule_create({'tenant': unit_utils.TENANT1,
+                                        'action': 'snapshot'})
+        schedules = models.Schedule.__table__
+        self.engine.execute(schedules.update().values(
+            partition_key=None, updated_at=schedules.c.updated_at))
+        models.SchedulerLease.__table__.drop(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=6))
+
+        migration.db_sync(self.engine)
+
+        row = self.engine.execute(schedules.select()).first()
+        self.assertEqual(row['partition_key'],
+                         db_utils.partition_key(schedule['id']))
+        self.assertEqual(row['updated_at'], schedule['updated_at'])
+        inspector = reflection.Inspector.from_engine(self.engine)
+        self.assertTrue('scheduler_leases' in inspector.get_table_names())
+        api.reset()
+
+    def test_db_sync_adds_job_scheduled_run(self):
+        jobs = models.Job.__table__
+        old_meta = sqlalchemy.MetaData()
+        sqlalchemy.Table(jobs.name, old_meta,
+                         *[column.copy() for column in jobs.columns
+                           if column.name != 'scheduled_run'])
+        jobs.drop(self.engine)
+        old_meta.create_all(self.engine)
+        self.engine.execute(migration._VERSION_TABLE.update().values(
+            version=7))
+
+        migration.db_sync(self.engine)
+
+        inspector = reflection.Inspector.from_engine(self.engine)
+        self.assertTrue('scheduled_run' in
+                        [c['name'] for c in inspector.get_columns(jobs.name)])
+        self.assertTrue('ix_jobs_schedule_id_scheduled_run' in
+                        self._index_names(models.Job))
+        qonos.db.sqlalchemy.api.reset()
@@ -132,6 +132,53 @@ class TestApi(utils.BaseTestCase):
         self.assertRaises(client_exc.NotFound, self.client.get_worker,
                           worker['id'])
 
+    def test_scheduler_lease_workflow(self):
+        request = {'schedule': {'tenant': TENANT1, 'action': 'snapshot',
+                                'minute': '30', 'hour': '12'}}
+        schedule = self.client.create_schedule(request)
+
+        # a lone scheduler holds every partition
+        lease = self.client.lease_partitions('scheduler-1', host='host-1')
+        self.assertEqual(lease['partitions'],
+                         range(lease['partition_count']))
+
+        partitions = ','.join(str(p) for p in lease['partitions'])
+        schedules = self.client.list_schedules({'partitions': partitions})
+        self.assertEqual([s['id'] for s in schedules], [schedule['id']])
+
+        # partitions are handed over on release
+        self.client.release_partitions('scheduler-1')
+        lease = self.client.lease_partitions('scheduler-2')
+        self.assertEqual(lease['partitions'],
+                         range(lease['partition_count']))
+        self.client.release_partitions('scheduler-2')
+        self.client.delete_schedule(schedule['id'])
+
+    def test_schedule_load_workflow(self):
+        request = {'schedule': {'tenant': TENANT1, 'action': 'snapshot',
+                                'minute': '30', 'hour': '12'}}
+        schedule = self.client.create_schedule(request)
+
+        load = self.client.get_schedule_load()
+        self.assertEqual(load, [{'minute': schedule['next_run'],
+                                 'count': 1}])
+        load = self.client.get_schedule_load(
+            next_run_before=schedule['next_run'].replace('30:00', '29:00'))
+        self.assertEqual(load, [])
+        self.client.delete_schedule(schedule['id'])
+
+    def test_job_forecast_workflow(self):
+        request = {'schedule': {'tenant': TENANT1, 'action': 'snapshot',
+                                'minute': '30', 'hour': '12'}}
+        schedule = self.client.create_schedule(request)
+
+        forecast = self.client.get_job_forecast('2013-01-01T12:00:00Z',
+                                                '2013-01-03T00:00:00Z',
+                                                bucket_minutes=24 * 60)
+        self.assertEqual([bucket['jobs'] for bucket in forecast],
+                         [{'snapshot': 1}, {'snapshot': 1}])
+        self.client.delete_schedule(schedule['id'])
+
     def test_schedule_workflow(self):
         schedules = self.client.list_schedules()
         self.assertEqual(len(schedules), 0)
@@ -234,6 +281,9 @@ class TestApi(utils.BaseTestCase):
         filters['instance_id'] = 'aaaa-bbbb-cccc-dddd'
         schedules = self.client.list_schedules(filter_args=filters)
         self.assertEqual(len(schedules), 0)
+        filters['instance_id'] = 'aaaa-bbbb-cccc-dddd,my_instance_1'
+        schedules = self.client.list_schedules(filter_args=filters)
+        self.assertEqual(len(schedules), 1)
 
         #update schedule
         request = {'schedule': {'hour': 14}}
@@ -432,12 +482,31 @@ class TestApi(utils.BaseTestCase):
         self.assertNotEqual(job_fault['updated_at'], None)
         self.assertNotEqual(job_fault['id'], None)
 
+        # list the job's faults
+        faults = self.client.list_job_faults({'job_id': job['id']})
+        self.assertEqual(len(faults), 1)
+        self.assertEqual(faults[0]['id'], job_fault['id'])
+        self.assertEqual(faults[0]['message'], error_message)
+
         # delete job
         self.client.delete_job(job['id'])
 
         # make sure job no longer exists
         self.assertRaises(client_exc.NotFound, self.client.get_job, job['id'])
 
+        # no jobs have been archived
+        self.assertEqual(self.client.list_archived_jobs(), [])
+
+        # enqueue jobs for every due schedule
+        next_run_before = updated_schedule['next_run']
+        job_ids = self.client.enqueue_jobs(next_run_before)
+        self.assertEqual(len(job_ids), 1)
+        job = self.client.get_job(job_ids[0])
+        self.assertEqual(job['schedule_id'], schedule['id'])
+        self.assertEqual(job['status'], 'queued')
+        self.assertMetadataInList(job['metadata'], meta_fixture1)
+        self.client.delete_job(job['id'])
+
     def test_job_meta_workflow(self):
 
         # (setup) create job
@@ -576,6 +645,16 @@ class TestApi(utils.BaseTestCase):
         schedule_ids = set(s['id'] for s in schedules[1:3])
         self.assertEqual(response_ids, schedule_ids)
 
+        #list schedules page by page following the cursor
+        filter_args = {'limit': '3'}
+        page, cursor = self.client.list_schedules_page(filter_args)
+        self.assertEqual(len(page), 3)
+        filter_args['cursor'] = cursor
+        next_page, cursor = self.client.list_schedules_page(filter_args)
+        self.assertEqual(cursor, None)
+        response_ids = [r['id'] for r in page + next_page]
+        self.assertEqual(response_ids, [s['id'] for s in schedules])
+
         # list workers
         response = self.client.list_workers()
         self.assertEqual(len(response), 4)
@@ -16,20 +16,18 @@
 
 import sys
 
-from qonos.openstack.common import cfg
 from qonos.tests.functional.v1 import base
 from qonos.tests import utils as utils
 
-CONF = cfg.CONF
 
+class SimpleDBMixin(object):
+    """Run the API on the simple db api."""
 
-def setUpModule():
-    CONF.db_api = 'qonos.db.simple.api'
-
-
-def tearDownModule():
-    CONF.db_api = None
+    def setUp(self):
+        self.config(db_api='qonos.db.simple.api')
+        super(SimpleDBMixin, self).setUp()
 
 
 module = sys.modules[__name__]
-utils.import_test_cases(module, base, suffix="_Simple_DB")
+utils.import_test_cases(module, base, suffix="_Simple_DB",
+                        mixins=[SimpleDBMixin])
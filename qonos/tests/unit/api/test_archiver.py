@@ -0,0 +1,67 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from qonos.api import archiver
+from qonos.openstack.common import timeutils
+from qonos.tests import utils as test_utils
+
+
+class FakeDBApi(object):
+
+    def __init__(self, finished):
+        self.finished = finished
+        self.calls = []
+
+    def jobs_archive_finished(self, finished_before, limit):
+        self.calls.append((finished_before, limit))
+        moved = min(limit, self.finished)
+        self.finished -= moved
+        return moved
+
+
+class TestJobArchiver(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestJobArchiver, self).setUp()
+        self.config(job_archive_batch_size=2, job_archive_age=60,
+                    group='api')
+        timeutils.set_time_override()
+
+    def tearDown(self):
+        timeutils.clear_time_override()
+        super(TestJobArchiver, self).tearDown()
+
+    def test_archive_in_batches(self):
+        db_api = FakeDBApi(3)
+        self.assertEqual(archiver.JobArchiver(db_api).archive(), 3)
+        finished_before = timeutils.utcnow() - datetime.timedelta(seconds=60)
+        self.assertEqual(db_api.calls, [(finished_before, 2),
+                                        (finished_before, 2)])
+
+    def test_archive_logs_errors(self):
+        db_api = FakeDBApi(0)
+
+        def fake_archive(*args, **kwargs):
+            raise Exception('DB is away')
+
+        self.stubs.Set(db_api, 'jobs_archive_finished', fake_archive)
+        self.assertEqual(archiver.JobArchiver(db_api).archive(), 0)
+
+    def test_start_disabled(self):
+        self.config(job_archive_interval=0, group='api')
+        self.assertEqual(archiver.JobArchiver(FakeDBApi(0)).start(), None)
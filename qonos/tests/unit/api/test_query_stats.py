@@ -0,0 +1,123 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from eventlet import tpool
+import webob
+import webob.dec
+
+from qonos.api.middleware import query_stats as query_stats_middleware
+from qonos.api import query_reporter
+from qonos.db import query_stats
+from qonos.openstack.common import wsgi
+from qonos.tests import utils as test_utils
+
+
+class FakeController(object):
+    pass
+
+
+class FakeApp(object):
+
+    def __init__(self, queries, routed=True, in_thread=False):
+        self.queries = queries
+        self.routed = routed
+        self.in_thread = in_thread
+
+    def _run_queries(self):
+        for statement, duration in self.queries:
+            query_stats.record(statement, duration)
+
+    @webob.dec.wsgify
+    def __call__(self, req):
+        if self.routed:
+            match = {'controller': wsgi.Resource(FakeController()),
+                     'action': 'list'}
+            req.environ['wsgiorg.routing_args'] = ((), match)
+        if self.in_thread:
+            tpool.execute(query_stats.bind(self._run_queries))
+        else:
+            self._run_queries()
+        return webob.Response()
+
+
+class TestQueryStatsFilter(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestQueryStatsFilter, self).setUp()
+        query_stats.reset()
+
+    def tearDown(self):
+        super(TestQueryStatsFilter, self).tearDown()
+        query_stats.reset()
+
+    def _get(self, app):
+        middleware = query_stats_middleware.QueryStatsFilter(app)
+        return webob.Request.blank('/v1/schedules').get_response(middleware)
+
+    def test_headers(self):
+        app = FakeApp([('SELECT 1', 0.002), ('SELECT 2', 0.005)])
+        response = self._get(app)
+        self.assertEqual(response.headers['X-Qonos-Query-Count'], '2')
+        self.assertEqual(response.headers['X-Qonos-Query-Time-Ms'], '7.000')
+        self.assertEqual(response.headers['X-Qonos-Slowest-Query-Time-Ms'],
+                         '5.000')
+
+    def test_headers_queries_in_native_thread(self):
+        app = FakeApp([('SELECT 1', 0.002), ('SELECT 2', 0.005)],
+                      in_thread=True)
+        response = self._get(app)
+        self.assertEqual(response.headers['X-Qonos-Query-Count'], '2')
+        self.assertEqual(response.headers['X-Qonos-Query-Time-Ms'], '7.000')
+
+    def test_route_totals(self):
+        self._get(FakeApp([('SELECT 1', 0.002), ('SELECT 2', 0.005)]))
+        self._get(FakeApp([('SELECT 3', 0.001)]))
+        routes = query_stats.routes_snapshot()
+        self.assertEqual(routes.keys(), ['FakeController.list'])
+        totals = routes['FakeController.list']
+        self.assertEqual(totals['requests'], 2)
+        self.assertEqual(totals['queries'], 3)
+        self.assertEqual(totals['max_queries'], 2)
+        self.assertEqual(totals['slowest_statement'], 'SELECT 2')
+
+    def test_unrouted_request(self):
+        response = self._get(FakeApp([], routed=False))
+        self.assertEqual(response.headers['X-Qonos-Query-Count'], '0')
+        self.assertEqual(query_stats.routes_snapshot().keys(),
+                         [query_stats_middleware.UNROUTED])
+
+    def test_queries_outside_requests_not_counted(self):
+        query_stats.record('SELECT 1', 0.001)
+        self.assertEqual(query_stats.stop(), None)
+        self.assertEqual(query_stats.routes_snapshot(), {})
+
+
+class TestQueryStatsReporter(test_utils.BaseTestCase):
+
+    def tearDown(self):
+        super(TestQueryStatsReporter, self).tearDown()
+        query_stats.reset()
+
+    def test_report(self):
+        stats = query_stats.QueryStats()
+        stats.record('SELECT 1', 0.5)
+        query_stats.add_route('SchedulesController.list', stats)
+        routes = query_reporter.QueryStatsReporter().report()
+        self.assertEqual(routes['SchedulesController.list']['queries'], 1)
+
+    def test_start_disabled(self):
+        self.config(query_stats_report_interval=0, group='api')
+        self.assertEqual(query_reporter.QueryStatsReporter().start(), None)
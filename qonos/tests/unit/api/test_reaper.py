@@ -0,0 +1,77 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from qonos.api import reaper
+from qonos.openstack.common import loopingcall
+from qonos.tests import utils as test_utils
+
+
+class FakeDBApi(object):
+
+    def __init__(self, expired):
+        self.expired = expired
+        self.calls = []
+
+    def jobs_delete_hard_timed_out(self, limit, record_faults=False):
+        self.calls.append((limit, record_faults))
+        deleted = min(limit, self.expired)
+        self.expired -= deleted
+        return deleted
+
+
+class TestJobReaper(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestJobReaper, self).setUp()
+        self.config(job_reaper_batch_size=2, group='api')
+
+    def test_reap_deletes_in_batches(self):
+        db_api = FakeDBApi(5)
+        self.assertEqual(reaper.JobReaper(db_api).reap(), 5)
+        self.assertEqual(db_api.calls, [(2, True), (2, True), (2, True)])
+
+    def test_reap_stops_on_exact_batch(self):
+        db_api = FakeDBApi(4)
+        self.config(job_reaper_record_faults=False, group='api')
+        self.assertEqual(reaper.JobReaper(db_api).reap(), 4)
+        self.assertEqual(db_api.calls, [(2, False), (2, False), (2, False)])
+
+    def test_reap_logs_errors(self):
+        db_api = FakeDBApi(0)
+
+        def fake_delete(*args, **kwargs):
+            raise Exception('DB is away')
+
+        self.stubs.Set(db_api, 'jobs_delete_hard_timed_out', fake_delete)
+        self.assertEqual(reaper.JobReaper(db_api).reap(), 0)
+
+    def test_start_disabled(self):
+        self.config(job_reaper_interval=0, group='api')
+        self.assertEqual(reaper.JobReaper(FakeDBApi(0)).start(), None)
+
+    def test_start(self):
+        self.config(job_reaper_interval=30, group='api')
+        started = {}
+
+        def fake_start(timer, interval, initial_delay=None):
+            started['interval'] = interval
+            started['initial_delay'] = initial_delay
+
+        self.stubs.Set(loopingcall.LoopingCall, 'start', fake_start)
+        db_api = FakeDBApi(0)
+        timer = reaper.JobReaper(db_api).start()
+        self.assertEqual(timer.f.__self__.db_api, db_api)
+        self.assertEqual(started, {'interval': 30, 'initial_delay': 30})
@@ -0,0 +1,115 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+
+from croniter.croniter import croniter
+
+from qonos.common import cron
+from qonos.tests import utils as test_utils
+
+
+class TestCron(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestCron, self).setUp()
+        self.start = datetime.datetime(2013, 2, 27, 23, 59, 30)
+
+    def _assert_matches_croniter(self, *fields):
+        expected = croniter(' '.join(fields), self.start).get_next(
+            datetime.datetime)
+        expression = cron.get_expression(*fields)
+        self.assertTrue(isinstance(expression, cron.CronExpression))
+        self.assertEqual(expression.next_after(self.start), expected)
+
+    def test_matches_croniter(self):
+        for fields in (('*', '*', '*', '*', '*'),
+                       ('30', '2', '*', '*', '*'),
+                       ('*/15', '*/6', '*', '*', '*'),
+                       ('0', '9-17/2', '*', '*', 'mon-fri'),
+                       ('5,10', '0', '1', 'jan,jul', '*'),
+                       ('0', '0', '*', '*', '7'),
+                       ('0', '0', '29', '*', '*'),
+                       ('59', '23', '28', '*', '*'),
+                       ('0', '12', '*', '3', '1'),
+                       ('10/20', '3', '*', '*', '*'),
+                       ('50/1', '22/1', '*', '*', '*'),
+                       ('0', '0', '*', '*', '2/5'),
+                       ('0', '0', '*', '*', '*/3'),
+                       ('0', '0', '*', '*', '5-7')):
+            self._assert_matches_croniter(*fields)
+
+    def test_day_of_month_or_day_of_week(self):
+        expression = cron.get_expression('0', '0', '15', '*', '1')
+        self.assertEqual(expression.next_after(self.start),
+                         datetime.datetime(2013, 3, 4))
+        self.assertEqual(expression.next_after(datetime.datetime(2013, 3,
+                                                                 12)),
+                         datetime.datetime(2013, 3, 15))
+
+    def test_next_after_is_strictly_after(self):
+        start = datetime.datetime(2013, 1, 1, 2, 30)
+        self.assertEqual(cron.next_run(30, 2, start_time=start),
+                         datetime.datetime(2013, 1, 2, 2, 30))
+
+    def test_empty_fields_mean_any(self):
+        self.assertEqual(cron.get_expression(None, '', 5),
+                         cron.get_expression('*', '*', '5'))
+
+    def test_zero_fields_are_zero(self):
+        # NOTE: an hour of 0 is midnight, not every hour
+        start = datetime.datetime(2013, 1, 1, 5, 15)
+        self.assertEqual(cron.next_run(0, 0, start_time=start),
+                         datetime.datetime(2013, 1, 2, 0, 0))
+        self.assertEqual(cron.get_expression(0, 0).minutes, 1)
+
+    def test_expressions_memoized(self):
+        self.assertTrue(cron.get_expression('30', '2') is
+                        cron.get_expression(30, 2))
+
+    def test_croniter_only_syntax(self):
+        expression = cron.get_expression('0', '0', 'L', '*', '*')
+        self.assertFalse(isinstance(expression, cron.CronExpression))
+        self.assertEqual(expression.next_after(self.start),
+                         datetime.datetime(2013, 2, 28))
+
+    def test_never_matches(self):
+        expression = cron.get_expression('0', '0', '31', '2', '*')
+        self.assertRaises(ValueError, expression.next_after, self.start)
+
+    def test_runs_between(self):
+        expression = cron.get_expression('0', '*/8')
+        runs = expression.runs_between(datetime.datetime(2013, 1, 1),
+                                       datetime.datetime(2013, 1, 2, 8))
+        self.assertEqual(list(runs),
+                         [datetime.datetime(2013, 1, 1, 0),
+                          datetime.datetime(2013, 1, 1, 8),
+                          datetime.datetime(2013, 1, 1, 16),
+                          datetime.datetime(2013, 1, 2, 0)])
+
+    def test_runs_between_never_matches(self):
+        expression = cron.get_expression('0', '0', '31', '2', '*')
+        self.assertEqual(list(expression.runs_between(self.start,
+                                                      self.start)), [])
+
+    def test_next_runs(self):
+        schedules = [{'minute': '30', 'hour': '2'},
+                     {'minute': '0', 'hour': '*', 'day_of_week': '5'},
+                     {'minute': 30, 'hour': 2}]
+        self.assertEqual(cron.next_runs(schedules, self.start),
+                         [datetime.datetime(2013, 2, 28, 2, 30),
+                          datetime.datetime(2013, 3, 1, 0, 0),
+                          datetime.datetime(2013, 2, 28, 2, 30)])
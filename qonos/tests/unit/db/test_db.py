@@ -0,0 +1,60 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from eventlet import tpool
+
+import qonos.db
+from qonos.db import query_stats
+import qonos.db.simple.api
+from qonos.tests import utils as utils
+
+
+class TestGetApi(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestGetApi, self).setUp()
+        self.config(db_api='qonos.db.simple.api')
+
+    def tearDown(self):
+        super(TestGetApi, self).tearDown()
+        qonos.db.simple.api.reset()
+
+    def test_get_api(self):
+        self.assertTrue(qonos.db.get_api() is qonos.db.simple.api)
+
+    def test_get_api_tpool(self):
+        self.config(sql_use_tpool=True)
+        db_api = qonos.db.get_api()
+        self.assertTrue(isinstance(db_api, tpool.Proxy))
+        worker = db_api.worker_create({'host': 'foo'})
+        self.assertEqual(worker['host'], 'foo')
+
+    def test_get_api_tpool_counts_queries(self):
+        self.config(sql_use_tpool=True)
+
+        def fake_worker_get_all(params={}, consistent=False):
+            query_stats.record('SELECT 1', 0.001)
+            return []
+        self.stubs.Set(qonos.db.simple.api, 'worker_get_all',
+                       fake_worker_get_all)
+
+        db_api = qonos.db.get_api()
+        query_stats.start()
+        try:
+            db_api.worker_get_all()
+        finally:
+            stats = query_stats.stop()
+        self.assertEqual(stats.count, 1)
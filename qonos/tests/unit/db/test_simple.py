@@ -0,0 +1,263 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+from qonos.db.simple import api as db_api
+from qonos.db.simple import journal
+from qonos.openstack.common import timeutils
+from qonos.tests import utils
+
+
+class TestSimpleJournal(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSimpleJournal, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'qonos.journal')
+        self.config(simple_db_journal=self.path)
+        db_api.reset()
+        db_api.configure_db()
+
+    def tearDown(self):
+        self._close()
+        db_api.reset()
+        shutil.rmtree(self.tmp_dir)
+        super(TestSimpleJournal, self).tearDown()
+
+    def _close(self):
+        if db_api._JOURNAL is not None:
+            db_api._JOURNAL.close()
+            db_api._JOURNAL = None
+
+    def _restart(self):
+        self._close()
+        for table in db_api.DATA:
+            db_api.DATA[table] = {}
+        db_api._reset_indexes()
+        db_api.configure_db()
+
+    def _create_schedule(self, tenant='tenant-1'):
+        return db_api.schedule_create({
+            'tenant': tenant,
+            'action': 'snapshot',
+            'next_run': datetime.datetime(2013, 1, 1, 2, 30, 0, 123),
+            'schedule_metadata': [{'key': 'instance_id',
+                                   'value': 'instance-1'}]})
+
+    def test_replays_changes(self):
+        schedule = self._create_schedule()
+        deleted = self._create_schedule()
+        db_api.schedule_delete(deleted['id'])
+        job = db_api.job_create({'schedule_id': schedule['id'],
+                                 'tenant': 'tenant-1',
+                                 'action': 'snapshot',
+                                 'job_metadata': [{'key': 'a',
+                                                   'value': 'b'}]})
+        db_api.job_update(job['id'], {'status': 'error'})
+        worker = db_api.worker_create({'host': 'host-1'})
+
+        self._restart()
+
+        self.assertEqual(db_api.schedule_get_by_id(schedule['id']), schedule)
+        self.assertEqual(db_api.schedule_get_all(), [schedule])
+        self.assertEqual(db_api.job_get_by_id(job['id'])['status'], 'error')
+        self.assertEqual(
+            db_api.job_meta_get_all_by_job_id(job['id'])[0]['value'], 'b')
+        self.assertEqual(db_api.worker_get_all(), [worker])
+
+    def test_replay_rebuilds_indexes(self):
+        schedule = self._create_schedule()
+        self._create_schedule(tenant='tenant-2')
+
+        self._restart()
+
+        for filters in ({'tenant': 'tenant-1'},
+                        {'instance_id': 'instance-1', 'tenant': 'tenant-1'},
+                        {'next_run_before': schedule['next_run'],
+                         'tenant': 'tenant-1'}):
+            schedules = db_api.schedule_get_all(filters)
+            self.assertEqual([s['id'] for s in schedules], [schedule['id']])
+
+    def test_journals_one_record_per_call(self):
+        self._create_schedule()
+        self._create_schedule()
+        self.assertEqual(db_api._JOURNAL.records, 2)
+
+    def test_compacts_into_snapshot(self):
+        self.config(simple_db_compact_records=3)
+        self._restart()
+        schedules = [self._create_schedule() for i in range(4)]
+
+        self.assertTrue(os.path.exists(self.path + '.snapshot'))
+        self.assertEqual(db_api._JOURNAL.records, 1)
+
+        self._restart()
+        self.assertEqual(len(db_api.schedule_get_all()), 4)
+        self.assertEqual(db_api.schedule_get_by_id(schedules[0]['id']),
+                         schedules[0])
+
+    def test_drops_incomplete_change(self):
+        schedule = self._create_schedule()
+        self._close()
+        with open(self.path, 'ab') as f:
+            f.write('[["schedules", "x", {"id": "x"')
+
+        self._restart()
+
+        self.assertEqual(db_api.schedule_get_all(), [schedule])
+        self._create_schedule()
+        self._restart()
+        self.assertEqual(len(db_api.schedule_get_all()), 2)
+
+    def test_reset_empties_store(self):
+        self._create_schedule()
+        db_api.reset()
+        self._restart()
+        self.assertEqual(db_api.schedule_get_all(), [])
+
+
+class TestJournalGroupCommit(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestJournalGroupCommit, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.syncs = []
+        self.stubs.Set(os, 'fsync', self.syncs.append)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        super(TestJournalGroupCommit, self).tearDown()
+
+    def _journal(self, sync_interval):
+        _journal = journal.Journal(os.path.join(self.tmp_dir, 'journal'),
+                                   sync_interval=sync_interval)
+        _journal.load()
+        self.addCleanup(_journal.close)
+        return _journal
+
+    def test_sync_every_commit(self):
+        _journal = self._journal(0)
+        _journal.commit([('jobs', '1', {'id': '1'})])
+        _journal.commit([('jobs', '1', None)])
+        self.assertEqual(len(self.syncs), 2)
+
+    def test_commits_share_a_sync(self):
+        _journal = self._journal(60)
+        now = timeutils.utcnow()
+        _journal.commit([('jobs', '1', {'id': '1', 'created_at': now})])
+        _journal.commit([('jobs', '2', {'id': '2', 'created_at': now})])
+        self.assertEqual(self.syncs, [])
+
+        _journal.sync()
+        self.assertEqual(len(self.syncs), 1)
+        _journal.sync()
+        self.assertEqual(len(self.syncs), 1)
+
+    def test_shared_sync_runs_off_the_hub(self):
+        _journal = self._journal(0.01)
+        synced = threading.Event()
+        self.stubs.Set(os, 'fsync', lambda fd: synced.set())
+
+        def commit():
+            _journal.commit([('jobs', '1', {'id': '1'})])
+
+        # NOTE: a native thread has no eventlet hub to run timers
+        thread = threading.Thread(target=commit)
+        thread.start()
+        thread.join()
+        synced.wait(5)
+        self.assertTrue(synced.is_set())
+
+
+class TestSimpleJobQueues(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSimpleJobQueues, self).setUp()
+        db_api.reset()
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1))
+
+    def tearDown(self):
+        timeutils.clear_time_override()
+        db_api.reset()
+        super(TestSimpleJobQueues, self).tearDown()
+
+    def _create_jobs(self, count, action='snapshot'):
+        now = timeutils.utcnow()
+        jobs = []
+        for i in range(count):
+            jobs.append(db_api.job_create({
+                'tenant': 'tenant-1',
+                'action': action,
+                'timeout': now + datetime.timedelta(minutes=5),
+                'hard_timeout': now + datetime.timedelta(hours=1)}))
+            timeutils.advance_time_seconds(1)
+        return jobs
+
+    def test_claims_skip_finished_leases(self):
+        jobs = self._create_jobs(3)
+        for job in jobs[:2]:
+            db_api.job_update(job['id'], {'worker_id': 'worker-1',
+                                          'status': 'DONE'})
+
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       'worker-2', 2)
+        self.assertEqual(job['id'], jobs[2]['id'])
+        self.assertEqual(len(db_api.INDEXES['leased_jobs']['snapshot']), 3)
+
+    def test_concurrent_claims(self):
+        self._create_jobs(50)
+        claimed = []
+
+        def claim(worker_id):
+            while True:
+                job = db_api.job_get_and_assign_next_by_action(
+                    'snapshot', worker_id, 2)
+                if job is None:
+                    return
+                claimed.append(job['id'])
+
+        threads = [threading.Thread(target=claim, args=('worker-%d' % i,))
+                   for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(claimed), 50)
+        self.assertEqual(len(set(claimed)), 50)
+
+    def test_queues_rebuilt_on_replay(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.config(simple_db_journal=os.path.join(tmp_dir, 'journal'))
+        db_api.configure_db()
+        jobs = self._create_jobs(2)
+        db_api.job_get_and_assign_next_by_action('snapshot', 'worker-1', 2)
+
+        db_api._JOURNAL.close()
+        db_api._JOURNAL = None
+        db_api._reset_indexes()
+        db_api.configure_db()
+        db_api._JOURNAL.close()
+        db_api._JOURNAL = None
+
+        job = db_api.job_get_and_assign_next_by_action('snapshot',
+                                                       'worker-2', 2)
+        self.assertEqual(job['id'], jobs[1]['id'])
@@ -14,7 +14,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from sqlalchemy.dialects import postgresql
+
 import qonos.db.sqlalchemy.api as db_api
+from qonos.db.sqlalchemy import models
 from qonos.tests import utils as utils
 
 
@@ -53,3 +56,104 @@ class TestSqlalchemySpecificApi(utils.BaseTestCase):
         self.assertTrue(isinstance(value[0], dict))
         self.assertEqual(value[0].get('foo'), 'bar')
         self.assertFalse('_sa_instance_state' in value[1])
+
+
+class FakeDialect(object):
+
+    def __init__(self, name, server_version_info):
+        self.name = name
+        self.server_version_info = server_version_info
+
+
+class TestJobClaimSqlalchemyApi(utils.BaseTestCase):
+
+    def test_supports_skip_locked(self):
+        self.assertTrue(db_api._supports_skip_locked(
+            FakeDialect('postgresql', (9, 5))))
+        self.assertTrue(db_api._supports_skip_locked(
+            FakeDialect('mysql', (8, 0, 21))))
+
+    def test_supports_skip_locked_old_server(self):
+        self.assertFalse(db_api._supports_skip_locked(
+            FakeDialect('postgresql', (9, 4, 10))))
+        self.assertFalse(db_api._supports_skip_locked(
+            FakeDialect('mysql', (5, 6, 40))))
+        self.assertFalse(db_api._supports_skip_locked(
+            FakeDialect('mysql', (10, 3, 2, 'MariaDB'))))
+
+    def test_supports_skip_locked_mariadb(self):
+        self.assertTrue(db_api._supports_skip_locked(
+            FakeDialect('mysql', (10, 6, 12, 'MariaDB'))))
+        # MySQLdb reports MariaDB 10 behind its replication prefix, as
+        # '5.5.5-10.6.12-MariaDB'
+        self.assertTrue(db_api._supports_skip_locked(
+            FakeDialect('mysql', (5, 5, 5, 10, 6, 12, 'MariaDB'))))
+        self.assertFalse(db_api._supports_skip_locked(
+            FakeDialect('mysql', (5, 5, 5, 10, 5, 9, 'MariaDB', 'log'))))
+
+    def test_mysql_server_version(self):
+        self.assertEqual(db_api._mysql_server_version(
+            (5, 5, 5, 10, 6, 12, 'MariaDB', '1:10', 6, '12+maria~focal')),
+            ((10, 6, 12), True))
+        self.assertEqual(db_api._mysql_server_version((8, 0, 21)),
+                         ((8, 0, 21), False))
+        self.assertEqual(db_api._mysql_server_version((5, 5, 5, 'log')),
+                         ((5, 5, 5), False))
+
+    def test_supports_skip_locked_sqlite(self):
+        self.assertFalse(db_api._supports_skip_locked(
+            FakeDialect('sqlite', (3, 7, 17))))
+
+    def test_skip_locked_select(self):
+        jobs = models.Job.__table__
+        query = db_api._SkipLockedSelect([jobs.c.id], limit=1,
+                                         for_update=True)
+        compiled = str(query.compile(dialect=postgresql.dialect()))
+        self.assertTrue(compiled.endswith('FOR UPDATE SKIP LOCKED'))
+
+
+class FakeConnectionRecord(object):
+
+    def __init__(self):
+        self.info = {}
+
+
+class FakeDBAPIConnection(object):
+
+    OperationalError = Exception
+
+    def __init__(self):
+        self.pings = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, sql):
+        self.pings += 1
+
+
+class TestPingListener(utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPingListener, self).setUp()
+        self.dbapi_conn = FakeDBAPIConnection()
+        self.connection_rec = FakeConnectionRecord()
+
+    def test_ping_every_checkout(self):
+        self.config(sql_ping_interval=0)
+        db_api.ping_listener(self.dbapi_conn, self.connection_rec, None)
+        db_api.ping_listener(self.dbapi_conn, self.connection_rec, None)
+        self.assertEqual(self.dbapi_conn.pings, 2)
+
+    def test_ping_within_interval_skipped(self):
+        self.config(sql_ping_interval=60)
+        db_api.ping_listener(self.dbapi_conn, self.connection_rec, None)
+        db_api.ping_listener(self.dbapi_conn, self.connection_rec, None)
+        self.assertEqual(self.dbapi_conn.pings, 1)
+
+    def test_ping_after_interval(self):
+        self.config(sql_ping_interval=60)
+        db_api.ping_listener(self.dbapi_conn, self.connection_rec, None)
+        self.connection_rec.info['last_ping'] -= 61
+        db_api.ping_listener(self.dbapi_conn, self.connection_rec, None)
+        self.assertEqual(self.dbapi_conn.pings, 2)
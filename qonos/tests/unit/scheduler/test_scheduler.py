@@ -14,15 +14,26 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import mox
 import time
 
 from qonos.openstack.common import timeutils
+from qonos.qonosclient import exception as client_exc
 from qonos.scheduler import scheduler
 from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils as test_utils
 
 
+class FakeClient(object):
+
+    def list_schedules_page(self, filter_args):
+        pass
+
+    def create_job(self, schedule_id, scheduled_run=None):
+        pass
+
+
 class TestScheduler(test_utils.BaseTestCase):
 
     def setUp(self):
@@ -40,6 +51,7 @@ class TestScheduler(test_utils.BaseTestCase):
 
     def test_run_loop(self):
         self.config(job_schedule_interval=5, group='scheduler')
+        self.config(schedule_cache=False, group='scheduler')
         timeutils.set_time_override()
         current_time = timeutils.isotime()
         called = {'enqueue_jobs': False}
@@ -57,6 +69,7 @@ class TestScheduler(test_utils.BaseTestCase):
 
     def test_run_loop_take_too_long(self):
         self.config(job_schedule_interval=-1, group='scheduler')
+        self.config(schedule_cache=False, group='scheduler')
         called = {'enqueue_jobs': False,
                   'log_warn': False}
 
@@ -77,18 +90,93 @@ class TestScheduler(test_utils.BaseTestCase):
         self.assertTrue(called['log_warn'])
 
     def test_enqueue_jobs(self):
-        called = {'get_schedules': False}
-
-        def fake(*args, **kwargs):
-            called['get_schedules'] = True
-            return [{'id': unit_utils.SCHEDULE_UUID1}]
+        end_time = timeutils.isotime()
+        self.client.enqueue_jobs(next_run_before=end_time)\
+            .AndReturn([unit_utils.JOB_UUID1])
+        self.mox.ReplayAll()
+        self.scheduler.enqueue_jobs(end_time=end_time)
+        self.mox.VerifyAll()
 
-        self.stubs.Set(self.scheduler, 'get_schedules', fake)
-        self.client.create_job(mox.IgnoreArg())
+    def test_enqueue_jobs_per_schedule(self):
+        self.config(bulk_enqueue=False, group='scheduler')
+        self.client.list_schedules_page(filter_args=mox.IgnoreArg())\
+            .AndReturn(([{'id': unit_utils.SCHEDULE_UUID1,
+                          'next_run': '2013-01-01T02:30:00Z'}], None))
+        self.client.create_job(unit_utils.SCHEDULE_UUID1,
+                               '2013-01-01T02:30:00Z')
         self.mox.ReplayAll()
         self.scheduler.enqueue_jobs()
         self.mox.VerifyAll()
 
+    def _fake_client(self, pages, fail=()):
+        calls = []
+
+        def list_schedules_page(filter_args):
+            calls.append(('list', filter_args.get('cursor')))
+            return pages[len([c for c in calls if c[0] == 'list']) - 1]
+
+        def create_job(schedule_id, scheduled_run=None):
+            calls.append(('create', schedule_id))
+            if schedule_id in fail:
+                raise fail[schedule_id]
+
+        self.stubs.Set(self.scheduler, 'client', FakeClient())
+        self.stubs.Set(self.scheduler.client, 'list_schedules_page',
+                       list_schedules_page)
+        self.stubs.Set(self.scheduler.client, 'create_job', create_job)
+        return calls
+
+    def test_enqueue_jobs_per_schedule_streams_pages(self):
+        self.config(bulk_enqueue=False, enqueue_concurrency=1,
+                    group='scheduler')
+        calls = self._fake_client([([{'id': 'a'}, {'id': 'b'}], 'cursor_1'),
+                                   ([{'id': 'c'}], None)])
+        self.scheduler.enqueue_jobs()
+        # the first page is being worked on before the second is fetched
+        self.assertTrue(calls.index(('create', 'a')) <
+                        calls.index(('list', 'cursor_1')))
+        self.assertEqual(sorted(c[1] for c in calls if c[0] == 'create'),
+                         ['a', 'b', 'c'])
+
+    def test_enqueue_jobs_per_schedule_isolates_errors(self):
+        self.config(bulk_enqueue=False, group='scheduler')
+        calls = self._fake_client([([{'id': 'a'}, {'id': 'b'},
+                                     {'id': 'c'}], None)],
+                                  fail={'a': client_exc.NotFound(),
+                                        'b': Exception('boom')})
+        self.scheduler.enqueue_jobs()
+        self.assertEqual(sorted(c[1] for c in calls if c[0] == 'create'),
+                         ['a', 'b', 'c'])
+
+    def test_create_jobs_reports_failures(self):
+        self._fake_client([], fail={'a': client_exc.NotFound(),
+                                    'b': Exception('boom')})
+        failed = self.scheduler._create_jobs([[('a', '2013-01-01T02:30:00Z'),
+                                               ('b', '2013-01-01T02:30:00Z'),
+                                               ('c', '2013-01-01T02:30:00Z')]])
+        # a schedule deleted since it was listed is not retried
+        self.assertEqual(failed, [('b', '2013-01-01T02:30:00Z')])
+
+    def test_run_cached_loop_per_schedule_retries_failures(self):
+        self.config(bulk_enqueue=False, group='scheduler')
+        slept = self._run_cached_once([
+            self._schedule(unit_utils.SCHEDULE_UUID1,
+                           '2013-01-01T02:29:00Z', '2013-01-01T00:00:00Z'),
+            self._schedule(unit_utils.SCHEDULE_UUID2,
+                           '2013-01-01T02:30:00Z', '2013-01-01T00:00:00Z')])
+        self.client.create_job(unit_utils.SCHEDULE_UUID1,
+                               '2013-01-01T02:29:00Z')
+        self.client.create_job(unit_utils.SCHEDULE_UUID2,
+                               '2013-01-01T02:30:00Z')\
+            .AndRaise(client_exc.BadRequest())
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+        self.assertEqual(slept, [5])
+        self.assertEqual(self.scheduler.cache.next_runs,
+                         {unit_utils.SCHEDULE_UUID2:
+                          datetime.datetime(2013, 1, 1, 2, 30)})
+
     def test_get_schedules(self):
         timeutils.set_time_override()
         start_time = timeutils.isotime()
@@ -97,7 +185,8 @@ class TestScheduler(test_utils.BaseTestCase):
 
         filter_args = {'next_run_after': start_time,
                        'next_run_before': end_time}
-        self.client.list_schedules(filter_args=filter_args).AndReturn([])
+        self.client.list_schedules_page(filter_args=filter_args)\
+            .AndReturn(([], None))
         self.mox.ReplayAll()
         self.scheduler.get_schedules(start_time, end_time)
         self.mox.VerifyAll()
@@ -106,7 +195,277 @@ class TestScheduler(test_utils.BaseTestCase):
         end_time = timeutils.isotime()
 
         filter_args = {'next_run_before': end_time}
-        self.client.list_schedules(filter_args=filter_args).AndReturn([])
+        self.client.list_schedules_page(filter_args=filter_args)\
+            .AndReturn(([], None))
         self.mox.ReplayAll()
         self.scheduler.get_schedules(end_time=end_time)
         self.mox.VerifyAll()
+
+    def test_get_schedules_follows_cursor(self):
+        end_time = timeutils.isotime()
+        page_1 = [{'id': unit_utils.SCHEDULE_UUID1}]
+        page_2 = [{'id': unit_utils.SCHEDULE_UUID2}]
+
+        self.client.list_schedules_page(filter_args=mox.IgnoreArg())\
+            .AndReturn((page_1, 'cursor_1'))
+        self.client.list_schedules_page(
+            filter_args={'next_run_before': end_time, 'cursor': 'cursor_1'})\
+            .AndReturn((page_2, None))
+        self.mox.ReplayAll()
+        schedules = self.scheduler.get_schedules(end_time=end_time)
+        self.mox.VerifyAll()
+        self.assertEqual(schedules, page_1 + page_2)
+
+    def _schedule(self, schedule_id, next_run, updated_at):
+        return {'id': schedule_id, 'next_run': next_run,
+                'updated_at': updated_at}
+
+    def test_sync_schedules_full_then_changed_since(self):
+        schedule = self._schedule(unit_utils.SCHEDULE_UUID1,
+                                  '2013-01-01T02:30:00Z',
+                                  '2013-01-01T00:00:05Z')
+        self.client.list_schedules_page(filter_args={})\
+            .AndReturn(([schedule], None))
+        self.client.list_schedules_page(
+            filter_args={'changed_since': '2012-12-31T23:59:05Z'})\
+            .AndReturn(([], None))
+        self.mox.ReplayAll()
+        self.scheduler.sync_schedules()
+        self.scheduler.sync_schedules()
+        self.mox.VerifyAll()
+        self.assertEqual(self.scheduler.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 2, 30))
+
+    def test_sync_schedules_picks_up_late_commits(self):
+        self.config(schedule_sync_overlap=30, group='scheduler')
+        first = self._schedule(unit_utils.SCHEDULE_UUID1,
+                               '2013-01-01T02:30:00Z',
+                               '2013-01-01T00:00:05Z')
+        # committed after the first sync, but stamped before it
+        late = self._schedule(unit_utils.SCHEDULE_UUID2,
+                              '2013-01-01T01:30:00Z',
+                              '2013-01-01T00:00:02Z')
+        self.client.list_schedules_page(filter_args={})\
+            .AndReturn(([first], None))
+        self.client.list_schedules_page(
+            filter_args={'changed_since': '2012-12-31T23:59:35Z'})\
+            .AndReturn(([first, late], None))
+        self.mox.ReplayAll()
+        self.scheduler.sync_schedules()
+        self.scheduler.sync_schedules()
+        self.mox.VerifyAll()
+        due = self.scheduler.cache.pop_due(datetime.datetime(2013, 1, 1, 3))
+        self.assertEqual(due, [
+            (unit_utils.SCHEDULE_UUID2, datetime.datetime(2013, 1, 1, 1, 30)),
+            (unit_utils.SCHEDULE_UUID1, datetime.datetime(2013, 1, 1, 2, 30)),
+        ])
+
+    def test_sync_schedules_full_sync_interval(self):
+        self.config(schedule_full_sync_interval=0, group='scheduler')
+        deleted = self._schedule(unit_utils.SCHEDULE_UUID1,
+                                 '2013-01-01T02:30:00Z',
+                                 '2013-01-01T00:00:05Z')
+        self.client.list_schedules_page(filter_args={})\
+            .AndReturn(([deleted], None))
+        self.client.list_schedules_page(filter_args={})\
+            .AndReturn(([], None))
+        self.mox.ReplayAll()
+        self.scheduler.sync_schedules()
+        self.scheduler.sync_schedules()
+        self.mox.VerifyAll()
+        self.assertEqual(self.scheduler.cache.next_due(), None)
+
+    def _run_cached_once(self, schedules):
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1, 2, 30))
+        self.addCleanup(timeutils.clear_time_override)
+        self.client.list_schedules_page(filter_args={})\
+            .AndReturn((schedules, None))
+        slept = []
+        self.stubs.Set(time, 'sleep', slept.append)
+        return slept
+
+    def test_run_cached_loop_enqueues_due(self):
+        slept = self._run_cached_once([
+            self._schedule(unit_utils.SCHEDULE_UUID1,
+                           '2013-01-01T02:29:00Z', '2013-01-01T00:00:00Z'),
+            self._schedule(unit_utils.SCHEDULE_UUID2,
+                           '2013-01-01T02:30:02Z', '2013-01-01T00:00:00Z')])
+        self.client.enqueue_jobs(next_run_before='2013-01-01T02:30:00Z')\
+            .AndReturn([unit_utils.JOB_UUID1])
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+        # woken when the second schedule is due rather than after 5s
+        self.assertEqual(slept, [2])
+        self.assertEqual(self.scheduler.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 2, 30, 2))
+
+    def test_run_cached_loop_idle(self):
+        slept = self._run_cached_once([
+            self._schedule(unit_utils.SCHEDULE_UUID1,
+                           '2013-01-01T03:30:00Z', '2013-01-01T00:00:00Z')])
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+        self.assertEqual(slept, [5])
+
+    def test_run_cached_loop_restores_on_failure(self):
+        slept = self._run_cached_once([
+            self._schedule(unit_utils.SCHEDULE_UUID1,
+                           '2013-01-01T02:29:00Z', '2013-01-01T00:00:00Z')])
+        self.client.enqueue_jobs(next_run_before='2013-01-01T02:30:00Z')\
+            .AndRaise(client_exc.BadRequest())
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+        # retried on the next poll
+        self.assertEqual(slept, [5])
+        self.assertEqual(self.scheduler.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 2, 29))
+
+    def test_run_cached_loop_restores_when_lease_ran_out(self):
+        self.config(sharded=True, group='scheduler')
+        timeutils.set_time_override(datetime.datetime(2013, 1, 1, 2, 30))
+        self.addCleanup(timeutils.clear_time_override)
+        self.stubs.Set(time, 'sleep', lambda seconds: None)
+        self._lease([1], ttl=0)
+        self.client.list_schedules_page(filter_args={'partitions': '1'})\
+            .AndReturn(([self._schedule(unit_utils.SCHEDULE_UUID1,
+                                        '2013-01-01T02:29:00Z',
+                                        '2013-01-01T00:00:00Z')], None))
+        self.client.release_partitions(self.scheduler.scheduler_id)
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+        self.assertEqual(self.scheduler.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 2, 29))
+
+    def test_run_cached_loop_per_schedule(self):
+        self.config(bulk_enqueue=False, group='scheduler')
+        self._run_cached_once([
+            self._schedule(unit_utils.SCHEDULE_UUID1,
+                           '2013-01-01T02:29:00Z', '2013-01-01T00:00:00Z'),
+            self._schedule(unit_utils.SCHEDULE_UUID2,
+                           '2013-01-01T02:30:00Z', '2013-01-01T00:00:00Z')])
+        self.client.create_job(unit_utils.SCHEDULE_UUID1,
+                               '2013-01-01T02:29:00Z')
+        self.client.create_job(unit_utils.SCHEDULE_UUID2,
+                               '2013-01-01T02:30:00Z')\
+            .AndRaise(client_exc.NotFound())
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+
+    def _lease(self, partitions, ttl=30):
+        self.client.lease_partitions(self.scheduler.scheduler_id,
+                                     host=mox.IgnoreArg())\
+            .AndReturn({'partitions': partitions, 'partition_count': 4,
+                        'ttl': ttl})
+
+    def test_run_loop_sharded(self):
+        self.config(sharded=True, schedule_cache=False, group='scheduler')
+        self.stubs.Set(time, 'sleep', lambda seconds: None)
+        self._lease([1, 3])
+        self.client.enqueue_jobs(next_run_before=mox.IgnoreArg(),
+                                 partitions=[1, 3]).AndReturn([])
+        self.client.release_partitions(self.scheduler.scheduler_id)
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+
+    def test_run_loop_sharded_without_partitions(self):
+        self.config(sharded=True, schedule_cache=False, group='scheduler')
+        self.stubs.Set(time, 'sleep', lambda seconds: None)
+        self._lease([])
+        self.mox.ReplayAll()
+        self.scheduler.run(run_once=True)
+        self.mox.VerifyAll()
+
+    def test_renew_lease_failure(self):
+        self.config(sharded=True, group='scheduler')
+        self.client.lease_partitions(self.scheduler.scheduler_id,
+                                     host=mox.IgnoreArg())\
+            .AndRaise(client_exc.BadRequest())
+        self.mox.ReplayAll()
+        self.assertFalse(self.scheduler.renew_lease())
+        self.mox.VerifyAll()
+
+    def test_sync_schedules_sharded(self):
+        self.config(sharded=True, group='scheduler')
+        schedule = self._schedule(unit_utils.SCHEDULE_UUID1,
+                                  '2013-01-01T02:30:00Z',
+                                  '2013-01-01T00:00:05Z')
+        self._lease([1, 3])
+        self.client.list_schedules_page(filter_args={'partitions': '1,3'})\
+            .AndReturn(([schedule], None))
+        self._lease([1])
+        self.client.list_schedules_page(filter_args={'partitions': '1'})\
+            .AndReturn(([], None))
+        self.mox.ReplayAll()
+        self.scheduler.renew_lease()
+        self.scheduler.sync_schedules()
+        # a new set of partitions starts the cache over
+        self.scheduler.renew_lease()
+        self.scheduler.sync_schedules()
+        self.mox.VerifyAll()
+        self.assertEqual(self.scheduler.cache.next_due(), None)
+
+    def test_enqueue_jobs_lease_ran_out(self):
+        self.config(sharded=True, group='scheduler')
+        self._lease([1], ttl=0)
+        self.mox.ReplayAll()
+        self.scheduler.renew_lease()
+        self.scheduler.enqueue_jobs(end_time=timeutils.isotime())
+        self.mox.VerifyAll()
+
+
+class TestScheduleCache(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestScheduleCache, self).setUp()
+        self.cache = scheduler.ScheduleCache()
+
+    def test_next_due_follows_updates(self):
+        self.cache.update([{'id': 'a', 'next_run': '2013-01-01T02:00:00Z',
+                            'updated_at': '2013-01-01T00:00:01Z'},
+                           {'id': 'b', 'next_run': '2013-01-01T03:00:00Z',
+                            'updated_at': '2013-01-01T00:00:02Z'}])
+        self.assertEqual(self.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 2))
+        self.cache.update([{'id': 'a', 'next_run': '2013-01-01T04:00:00Z',
+                            'updated_at': '2013-01-01T00:00:03Z'}])
+        self.assertEqual(self.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 3))
+        self.cache.update([{'id': 'b', 'next_run': None,
+                            'updated_at': '2013-01-01T00:00:04Z'}])
+        self.assertEqual(self.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 4))
+        self.assertEqual(self.cache.changed_since,
+                         datetime.datetime(2013, 1, 1, 0, 0, 4))
+
+    def test_pop_due(self):
+        self.cache.update([{'id': 'a', 'next_run': '2013-01-01T02:00:00Z'},
+                           {'id': 'b', 'next_run': '2013-01-01T02:00:00Z'},
+                           {'id': 'c', 'next_run': '2013-01-01T03:00:00Z'}])
+        due = self.cache.pop_due(datetime.datetime(2013, 1, 1, 2))
+        self.assertEqual(sorted(due),
+                         [('a', datetime.datetime(2013, 1, 1, 2)),
+                          ('b', datetime.datetime(2013, 1, 1, 2))])
+        self.assertEqual(self.cache.pop_due(datetime.datetime(2013, 1, 1, 2)),
+                         [])
+        self.assertEqual(self.cache.next_due(),
+                         datetime.datetime(2013, 1, 1, 3))
+
+    def test_restore(self):
+        self.cache.update([{'id': 'a', 'next_run': '2013-01-01T02:00:00Z'},
+                           {'id': 'b', 'next_run': '2013-01-01T02:00:00Z'}])
+        due = self.cache.pop_due(datetime.datetime(2013, 1, 1, 2))
+        # a sync in between brought b's next run
+        self.cache.update([{'id': 'b', 'next_run': '2013-01-02T02:00:00Z'}])
+        self.cache.restore(due)
+        self.assertEqual(self.cache.next_runs,
+                         {'a': datetime.datetime(2013, 1, 1, 2),
+                          'b': datetime.datetime(2013, 1, 2, 2)})
+        self.assertEqual(sorted(self.cache.pop_due(
+                             datetime.datetime(2013, 1, 1, 2))),
+                         [('a', datetime.datetime(2013, 1, 1, 2))])
@@ -20,6 +20,7 @@ import webob.exc
 
 from qonos.api.v1 import jobs
 from qonos.common import exception
+from qonos.db import db_utils
 import qonos.db.simple.api as db_api
 from qonos.openstack.common import timeutils
 from qonos.tests.unit import utils as unit_utils
@@ -213,6 +214,46 @@ class TestJobsApi(test_utils.BaseTestCase):
                             self.schedule_1.get('last_scheduled'))
         self.assertTrue(schedule.get('last_scheduled'))
 
+    def _create_daily_schedule(self):
+        return db_api.schedule_create({
+            'tenant': unit_utils.TENANT1,
+            'action': 'snapshot',
+            'minute': '30',
+            'hour': '2',
+            'next_run': datetime.datetime(2012, 11, 27, 2, 30),
+        })
+
+    def test_create_once_per_run(self):
+        schedule = self._create_daily_schedule()
+        request = unit_utils.get_fake_request(method='POST')
+        next_run = timeutils.isotime(schedule['next_run'])
+        fixture = {'job': {'schedule_id': schedule['id'],
+                           'scheduled_run': next_run}}
+        job = self.controller.create(request, fixture).get('job')
+        self.assertEqual(job['scheduled_run'], next_run)
+        advanced = db_api.schedule_get_by_id(schedule['id'])
+        self.assertNotEqual(advanced['next_run'], schedule['next_run'])
+
+        # a retry gets the same job and leaves the schedule be
+        retried = self.controller.create(request, fixture).get('job')
+        self.assertEqual(retried['id'], job['id'])
+        self.assertEqual(db_api.schedule_get_by_id(schedule['id']), advanced)
+
+    def test_create_defaults_to_next_run(self):
+        schedule = self._create_daily_schedule()
+        request = unit_utils.get_fake_request(method='POST')
+        fixture = {'job': {'schedule_id': schedule['id']}}
+        job = self.controller.create(request, fixture).get('job')
+        self.assertEqual(job['scheduled_run'],
+                         timeutils.isotime(schedule['next_run']))
+
+    def test_create_invalid_scheduled_run(self):
+        request = unit_utils.get_fake_request(method='POST')
+        fixture = {'job': {'schedule_id': self.schedule_1['id'],
+                           'scheduled_run': 'not-a-time'}}
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.create, request, fixture)
+
     def test_create_with_metadata(self):
         request = unit_utils.get_fake_request(method='POST')
         fixture = {'job': {'schedule_id': self.schedule_2['id'],
@@ -228,6 +269,107 @@ class TestJobsApi(test_utils.BaseTestCase):
         self.assertTrue('instance_id' in job['metadata'])
         self.assertEqual(job['metadata']['instance_id'], 'my_instance')
 
+    def test_list_archive(self):
+        db_api.job_update(self.job_1['id'], {'status': 'DONE'})
+        db_api.jobs_archive_finished(
+            timeutils.utcnow() + datetime.timedelta(seconds=1), 10)
+        request = unit_utils.get_fake_request(method='GET')
+        jobs = self.controller.list_archive(request).get('jobs')
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(jobs[0]['id'], self.job_1['id'])
+        self.assertEqual(jobs[0]['status'], 'DONE')
+        self.assertEqual(jobs[0]['metadata'], {})
+
+    def test_list_archive_filtered(self):
+        db_api.job_update(self.job_1['id'], {'status': 'DONE'})
+        db_api.jobs_archive_finished(
+            timeutils.utcnow() + datetime.timedelta(seconds=1), 10)
+        path = '?schedule_id=%s' % self.schedule_2['id']
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        jobs = self.controller.list_archive(request).get('jobs')
+        self.assertEqual(jobs, [])
+
+    def test_list_faults(self):
+        fault = db_api.job_fault_create({'job_id': self.job_1['id'],
+                                         'schedule_id': self.schedule_1['id'],
+                                         'tenant': self.job_1['tenant'],
+                                         'worker_id': 'UNASSIGNED',
+                                         'action': 'snapshot',
+                                         'message': 'failed'})
+        request = unit_utils.get_fake_request(method='GET')
+        faults = self.controller.list_faults(request).get('faults')
+        self.assertEqual(len(faults), 1)
+        self.assertEqual(faults[0]['id'], fault['id'])
+        self.assertEqual(faults[0]['message'], 'failed')
+        self.assertEqual(faults[0]['created_at'],
+                         timeutils.isotime(fault['created_at']))
+
+    def test_list_faults_filtered(self):
+        db_api.job_fault_create({'job_id': self.job_1['id'],
+                                 'schedule_id': self.schedule_1['id'],
+                                 'tenant': self.job_1['tenant'],
+                                 'worker_id': 'UNASSIGNED',
+                                 'action': 'snapshot'})
+        path = '?job_id=%s' % self.job_2['id']
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        faults = self.controller.list_faults(request).get('faults')
+        self.assertEqual(faults, [])
+
+    def test_list_faults_invalid_marker(self):
+        request = unit_utils.get_fake_request(path='?marker=missing',
+                                              method='GET')
+        self.assertRaises(webob.exc.HTTPNotFound,
+                          self.controller.list_faults, request)
+
+    def test_enqueue(self):
+        now = timeutils.utcnow()
+        db_api.schedule_update(self.schedule_1['id'],
+                               {'next_run': now - datetime.timedelta(
+                                   minutes=1)})
+        db_api.schedule_update(self.schedule_2['id'],
+                               {'next_run': now + datetime.timedelta(
+                                   hours=1)})
+        request = unit_utils.get_fake_request(method='POST')
+        body = {'next_run_before': timeutils.isotime(now)}
+        job_ids = self.controller.enqueue(request, body).get('job_ids')
+        self.assertEqual(len(job_ids), 1)
+        job = db_api.job_get_by_id(job_ids[0])
+        self.assertEqual(job['schedule_id'], self.schedule_1['id'])
+        self.assertEqual(job['status'], 'queued')
+
+    def test_enqueue_partitions(self):
+        self.config(scheduler_partitions=2, group='api')
+        now = timeutils.utcnow()
+        db_api.schedule_update(self.schedule_1['id'],
+                               {'next_run': now - datetime.timedelta(
+                                   minutes=1)})
+        partition = db_utils.partition_key(self.schedule_1['id']) % 2
+        request = unit_utils.get_fake_request(method='POST')
+        body = {'next_run_before': timeutils.isotime(now)}
+
+        def enqueued(partitions):
+            body['partitions'] = partitions
+            job_ids = self.controller.enqueue(request, body)['job_ids']
+            return [db_api.job_get_by_id(job_id)['schedule_id']
+                    for job_id in job_ids]
+
+        self.assertFalse(self.schedule_1['id'] in enqueued([1 - partition]))
+        self.assertTrue(self.schedule_1['id'] in enqueued([partition]))
+
+    def test_enqueue_invalid_partitions(self):
+        self.config(scheduler_partitions=2, group='api')
+        request = unit_utils.get_fake_request(method='POST')
+        for partitions in (['a'], [2], 'x'):
+            self.assertRaises(webob.exc.HTTPBadRequest,
+                              self.controller.enqueue, request,
+                              {'partitions': partitions})
+
+    def test_enqueue_invalid_next_run_before(self):
+        request = unit_utils.get_fake_request(method='POST')
+        body = {'next_run_before': 'not-a-time'}
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.enqueue, request, body)
+
     def test_get(self):
         request = unit_utils.get_fake_request(method='GET')
         job = self.controller.get(request, self.job_1['id']).get('job')
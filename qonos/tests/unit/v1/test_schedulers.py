@@ -0,0 +1,50 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright 2013 Rackspace
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from qonos.api.v1 import schedulers
+import qonos.db.simple.api as db_api
+from qonos.tests.unit import utils as unit_utils
+from qonos.tests import utils as test_utils
+
+
+class TestSchedulersApi(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestSchedulersApi, self).setUp()
+        self.controller = schedulers.SchedulersController(db_api=db_api)
+        self.config(scheduler_partitions=4, scheduler_lease_ttl=30,
+                    group='api')
+
+    def tearDown(self):
+        super(TestSchedulersApi, self).tearDown()
+        db_api.reset()
+
+    def _lease(self, scheduler_id):
+        request = unit_utils.get_fake_request(method='PUT')
+        return self.controller.lease(request, scheduler_id,
+                                     {'host': 'host-1'})['lease']
+
+    def test_lease(self):
+        lease = self._lease('scheduler-1')
+        self.assertEqual(lease, {'partitions': [0, 1, 2, 3],
+                                 'partition_count': 4, 'ttl': 30})
+
+    def test_release(self):
+        self._lease('scheduler-1')
+        request = unit_utils.get_fake_request(method='DELETE')
+        self.controller.release(request, 'scheduler-1')
+        self.assertEqual(self._lease('scheduler-2')['partitions'],
+                         [0, 1, 2, 3])
@@ -18,12 +18,15 @@ import datetime
 import uuid
 import webob.exc
 
+from qonos.api.v1 import api_utils
 from qonos.api.v1 import schedules
 from qonos.common import exception
 from qonos.common import timeutils
 from qonos.common import utils as qonos_utils
+from qonos.db import db_utils
 from qonos.db.simple import api as db_api
 from qonos.openstack.common import cfg
+from qonos.openstack.common import timeutils as db_timeutils
 from qonos.tests.unit import utils as unit_utils
 from qonos.tests import utils as test_utils
 
@@ -121,6 +124,53 @@ class TestSchedulesApi(test_utils.BaseTestCase):
         schedules = self.controller.list(request).get('schedules')
         self.assertEqual(len(schedules), 3)
 
+    def test_list_changed_since_filtered(self):
+        changed_since = self.schedule_4['updated_at'] + \
+            datetime.timedelta(seconds=1)
+        db_timeutils.set_time_override(changed_since)
+        self.addCleanup(db_timeutils.clear_time_override)
+        db_api.schedule_update(self.schedule_1['id'], {'hour': '4'})
+        path = '?changed_since=%s' % timeutils.isotime(changed_since)
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        schedules = self.controller.list(request).get('schedules')
+        self.assertEqual([s['id'] for s in schedules],
+                         [self.schedule_1['id']])
+
+    def test_list_changed_since_consistent(self):
+        calls = []
+
+        def fake_schedule_get_all(filter_args={}, consistent=False):
+            calls.append(consistent)
+            return []
+        self.stubs.Set(db_api, 'schedule_get_all', fake_schedule_get_all)
+
+        self.controller.list(unit_utils.get_fake_request(method='GET'))
+        path = '?changed_since=%s' % timeutils.isotime()
+        self.controller.list(unit_utils.get_fake_request(path=path,
+                                                         method='GET'))
+        self.assertEqual(calls, [False, True])
+
+    def test_list_partitions_filtered(self):
+        self.config(scheduler_partitions=2, group='api')
+        request = unit_utils.get_fake_request(path='?partitions=0,1',
+                                              method='GET')
+        schedules = self.controller.list(request).get('schedules')
+        self.assertEqual(len(schedules), 4)
+
+        request = unit_utils.get_fake_request(path='?partitions=1',
+                                              method='GET')
+        schedules = self.controller.list(request).get('schedules')
+        for schedule in schedules:
+            self.assertEqual(db_utils.partition_key(schedule['id']) % 2, 1)
+
+    def test_list_invalid_partitions(self):
+        self.config(scheduler_partitions=2, group='api')
+        for partitions in ('a', '0,2', '-1'):
+            request = unit_utils.get_fake_request(
+                path='?partitions=%s' % partitions, method='GET')
+            self.assertRaises(webob.exc.HTTPBadRequest,
+                              self.controller.list, request)
+
     def test_list_next_run_filtered_before_less_than_after(self):
         after = self.schedule_3['next_run']
         before = timeutils.isotime(after
@@ -131,6 +181,20 @@ class TestSchedulesApi(test_utils.BaseTestCase):
         schedules = self.controller.list(request).get('schedules')
         self.assertEqual(len(schedules), 0)
 
+    def test_list_instance_id_filtered_by_list(self):
+        for schedule, instance_id in ((self.schedule_1, 'inst-1'),
+                                      (self.schedule_2, 'inst-2'),
+                                      (self.schedule_3, 'inst-3')):
+            db_api.schedule_meta_create(schedule['id'],
+                                        {'key': 'instance_id',
+                                         'value': instance_id})
+        path = '?instance_id=inst-1,inst-3,inst-5'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        schedules = self.controller.list(request).get('schedules')
+        self.assertEqual(sorted(s['id'] for s in schedules),
+                         sorted([self.schedule_1['id'],
+                                 self.schedule_3['id']]))
+
     def test_list_limit(self):
         path = '?limit=2'
         request = unit_utils.get_fake_request(path=path, method='GET')
@@ -203,9 +267,29 @@ class TestSchedulesApi(test_utils.BaseTestCase):
                              set([self.schedule_2[k], self.schedule_3[k]]))
         for item in links:
             if item.get('rel') == 'next':
-                marker = unit_utils.SCHEDULE_UUID3
-                self.assertEqual(item.get('href'), '/v1/schedules?marker=%s' %
-                                 marker)
+                cursor = db_utils.encode_cursor({'id':
+                                                 unit_utils.SCHEDULE_UUID3})
+                self.assertEqual(item.get('href'), '/v1/schedules?cursor=%s' %
+                                 cursor)
+
+    def test_list_with_cursor(self):
+        self.config(limit_param_default=2, api_limit_max=4)
+        request = unit_utils.get_fake_request(method='GET')
+        links = self.controller.list(request).get('schedules_links')
+        next_page = [l['href'] for l in links if l['rel'] == 'next'][0]
+        path = next_page[len('/v1/schedules'):]
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        schedules = self.controller.list(request).get('schedules')
+        self.assertEqual(len(schedules), 2)
+        for k in SCHEDULE_ATTRS:
+            self.assertEqual(set([s[k] for s in schedules]),
+                             set([self.schedule_3[k], self.schedule_4[k]]))
+
+    def test_list_invalid_cursor(self):
+        path = '?cursor=%s' % 'not-a-cursor'
+        request = unit_utils.get_fake_request(path=path, method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.list, request)
 
     def test_get(self):
         request = unit_utils.get_fake_request(method='GET')
@@ -242,6 +326,114 @@ class TestSchedulesApi(test_utils.BaseTestCase):
         self.assertEqual(expected['minute'], actual['minute'])
         self.assertEqual(expected['hour'], actual['hour'])
 
+    def test_create_smoothed(self):
+        self.config(schedule_smoothing_window='23:00-01:00', group='api')
+        self.controller = schedules.SchedulesController(db_api=db_api)
+        request = unit_utils.get_fake_request(method='POST')
+        times = set()
+        for i in range(20):
+            fixture = {'schedule': {'tenant': unit_utils.TENANT1,
+                                    'action': 'snapshot'}}
+            schedule = self.controller.create(request, fixture)['schedule']
+            self.assertTrue(schedule['hour'] in (23, 0))
+            times.add((schedule['hour'], schedule['minute']))
+
+            stored = db_api.schedule_get_by_id(schedule['id'])
+            self.assertEqual(stored['next_run'].hour, schedule['hour'])
+            self.assertEqual(stored['next_run'].minute, schedule['minute'])
+
+            again = {'id': schedule['id']}
+            api_utils.smooth_schedule(again, (1380, 120))
+            self.assertEqual((again['hour'], again['minute']),
+                             (schedule['hour'], schedule['minute']))
+        self.assertTrue(len(times) > 1)
+
+    def test_create_smoothing_keeps_given_time(self):
+        self.config(schedule_smoothing_window='00:00-04:00', group='api')
+        self.controller = schedules.SchedulesController(db_api=db_api)
+        request = unit_utils.get_fake_request(method='POST')
+        fixture = {'schedule': {'tenant': unit_utils.TENANT1,
+                                'action': 'snapshot',
+                                'minute': 15}}
+        schedule = self.controller.create(request, fixture)['schedule']
+        self.assertEqual(schedule['minute'], 15)
+        self.assertEqual(schedule.get('hour'), None)
+
+    def test_invalid_smoothing_window_fails_at_startup(self):
+        self.config(schedule_smoothing_window='23:00', group='api')
+        self.assertRaises(exception.Invalid,
+                          schedules.SchedulesController, db_api=db_api)
+
+    def test_parse_time_window(self):
+        self.assertEqual(api_utils.parse_time_window('00:00-04:00'),
+                         (0, 240))
+        self.assertEqual(api_utils.parse_time_window('22:30-01:00'),
+                         (1350, 150))
+        self.assertEqual(api_utils.parse_time_window('03:00-03:00'),
+                         (180, 1440))
+        for window in ('', '00:00', '0-4', '00:00-24:00', 'a:00-04:00'):
+            self.assertRaises(exception.Invalid,
+                              api_utils.parse_time_window, window)
+
+    def test_load(self):
+        request = unit_utils.get_fake_request(method='GET')
+        load = self.controller.load(request)['load']
+        self.assertEqual(
+            load,
+            [{'minute': timeutils.isotime(schedule['next_run']), 'count': 1}
+             for schedule in sorted([self.schedule_1, self.schedule_2,
+                                     self.schedule_3, self.schedule_4],
+                                    key=lambda s: s['next_run'])])
+
+    def test_load_next_run_before(self):
+        next_run = timeutils.isotime(self.schedule_2['next_run'])
+        request = unit_utils.get_fake_request(
+            path='?next_run_after=%s&next_run_before=%s' % (next_run,
+                                                            next_run),
+            method='GET')
+        load = self.controller.load(request)['load']
+        self.assertEqual(load, [{'minute': next_run, 'count': 1}])
+
+    def test_load_invalid_time(self):
+        request = unit_utils.get_fake_request(path='?next_run_after=x',
+                                              method='GET')
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.load, request)
+
+    def test_forecast(self):
+        db_api.schedule_create({'tenant': unit_utils.TENANT1,
+                                'action': 'backup',
+                                'minute': '0', 'hour': '*/2'})
+        request = unit_utils.get_fake_request(
+            path='?start=2013-01-01T02:00:00Z&end=2013-01-01T06:00:00Z'
+                 '&bucket_minutes=90',
+            method='GET')
+        forecast = self.controller.forecast(request)['forecast']
+        self.assertEqual(forecast, [
+            {'start': '2013-01-01T02:00:00Z', 'end': '2013-01-01T03:30:00Z',
+             'jobs': {'snapshot': 1, 'backup': 1}},
+            {'start': '2013-01-01T03:30:00Z', 'end': '2013-01-01T05:00:00Z',
+             'jobs': {'snapshot': 2, 'backup': 1}},
+            {'start': '2013-01-01T05:00:00Z', 'end': '2013-01-01T06:00:00Z',
+             'jobs': {'snapshot': 1}},
+        ])
+
+    def test_forecast_defaults_to_hourly_for_a_day(self):
+        request = unit_utils.get_fake_request(method='GET')
+        forecast = self.controller.forecast(request)['forecast']
+        self.assertEqual(len(forecast), 24)
+        self.assertEqual(sum(bucket['jobs'].get('snapshot', 0)
+                             for bucket in forecast), 4)
+
+    def test_forecast_bad_request(self):
+        for query in ('?start=x', '?bucket_minutes=x', '?bucket_minutes=0',
+                      '?start=2013-01-02T00:00:00Z&end=2013-01-01T00:00:00Z',
+                      '?start=2013-01-01T00:00:00Z&end=2013-03-01T00:00:00Z',
+                      '?bucket_minutes=0.1'):
+            request = unit_utils.get_fake_request(path=query, method='GET')
+            self.assertRaises(webob.exc.HTTPBadRequest,
+                              self.controller.forecast, request)
+
     def test_create_no_body_bad_request(self):
         request = unit_utils.get_fake_request(method='POST')
         schedule_id = str(uuid.uuid4())
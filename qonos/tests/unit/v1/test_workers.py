@@ -294,3 +294,41 @@ class TestWorkersApi(test_utils.BaseTestCase):
                                            self.worker_1['id'],
                                            fixture)
         self.assertEqual(self.worker_1['id'], job['job']['worker_id'])
+
+    def test_get_next_jobs_for_action(self):
+        request = unit_utils.get_fake_request(method='POST')
+        fixture = {'action': 'snapshot', 'max_jobs': 5}
+        jobs = self.controller.get_next_job(request,
+                                            self.worker_1['id'],
+                                            fixture)['jobs']
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(self.worker_1['id'], jobs[0]['worker_id'])
+        self.assertTrue('metadata' in jobs[0])
+
+    def test_get_next_jobs_leased_for_timeout(self):
+        self.config(timeout_seconds=600, group='action_default')
+        timeutils.set_time_override()
+        self.addCleanup(timeutils.clear_time_override)
+        request = unit_utils.get_fake_request(method='POST')
+        fixture = {'action': 'snapshot', 'max_jobs': 5}
+        jobs = self.controller.get_next_job(request,
+                                            self.worker_1['id'],
+                                            fixture)['jobs']
+        expected = timeutils.utcnow() + datetime.timedelta(seconds=600)
+        self.assertEqual(jobs[0]['timeout'], timeutils.isotime(expected))
+
+    def test_get_next_jobs_none_for_action(self):
+        request = unit_utils.get_fake_request(method='POST')
+        fixture = {'action': 'dummy', 'max_jobs': 5}
+        jobs = self.controller.get_next_job(request,
+                                            self.worker_1['id'],
+                                            fixture)
+        self.assertEqual(jobs['jobs'], [])
+
+    def test_get_next_jobs_invalid_max_jobs(self):
+        request = unit_utils.get_fake_request(method='POST')
+        for max_jobs in ('cow', 0, -1, [5], {'n': 5}):
+            fixture = {'action': 'snapshot', 'max_jobs': max_jobs}
+            self.assertRaises(webob.exc.HTTPBadRequest,
+                              self.controller.get_next_job,
+                              request, self.worker_1['id'], fixture)
@@ -14,10 +14,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import datetime
 import fakes
 import mox
 import time
 
+from qonos.openstack.common import timeutils
 from qonos.tests import utils as test_utils
 from qonos.worker import worker
 
@@ -102,6 +104,40 @@ class TestWorker(test_utils.BaseTestCase):
 
         self.mox.VerifyAll()
 
+    def test_run_loop_with_job_batch(self):
+        self.client.create_worker(mox.IsA(str)).AndReturn(fakes.WORKER)
+        jobs = {'jobs': [fakes.JOB['job'], fakes.JOB['job']]}
+        self.client.get_next_job(str(fakes.WORKER_ID), mox.IsA(str),
+                                 max_jobs=2).AndReturn(jobs)
+        self.client.delete_worker(str(fakes.WORKER_ID))
+        self.mox.ReplayAll()
+
+        self.config(job_poll_interval=5, group='worker')
+        self.config(action_type='snapshot', group='worker')
+        self.config(max_jobs_per_poll=2, group='worker')
+
+        fake_sleep = lambda x: None
+        self.stubs.Set(time, 'sleep', fake_sleep)
+
+        self.worker.run(run_once=True, poll_once=True)
+        self.assertTrue(self.processor.was_process_job_called(1))
+        self.assertEqual(self.worker.pending_jobs, [fakes.JOB['job']])
+
+        self.mox.VerifyAll()
+
+    def test_poll_drops_pending_jobs_past_their_lease(self):
+        expired = dict(fakes.JOB['job'], id='expired',
+                       timeout=timeutils.isotime(
+                           timeutils.utcnow() -
+                           datetime.timedelta(minutes=1)))
+        leased = dict(fakes.JOB['job'], timeout=timeutils.isotime(
+            fakes.TIMEOUT))
+        self.worker.pending_jobs = [expired, leased]
+
+        job = self.worker._poll_for_next_job(poll_once=True)
+        self.assertEqual(job, leased)
+        self.assertEqual(self.worker.pending_jobs, [])
+
 
 class FakeProcessor(worker.JobProcessor):
 
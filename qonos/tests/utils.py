@@ -79,7 +79,7 @@ class BaseTestCase(unittest.TestCase):
         self.assertTrue(found)
 
 
-def import_test_cases(target_module, test_module, suffix=""):
+def import_test_cases(target_module, test_module, suffix="", mixins=()):
     """Adds test cases to target module.
 
     Adds all testcase classes in test_module to target_module and appends an
@@ -88,9 +88,11 @@ def import_test_cases(target_module, test_module, suffix=""):
     :param target_module: module which has an attribute set for each test case
     :param test_module: module containing test cases to copy
     :param suffix: an optional suffix to be added to each test case class name
+    :param mixins: optional classes each copied test case also derives from,
+                   ahead of the original test case
 
     """
     for name, obj in inspect.getmembers(test_module):
         if inspect.isclass(obj) and issubclass(obj, BaseTestCase):
             setattr(target_module, name + suffix,
-                    type(name + suffix, (obj,), {}))
+                    type(name + suffix, tuple(mixins) + (obj,), {}))
@@ -23,6 +23,7 @@ from qonos.openstack.common import cfg
 from qonos.openstack.common.gettextutils import _
 from qonos.openstack.common import importutils
 import qonos.openstack.common.log as logging
+from qonos.openstack.common import timeutils
 
 LOG = logging.getLogger(__name__)
 
@@ -42,6 +43,10 @@ worker_opts = [
     cfg.StrOpt('processor_class', default=None,
                help=_('The fully qualified class name of the processor '
                       'to use in this worker')),
+    cfg.IntOpt('max_jobs_per_poll', default=1,
+               help=_('Maximum number of jobs to claim on each poll. '
+                      'Jobs beyond the first are processed in order '
+                      'without polling again')),
 ]
 
 CONF = cfg.CONF
@@ -57,6 +62,7 @@ class Worker(object):
 
         self.processor = processor
         self.worker_id = None
+        self.pending_jobs = []
         self.host = socket.gethostname()
 
     def run(self, run_once=False, poll_once=False):
@@ -112,17 +118,38 @@ class Worker(object):
         self.running = False
 
     def _poll_for_next_job(self, poll_once=False):
+        while self.pending_jobs:
+            job = self.pending_jobs.pop(0)
+            # NOTE: once its lease runs out another worker may have
+            # claimed the job, so it is left to that worker
+            if not _lease_expired(job):
+                return job
+            LOG.debug(_('Dropping job %s whose lease ran out') % job['id'])
+
         LOG.debug(_("Attempting to get next job from API"))
         job = None
         while job is None:
             time.sleep(CONF.worker.job_poll_interval)
-            job = self.client.get_next_job(self.worker_id,
-                                           CONF.worker.action_type)['job']
+            job = self._get_next_job()
             if poll_once:
                 break
 
         return job
 
+    def _get_next_job(self):
+        max_jobs = CONF.worker.max_jobs_per_poll
+        if max_jobs <= 1:
+            return self.client.get_next_job(self.worker_id,
+                                            CONF.worker.action_type)['job']
+
+        jobs = self.client.get_next_job(self.worker_id,
+                                        CONF.worker.action_type,
+                                        max_jobs=max_jobs)['jobs']
+        if not jobs:
+            return None
+        self.pending_jobs.extend(jobs[1:])
+        return jobs[0]
+
     def update_job(self, job_id, status, timeout=None, error_message=None):
         msg = (_("Worker: [%(worker_id)s] updating "
                "job [%(job_id)s] Status: %(status)s") %
@@ -140,6 +167,15 @@ class Worker(object):
         self.client.update_job_status(job_id, status, timeout, error_message)
 
 
+def _lease_expired(job):
+    timeout = job.get('timeout')
+    if timeout is None:
+        return False
+    if isinstance(timeout, basestring):
+        timeout = timeutils.normalize_time(timeutils.parse_isotime(timeout))
+    return timeout <= timeutils.utcnow()
+
+
 class JobProcessor(object):
     def __init__(self):
         self.worker = None